@@ -74,7 +74,7 @@ dataloader.train=L(MultiTaskDataLoader)(
             shuffle=True,
             num_classes=seg_num_classes,
             is_train=True,
-            use_shared_memory=False,
+            use_shared_memory=True,
         ),
         #汽车分类
         fgvc=L(build_vehiclemulti_train_loader_lazy)(
@@ -294,7 +294,7 @@ from modeling.heads.mask2former.mask2former import Mask2Former
 from modeling.losses.mask2former_loss import Mask2FormerLoss
 from modeling.heads.swin_detr import DETR
 from ppdet.modeling.transformers.matchers import HungarianMatcher
-from ppdet.modeling.post_process import DETRBBoxPostProcess
+from modeling.post_process import DETRBBoxPostProcess
 from modeling.losses.dino_loss import DINOLoss
 from modeling.heads.detr_head import DINOHead
 from modeling.transformers.dino_transformer import DINOTransformer
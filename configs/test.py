@@ -146,7 +146,7 @@ from modeling.heads.mask2former.mask2former import Mask2Former
 from modeling.losses.mask2former_loss import Mask2FormerLoss
 from modeling.heads.swin_detr import DETR
 from ppdet.modeling.transformers.matchers import HungarianMatcher
-from ppdet.modeling.post_process import DETRBBoxPostProcess
+from modeling.post_process import DETRBBoxPostProcess
 from modeling.losses.dino_loss import DINOLoss
 from modeling.heads.detr_head import DINOHead
 from modeling.transformers.dino_transformer import DINOTransformer
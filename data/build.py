@@ -1,7 +1,10 @@
 # !/usr/bin/env python3
 import os
+import time
+import queue
 import random
 import logging
+import threading
 from collections.abc import Mapping
 
 import numpy as np
@@ -19,30 +22,273 @@ from data.transforms.detection_ops import Compose, BatchCompose
 _root = os.getenv("FASTREID_DATASETS", "datasets")
 
 
-def fast_batch_collator(batched_inputs):
+class BatchBufferPool(object):
+    """
+    Preallocated batch arrays reused across steps, a ring of `num_buffers` arrays per
+    field. Each process (e.g. every DataLoader worker) allocates its own private buffers;
+    this saves the allocation of the collated arrays, not the copy paddle makes of them.
+
+    A buffer is overwritten `num_buffers` batches later, so the consumer must copy the
+    batch before that, which the paddle DataLoader does synchronously when it moves the
+    batch into shared memory (`use_shared_memory=True`) or into a tensor (`num_workers=0`).
+    With workers and `use_shared_memory=False` the batch is pickled later by a background
+    thread of the queue, so the pool must not be used, see :class:`BufferedBatchCollator`.
+    """
+    def __init__(self, num_buffers=2):
+        self.num_buffers = num_buffers
+        self._rings = {}
+
+    def stack(self, key, arrays):
+        """stack `arrays` along a new first axis into the next buffer of field `key`
+        """
+        shape = (len(arrays),) + arrays[0].shape
+        dtype = np.result_type(*arrays)
+        ring = self._rings.get(key)
+        if ring is None or ring['shape'] != shape or ring['dtype'] != dtype:
+            ring = {
+                'shape': shape,
+                'dtype': dtype,
+                'buffers': [np.empty(shape, dtype=dtype) for _ in range(self.num_buffers)],
+                'next': 0,
+            }
+            self._rings[key] = ring
+        buf = ring['buffers'][ring['next']]
+        ring['next'] = (ring['next'] + 1) % self.num_buffers
+        np.stack(arrays, axis=0, out=buf)
+        return buf
+
+
+def fast_batch_collator(batched_inputs, buffer_pool=None, key=''):
     """
     A simple batch collator for most common reid tasks.
     There is no need of transforming data to GPU in fast_batch_collator
+
+    Args:
+        buffer_pool (BatchBufferPool): if given, arrays are written into its reused
+            buffers instead of freshly allocated ones.
+        key (str): name of the collated field, used to pick the buffer.
     """
     elem = batched_inputs[0]
     if isinstance(elem, np.ndarray):
         # return paddle.to_tensor(np.concatenate([ np.expand_dims(elem, axis=0) for elem in batched_inputs], axis=0))
-        return np.concatenate([np.expand_dims(elem, axis=0) for elem in batched_inputs], axis=0)
+        if buffer_pool is not None:
+            return buffer_pool.stack(key, batched_inputs)
+        return np.stack(batched_inputs, axis=0)
 
     elif isinstance(elem, Mapping):
-        return {key: fast_batch_collator([d[key] for d in batched_inputs]) for key in elem}
+        return {k: fast_batch_collator([d[k] for d in batched_inputs], buffer_pool, '{}/{}'.format(key, k))
+                for k in elem}
     elif isinstance(elem, float):
         # return paddle.to_tensor(batched_inputs, dtype=paddle.float64)
         return np.array(batched_inputs, dtype=np.float64) 
-    elif isinstance(elem, int):
+    elif isinstance(elem, (int, np.number)):
         #return paddle.to_tensor(batched_inputs)
         return np.array(batched_inputs) 
     elif isinstance(elem, str):
         return batched_inputs
+    elif isinstance(elem, (list, tuple)):
+        return [fast_batch_collator(list(fields), buffer_pool, '{}/{}'.format(key, i))
+                for i, fields in enumerate(zip(*batched_inputs))]
+
+
+class BufferedBatchCollator(object):
+    """
+    `fast_batch_collator` writing samples into preallocated buffers that are reused across
+    steps, see :class:`BatchBufferPool`. paddle still copies every batch out of them.
+
+    Args:
+        num_workers (int), use_shared_memory (bool): those of the DataLoader. The pool is
+            disabled for workers without shared memory, whose batches are pickled
+            asynchronously and could be overwritten while still queued.
+    """
+    def __init__(self, num_buffers=2, num_workers=0, use_shared_memory=True):
+        self.num_buffers = num_buffers
+        self.enabled = num_workers == 0 or use_shared_memory
+        self.buffer_pool = None
+
+    def __call__(self, batched_inputs):
+        if not self.enabled:
+            return fast_batch_collator(batched_inputs)
+        # created lazily so every worker process owns its buffers
+        if self.buffer_pool is None:
+            self.buffer_pool = BatchBufferPool(self.num_buffers)
+        return fast_batch_collator(batched_inputs, self.buffer_pool)
+
+
+def _process_rss(pid):
+    """resident set size (bytes) of process `pid`, 0 if it can not be read
+    """
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+def _shutdown_loader_iter(iterator):
+    """terminate the worker processes and reader thread behind a paddle DataLoader iterator
+    """
+    if hasattr(iterator, '_try_shutdown_all'):
+        iterator._try_shutdown_all()
+
+
+class _TaskPrefetcher(object):
+    """Fill a bounded queue with batches of one task loader in a background thread.
+    """
+    _END = object()
+
+    def __init__(self, name, iterator, depth):
+        self.name = name
+        self.iterator = iterator
+        self.queue = queue.Queue(maxsize=depth)
+        self.wait_time = 0.
+        self.last_wait_time = 0.
+        self.num_batches = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._worker, name='prefetch-{}'.format(name), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self):
+        while not self._stop_event.is_set():
+            try:
+                item = next(self.iterator)
+            except StopIteration:
+                self._put(self._END)
+                return
+            except Exception as e:  # re-raised on the trainer thread
+                self._put(e)
+                return
+            if not self._put(item):
+                return
+
+    def get(self):
+        """get the next ready batch, recording how long the caller was blocked
+        """
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.last_wait_time = time.perf_counter() - start
+        self.wait_time += self.last_wait_time
+        if item is self._END:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        self.num_batches += 1
+        return item
+
+    def stop(self):
+        """stop
+        """
+        self._stop_event.set()
+        self._thread.join(timeout=1.0)
+
+
+class TaskSampler(object):
+    """Pick the task trained at each step when `sample_mode='sample'`.
+
+    Args:
+        task_loaders (dict): task name -> loader, in task order.
+        weighting (str): how the task probabilities are built,
+            'static': proportional to `sample_prob`;
+            'temperature': proportional to dataset_size ** (1 / temperature);
+            'cost': proportional to `sample_prob` (uniform if empty) divided by the
+                measured step cost of the task, favouring cheap tasks.
+        sample_prob (list[float]): static weights, one per task.
+        temperature (float): temperature for 'temperature' weighting.
+        cost_momentum (float): momentum of the moving average of the step cost.
+        cost_sync_period (int): number of steps between two cost averagings across ranks.
+        seed (int): seed of the task RNG. It must be the same on every rank so all ranks
+            train the same task at each step.
+    """
+    def __init__(self, task_loaders, weighting='static', sample_prob=None, temperature=1.0,
+            cost_momentum=0.9, cost_sync_period=50, seed=0):
+        self.task_names = list(task_loaders.keys())
+        self.weighting = weighting
+        self.cost_momentum = cost_momentum
+        self.cost_sync_period = cost_sync_period
+        self._rng = random.Random(seed)
+        self._num_steps = 0
+
+        num_tasks = len(self.task_names)
+        if sample_prob:
+            assert len(sample_prob) == num_tasks, \
+                "sample_prob has {} entries for {} tasks".format(len(sample_prob), num_tasks)
+            base_weights = np.array(sample_prob, dtype=np.float64)
+        else:
+            base_weights = np.ones(num_tasks, dtype=np.float64)
+
+        if weighting == 'static' or weighting == 'cost':
+            self.base_weights = base_weights
+        elif weighting == 'temperature':
+            sizes = np.array([len(loader.dataset) for loader in task_loaders.values()], dtype=np.float64)
+            self.base_weights = sizes ** (1.0 / temperature)
+        else:
+            raise ValueError("Unknown task sampling weighting: {}".format(weighting))
+
+        # moving average of the measured step cost (seconds) per task, nan until measured
+        self.task_costs = np.full(num_tasks, np.nan)
+        self._synced_costs = np.ones(num_tasks, dtype=np.float64)
+        self.probs = self.base_weights / self.base_weights.sum()
+
+    def update_cost(self, name, cost):
+        """update the moving average of the step cost of task `name`
+        """
+        idx = self.task_names.index(name)
+        if np.isnan(self.task_costs[idx]):
+            self.task_costs[idx] = cost
+        else:
+            self.task_costs[idx] = self.cost_momentum * self.task_costs[idx] + (1 - self.cost_momentum) * cost
+
+    def _sync_costs(self):
+        costs = self.task_costs.copy()
+        measured = ~np.isnan(costs)
+        if not measured.any():
+            return
+        # tasks that were never sampled get the mean cost of the others
+        costs[~measured] = costs[measured].mean()
+        if comm.get_world_size() > 1:
+            costs_tensor = paddle.to_tensor(costs)
+            paddle.distributed.all_reduce(costs_tensor)
+            costs = costs_tensor.numpy() / comm.get_world_size()
+        self._synced_costs = costs
+        weights = self.base_weights / np.maximum(self._synced_costs, 1e-6)
+        self.probs = weights / weights.sum()
+
+    def sample(self):
+        """
+        Returns:
+            str: name of the task to train at this step
+        """
+        if self.weighting == 'cost' and self._num_steps % self.cost_sync_period == 0:
+            self._sync_costs()
+        self._num_steps += 1
+        return self._rng.choices(self.task_names, weights=self.probs)[0]
 
 
 class MultiTaskDataLoader(object):
     """MultiTaskDataLoader
+
+    cfg:
+        sample_mode (str): 'batch' pulls one batch from every task per step,
+            'sample' pulls one batch of a single task chosen by :class:`TaskSampler`.
+        sample_weighting, sample_prob, sample_temperature, cost_momentum,
+            cost_sync_period, sample_seed: see :class:`TaskSampler`.
+        prefetch (bool): if True, every task loader fills its own bounded queue in
+            a background thread and `__next__` only assembles ready batches.
+        prefetch_depth (int): max number of batches buffered per task.
+        cycle (bool): if True, a task loader that runs out of data is restarted instead of
+            ending the iteration. Otherwise all workers are shut down at the end of the epoch.
     """
     def __init__(self, task_loaders, cfg):
         super().__init__()
@@ -50,36 +296,139 @@ class MultiTaskDataLoader(object):
         self.cfg = cfg
 
         self.task_iters = {}
+        self._start_iters()
+
+        self.task_sampler = None
+        if self.cfg.sample_mode == 'sample':
+            self.task_sampler = TaskSampler(
+                self.task_loaders,
+                weighting=self.cfg.get('sample_weighting', 'static'),
+                sample_prob=self.cfg.get('sample_prob', None),
+                temperature=self.cfg.get('sample_temperature', 1.0),
+                cost_momentum=self.cfg.get('cost_momentum', 0.9),
+                cost_sync_period=self.cfg.get('cost_sync_period', 50),
+                seed=self.cfg.get('sample_seed', 0),
+            )
+
+        self.prefetchers = {}
+        for name in self.task_iters:
+            self._start_prefetcher(name)
+
+    def _start_iters(self):
         for name, loader in self.task_loaders.items():
             self.task_iters[name] = iter(loader)
 
+    def _start_prefetcher(self, name):
+        if self.cfg.get('prefetch', False):
+            self.prefetchers[name] = _TaskPrefetcher(name, self.task_iters[name], self.cfg.get('prefetch_depth', 2))
+
     def __iter__(self):
+        # iterators are shut down once exhausted, start a new epoch
+        if not self.task_iters:
+            self._start_iters()
+            for name in list(self.task_iters.keys()):
+                self._start_prefetcher(name)
         return self
         
     def __len__(self):
         # TODO: make it more general
-        return len(list(self.task_iters.values())[0])
+        return len(list(self.task_loaders.values())[0])
+
+    def _next_task_batch(self, name):
+        try:
+            if name in self.prefetchers:
+                return self.prefetchers[name].get()
+            return next(self.task_iters[name])
+        except StopIteration:
+            if not self.cfg.get('cycle', False):
+                # end of epoch: release every worker pool before stopping
+                self.shutdown()
+                raise
+        # finite loader used as an endless stream: start its next epoch
+        self.reset(name)
+        if name in self.prefetchers:
+            return self.prefetchers[name].get()
+        return next(self.task_iters[name])
+
+    def reset(self, name=None):
+        """
+        Shut down the iterator of task `name` (all tasks if None) together with its
+        worker processes and start a new one.
+        """
+        names = list(self.task_iters.keys()) if name is None else [name]
+        for name in names:
+            self._shutdown_task(name)
+            self.task_iters[name] = iter(self.task_loaders[name])
+            self._start_prefetcher(name)
+
+    def _shutdown_task(self, name):
+        prefetcher = self.prefetchers.pop(name, None)
+        if prefetcher is not None:
+            prefetcher.stop()
+        iter_ = self.task_iters.pop(name, None)
+        if iter_ is not None:
+            _shutdown_loader_iter(iter_)
 
     def __next__(self):
         batch = {}
 
         if self.cfg.sample_mode == 'batch':
-            for name, iter_ in self.task_iters.items():
-                batch[name] = next(iter_)
+            for name in list(self.task_iters.keys()):
+                batch[name] = self._next_task_batch(name)
         elif self.cfg.sample_mode == 'sample':
-            name = random.choices(self.task_iters.keys(), self.cfg.sample_prob)[0]
-            batch[name] = next(self.task_iters[name])
+            name = self.task_sampler.sample()
+            batch[name] = self._next_task_batch(name)
         else:
             raise NotImplementedError
 
         return batch
 
+    @property
+    def track_task_cost(self):
+        """whether the trainer should measure and report the step cost of each task
+        """
+        return self.task_sampler is not None and self.task_sampler.weighting == 'cost'
+
+    def update_task_cost(self, name, cost):
+        """report the measured forward/backward time (seconds) of task `name`
+        """
+        if self.task_sampler is not None:
+            self.task_sampler.update_cost(name, cost)
+
+    def prefetch_stats(self):
+        """
+        Returns:
+            dict: per-task queue depth, wait time of the last step and average wait
+                time, keyed as `prefetch/<task>_<counter>`. Empty if prefetch is disabled.
+        """
+        stats = {}
+        for name, prefetcher in self.prefetchers.items():
+            stats['prefetch/{}_queue'.format(name)] = prefetcher.queue.qsize()
+            stats['prefetch/{}_wait'.format(name)] = prefetcher.last_wait_time
+            stats['prefetch/{}_avg_wait'.format(name)] = prefetcher.wait_time / max(prefetcher.num_batches, 1)
+        return stats
+
+    def worker_stats(self):
+        """
+        Returns:
+            dict: number of alive worker processes and their total resident memory
+                (bytes) per task, keyed as `workers/<task>_<counter>`.
+        """
+        stats = {}
+        for name, iter_ in self.task_iters.items():
+            workers = [w for w in getattr(iter_, '_workers', []) if w.is_alive()]
+            stats['workers/{}_num'.format(name)] = len(workers)
+            stats['workers/{}_rss'.format(name)] = sum(_process_rss(w.pid) for w in workers)
+        return stats
+
     # Signal for shutting down background thread
     def shutdown(self):
-        """shutdown
         """
-        for name, loader in self.task_loaders:
-            loader.shutdown()
+        Stop the prefetch threads and terminate the worker processes of every task
+        loader. Iterating over the loader again starts new workers.
+        """
+        for name in list(self.task_iters.keys()):
+            self._shutdown_task(name)
 
 
 class MOEplusplusMultiTaskDataLoader(MultiTaskDataLoader):
@@ -96,11 +445,18 @@ class MOEplusplusMultiTaskDataLoader(MultiTaskDataLoader):
 
         self.task_loaders = task_loaders
         self.cfg = cfg
+        self.taskname = taskname
 
-        self.task_iters = {taskname: iter(task_loaders[taskname])}
+        self.task_iters = {}
+        self._start_iters()
+        self.task_sampler = None
+        self.prefetchers = {}
         # for name, loader in self.task_loaders.items():
         #     self.task_iters[name] = iter(loader)
 
+    def _start_iters(self):
+        self.task_iters[self.taskname] = iter(self.task_loaders[self.taskname])
+
 
 def build_reid_test_loader_lazy(test_set, test_batch_size, num_workers, dp_degree=None, alive_rank_list=None):
     """
@@ -12,7 +12,7 @@ from fastreid.data.data_utils import read_image
 from fastreid.data.datasets import DATASET_REGISTRY
 from tools import moe_group_utils
 from paddle.io import Dataset
-from data.build import fast_batch_collator
+from data.build import fast_batch_collator, BufferedBatchCollator
 
 from data.samplers.clsaware_reader import VehicleMultiTaskClassAwareSampler
 from .datasets.fgvc_dataset import *
@@ -30,7 +30,8 @@ class HierachicalCommDataset(Dataset):
         self.dataset_name = dataset_name
         self._num_classes = num_classes
         self.labels = []
-        self.id2imgname = self.id2name(img_items)
+        # 列式索引, 样本中只传im_id, 路径等由评估端通过索引查找
+        self.index = self.build_index(img_items)
         self.is_train = is_train
 
         cam_set = set()
@@ -38,12 +39,20 @@ class HierachicalCommDataset(Dataset):
         if relabel:
             self.cam_dict = dict([(p, i) for i, p in enumerate(self.cams)])
 
-    def id2name(self, img_items):
-        id2name = {}
-        for i, item in enumerate(img_items):
-             img_path = item[0]
-             id2name[i] = img_path
-        return id2name
+    def build_index(self, img_items):
+        """columnar metadata of img_items: one numpy array per field, aligned with img_items
+        """
+        return {
+            'img_paths': np.array([item[0] for item in img_items], dtype=np.str_),
+            'targets': np.array([item[1] for item in img_items], dtype='int64'),
+            'im_ids': np.array([item[3] for item in img_items], dtype='int64'),
+        }
+
+    @property
+    def id2imgname(self):
+        """image path of every im_id, looked up by the evaluator instead of shipped in samples
+        """
+        return self.index['img_paths']
 
     def __len__(self):
         return len(self.img_items)
@@ -52,11 +61,10 @@ class HierachicalCommDataset(Dataset):
         n_retry = 10
         for _ in range(n_retry):
             try:
-                img_item = self.img_items[index]
-                img_path = img_item[0]
-                pid = img_item[1]
-                camid = img_item[2]
-                im_id = img_item[3]
+                img_path = self.index['img_paths'][index]
+                pid = self.index['targets'][index]
+                camid = self.img_items[index][2]
+                im_id = self.index['im_ids'][index]
                 img = read_image(img_path)
                 ori_h, ori_w, _ = np.array(img).shape
                 if self.transform is not None: img = self.transform(img)
@@ -78,18 +86,14 @@ class HierachicalCommDataset(Dataset):
                 "camids": camid,
                 "im_shape": im_shape,
                 "scale_factor": scale_factor,
-                "img_paths": img_path,
                 "im_id": im_id,
-                "id2imgname": self.id2imgname,
             }
         else:
             return {
                 "image": img,
                 "im_shape": im_shape,
                 "scale_factor": scale_factor,
-                "img_paths": img_path,
                 "im_id": im_id,
-                "id2imgname": self.id2imgname,
             }
 
     @property
@@ -176,7 +180,7 @@ def build_vehiclemulti_train_loader_lazy(
     train_loader = paddle.io.DataLoader( #TODO make a distributed version
         dataset=train_set,
         batch_sampler=batch_sampler,
-        collate_fn=fast_batch_collator,
+        collate_fn=BufferedBatchCollator(num_workers=num_workers),
         num_workers=num_workers,
         )
 
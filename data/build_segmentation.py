@@ -21,6 +21,8 @@ from utils import comm
 import numpy as np
 from fastreid.data import samplers
 from fastreid.data.datasets import DATASET_REGISTRY
+from data.build import BufferedBatchCollator
+from data.samplers.iteration_sampler import IterationBatchSampler
 from data.datasets.cityscapes_datasets import *
 from data.datasets.bdd100k_datasets import *
 
@@ -37,9 +39,11 @@ def build_segmentation_dataset(dataset_name=None, transforms=[], dataset_root=No
 
 
 def build_segmentation_trainloader(data_set, is_train=True, total_batch_size=0, \
-        worker_num=0, drop_last=True,sample_weight = False,**kwargs):
+        worker_num=0, drop_last=True,sample_weight = False, use_shared_memory=True, **kwargs):
     """ 
     Build a dataloader for Cityscapse segmentation.
+    Batches are collated into reused buffers (see `BufferedBatchCollator`) and, with
+    `use_shared_memory`, copied by paddle into shared memory instead of being pickled.
     Returns:
         paddle.io.DataLoader: a dataloader.
     """
@@ -49,7 +53,11 @@ def build_segmentation_trainloader(data_set, is_train=True, total_batch_size=0,
     if is_train:
         # 无限流
         sampler = samplers.TrainingSampler(data_set)  #首先创建的是无限流
-        batch_sampler = paddle.io.BatchSampler(sampler=sampler, batch_size=mini_batch_size)  
+        if hasattr(data_set, 'set_start_iter'):
+            # 每个样本带上其所在batch的序号, 数据集据此得到训练iter
+            batch_sampler = IterationBatchSampler(sampler=sampler, batch_size=mini_batch_size)
+        else:
+            batch_sampler = paddle.io.BatchSampler(sampler=sampler, batch_size=mini_batch_size)
         worker_init_fn = np.random.seed(random.randint(0, 100000))   
     else:
         # 有序分布流
@@ -64,6 +72,8 @@ def build_segmentation_trainloader(data_set, is_train=True, total_batch_size=0,
         batch_sampler=batch_sampler,
         num_workers=worker_num,
         return_list=True,
+        collate_fn=BufferedBatchCollator(num_workers=worker_num, use_shared_memory=use_shared_memory),
+        use_shared_memory=use_shared_memory,
         worker_init_fn=worker_init_fn)
     return dataloader
 
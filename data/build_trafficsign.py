@@ -14,33 +14,12 @@ from fastreid.data.datasets import DATASET_REGISTRY
 from tools import moe_group_utils
 from data.transforms import detection_ops
 from data.transforms.detection_ops import Compose, BatchCompose
+from data.build import fast_batch_collator
 
 
 _root = os.getenv("FASTREID_DATASETS", "datasets")
 
 
-def fast_batch_collator(batched_inputs):
-    """
-    A simple batch collator for most common reid tasks.
-    There is no need of transforming data to GPU in fast_batch_collator
-    """
-    elem = batched_inputs[0]
-    if isinstance(elem, np.ndarray):
-        # return paddle.to_tensor(np.concatenate([ np.expand_dims(elem, axis=0) for elem in batched_inputs], axis=0))
-        return np.concatenate([np.expand_dims(elem, axis=0) for elem in batched_inputs], axis=0)
-
-    elif isinstance(elem, Mapping):
-        return {key: fast_batch_collator([d[key] for d in batched_inputs]) for key in elem}
-    elif isinstance(elem, float):
-        # return paddle.to_tensor(batched_inputs, dtype=paddle.float64)
-        return np.array(batched_inputs, dtype=np.float64) 
-    elif isinstance(elem, int):
-        #return paddle.to_tensor(batched_inputs)
-        return np.array(batched_inputs) 
-    elif isinstance(elem, str):
-        return batched_inputs
-
-
 def build_cocodet_test_loader_lazy(data_set, total_batch_size=0, num_workers=0, is_train=False,
         batch_transforms=[], shuffle=True, drop_last=True, collate_batch=True):
     """
@@ -14,6 +14,7 @@
 
 import os
 import glob
+import multiprocessing
 
 from data.datasets.seg_dataset import Dataset
 from paddleseg.cvlibs import manager
@@ -33,6 +34,10 @@ class BDD100K(Dataset):
         dataset_root (str): Cityscapes dataset directory.
         mode (str, optional): Which part of dataset to use. it is one of ('train', 'val', 'test'). Default: 'train'.
         edge (bool, optional): Whether to compute edge while training. Default: False
+        stop_iter (int, optional): Training iteration from which Mosaic is disabled.
+        worker_num (float, optional): Only used when indices do not come from an
+            `IterationBatchSampler`, to estimate the training iteration from the number of
+            samples seen by one worker.
     """
     NUM_CLASSES = 19
     dataset_name = 'BDD100K'
@@ -54,6 +59,8 @@ class BDD100K(Dataset):
         self.mosaic_epoch = mosaic_epoch
         self.worker_num = worker_num
         self.stop_iter = stop_iter
+        # 训练起始iter, 由trainer写入, 在所有worker进程间共享
+        self._start_iter = multiprocessing.Value('l', 0)
 
         if mode not in ['train', 'val', 'test']:
             raise ValueError(
@@ -84,7 +91,12 @@ class BDD100K(Dataset):
         ]
         
     def __getitem__(self, idx):
-        current_iter = int(self._curr_iter * self.worker_num)  #当前的iter
+        if isinstance(idx, tuple):
+            # (index, batch序号), 来自IterationBatchSampler
+            idx, step = idx
+            current_iter = self._start_iter.value + step  #当前的iter
+        else:
+            current_iter = int(self._curr_iter * self.worker_num)  #估计的当前iter
         if self.mosaic_epoch == 0 and current_iter < self.stop_iter:
             data = []
             n = len(self.file_list)
@@ -95,7 +107,7 @@ class BDD100K(Dataset):
                     index = np.random.randint(n)
                 cur_data = {}
                 cur_data['trans_info'] = []
-                cur_data['curr_iter'] = self._curr_iter
+                cur_data['curr_iter'] = current_iter
                 image_path, label_path = self.file_list[index]
                 cur_data['image'] = image_path
                 cur_data['image_path'] = image_path
@@ -110,7 +122,7 @@ class BDD100K(Dataset):
         else:
             data = {}
             data['trans_info'] = []
-            data['curr_iter'] = self._curr_iter
+            data['curr_iter'] = current_iter
             image_path, label_path = self.file_list[idx]
             data['image'] = image_path
             data['image_path'] = image_path
@@ -136,6 +148,11 @@ class BDD100K(Dataset):
     
     def set_epoch(self, epoch_id):
         self._epoch = epoch_id  
+
+    def set_start_iter(self, start_iter):
+        """set the training iteration the first batch of the sampler belongs to
+        """
+        self._start_iter.value = start_iter
         
         
 @DATASET_REGISTRY.register()
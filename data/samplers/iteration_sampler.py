@@ -0,0 +1,24 @@
+"""data/samplers/iteration_sampler.py
+"""
+import paddle
+
+
+class IterationBatchSampler(paddle.io.BatchSampler):
+    """
+    A BatchSampler that tags every index with the number of batches yielded before it,
+    i.e. it yields `[(idx, step), ...]` instead of `[idx, ...]`.
+
+    Batch indices are drawn in the main process in training order, so `step` does not
+    depend on the number of DataLoader workers or the prefetch depth. Datasets add the
+    iteration the training started from (see `BDD100K.set_start_iter`) to get the global
+    iteration of the sample, and use it for augmentation schedules. Only use it for
+    datasets implementing `set_start_iter`, which unpack the tuples.
+
+    `step` counts the batches of this loader. It equals the trainer iteration when every
+    step pulls a batch of every task (`sample_mode='batch'`); with `sample_mode='sample'`
+    it only counts the steps that trained this task, so the iteration is underestimated.
+    """
+
+    def __iter__(self):
+        for step, batch_indices in enumerate(super().__iter__()):
+            yield [(idx, step) for idx in batch_indices]
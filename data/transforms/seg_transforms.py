@@ -15,6 +15,7 @@
 import random
 import math
 import omegaconf
+from collections import OrderedDict
 
 import cv2
 import numpy as np
@@ -53,6 +54,9 @@ class Compose:
         self.to_rgb = to_rgb
         self.img_channels = img_channels
         self.read_flag = cv2.IMREAD_GRAYSCALE if img_channels == 1 else cv2.IMREAD_COLOR
+        if len(self.transforms) > 0 and isinstance(self.transforms[0], Mosaic):
+            # Mosaic解码其余3个样本时与第一个样本使用相同的read_flag/to_rgb/img_channels
+            self.transforms[0].prepare_data = self.prepare_data
     
     def prepare_data(self, data):
         if 'image' not in data.keys():
@@ -94,6 +98,9 @@ class Compose:
         # 判断是否需要mosaic
         if not isinstance(data, Sequence):
             data = self.prepare_data(data)
+        elif len(self.transforms) > 0 and isinstance(self.transforms[0], Mosaic):
+            # Mosaic decodes the other samples itself, only when it is applied
+            data[0] = self.prepare_data(data[0])
         else: #mosaic
             for i in range(len(data)):
                 data[i] = self.prepare_data(data[i])            
@@ -1234,11 +1241,99 @@ class RandomSelectAug:
 
 
 
+class DecodedImageCache:
+    """
+    LRU cache of decoded arrays with a byte budget. Every DataLoader worker holds its
+    own copy, and the hit rate is logged every `log_period` lookups.
+
+    Args:
+        max_bytes (int): The budget in bytes, least recently used entries are evicted beyond it.
+        log_period (int, optional): Lookups between two hit rate logs, 0 disables them. Default: 1000.
+    """
+
+    def __init__(self, max_bytes, log_period=1000):
+        self.max_bytes = max_bytes
+        self.log_period = log_period
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def get(self, key):
+        if self.log_period > 0 and (self.hits + self.misses + 1) % self.log_period == 0:
+            logger.info('DecodedImageCache: hit rate {:.3f} over {} lookups, {:.0f}/{:.0f} MB used'.format(
+                self.hit_rate, self.hits + self.misses, self.nbytes / 1024 ** 2, self.max_bytes / 1024 ** 2))
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items.move_to_end(key)
+        return item
+
+    def put(self, key, arrays):
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes or key in self._items:
+            return
+        self._items[key] = arrays
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.nbytes -= sum(a.nbytes for a in evicted)
+
+
 class Mosaic:
-    def __init__(self, prob=1.0, input_dim=[640, 640]):
+    """
+    Mosaic of 4 samples. Must be the first transform: `Compose` only decodes the first
+    sample and the other 3 are decoded here when the mosaic is applied, with the
+    `prepare_data` of that `Compose`.
+
+    Args:
+        prob (float, optional): The probability of applying the mosaic. Default: 1.0.
+        input_dim (list, optional): The (width, height) of one mosaic tile. Default: [640, 640].
+        cache_bytes (int, optional): Byte budget of the per-worker LRU cache of decoded images
+            and labels, stored already downscaled to the tile size. 0 disables it. Default: 0.
+            The other 3 samples are drawn at random, so the hit rate is about the cached
+            fraction of the dataset; enable it only when the logged hit rate pays for
+            cache_bytes * num_workers of host memory.
+    """
+    def __init__(self, prob=1.0, input_dim=[640, 640], cache_bytes=0):
         self.prob = prob
         self.input_dim = input_dim
+        self.cache = DecodedImageCache(cache_bytes) if cache_bytes > 0 else None
+        # 由Compose设置
+        self.prepare_data = None
         print('=================>分割马赛克')
+
+    def _resize(self, img, label):
+        input_w, input_h = self.input_dim
+        h0, w0 = img.shape[:2]
+        scale = min(1. * input_h / h0, 1. * input_w / w0)
+        size = (int(w0 * scale), int(h0 * scale))
+        if size != (w0, h0):
+            img = cv2.resize(img, size, interpolation=cv2.INTER_LINEAR)
+            label = cv2.resize(label, size, interpolation=cv2.INTER_NEAREST)
+        return img, label
+
+    def _load(self, sp):
+        """decoded image and label of a not yet decoded sample, resized to the tile size
+        """
+        assert self.prepare_data is not None, "Mosaic must be the first transform of a Compose"
+        key = sp['image']
+        item = self.cache.get(key) if self.cache is not None else None
+        if item is None:
+            sp = self.prepare_data(dict(sp))
+            img, label = self._resize(sp['image'], sp['label'])
+            # 拼接到uint8的mosaic图时同样截断, 缓存uint8不改变结果
+            item = (img.astype(np.uint8), label)
+            if self.cache is not None:
+                self.cache.put(key, item)
+        return item
     
     def get_mosaic_coords(self, mosaic_idx, xc, yc, w, h, input_h, input_w):
         # (x1, y1, x2, y2) means coords in large image,
@@ -1287,15 +1382,10 @@ class Mosaic:
         mosaic_label = np.full((input_h * 2, input_w * 2), 255, dtype=np.uint8)  # 背景是255
         
         for mosaic_idx, sp in enumerate(data):
-            img = sp['image']
-            label = sp['label']
-            h0, w0 = img.shape[:2]
-            scale = min(1. * input_h / h0, 1. * input_w / w0)
-            img = cv2.resize(
-                img, (int(w0 * scale), int(h0 * scale)),
-                interpolation=cv2.INTER_LINEAR)
-            label = cv2.resize(label, (int(w0 * scale), int(h0 * scale)),
-                interpolation=cv2.INTER_NEAREST)
+            if isinstance(sp['image'], str):
+                img, label = self._load(sp)
+            else:
+                img, label = self._resize(sp['image'], sp['label'])
             (h, w, c) = img.shape[:3]
 
             # suffix l means large image, while s means small image in mosaic aug.
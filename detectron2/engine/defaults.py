@@ -157,6 +157,22 @@ For python-based LazyConfig, use "path.key=value".
         "--flip_horizontal_cls",
         action="store_true",
     )
+    parser.add_argument(
+        "--tta_scales_det",
+        type=float,
+        nargs="+",
+        default=None,
+        help="scales of the trafficsign test-time augmentation",
+    )
+    parser.add_argument(
+        "--flip_horizontal_det",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tta_fusion_det",
+        default="wbf",
+        choices=["wbf", "nms", "soft_nms"],
+    )
     return parser
 
 
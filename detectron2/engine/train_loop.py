@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) Facebook, Inc. and its affiliates.
 
+import functools
 import logging
+import math
 import numpy as np
 import time
 import weakref
@@ -17,7 +19,8 @@ from utils import comm
 from detectron2.utils.events import EventStorage, get_event_storage
 from detectron2.utils.logger import _log_api_usage
 
-__all__ = ["HookBase", "TrainerBase", "SimpleTrainer", "AMPTrainer"]
+__all__ = ["HookBase", "TrainerBase", "MetricsAccumulator", "GradBuckets", "OverlappedGradReducer",
+           "MicroBatchPlanner", "split_batch", "SimpleTrainer", "AMPTrainer"]
 
 
 class HookBase:
@@ -218,6 +221,472 @@ class TrainerBase:
                 logger.warning(f"Cannot find the hook '{key}', its state_dict is ignored.")
 
 
+class MetricsAccumulator:
+    """
+    Accumulates the loss scalars of every step on device and reduces them across workers
+    in one packed all_reduce every `period` steps, so logging adds no collective or host
+    sync to the other steps.
+
+    All workers must add the same loss names over a period, as they must call `flush`
+    together.
+
+    The storage receives one value per period, the mean over its steps, instead of one
+    value per step: the medians of `smoothing_hint` (e.g. the 20-value window of
+    CommonMetricPrinter) then span `period` times more steps, and hooks reading the
+    latest loss see a period mean.
+    """
+
+    def __init__(self, period=20, group=None):
+        """
+        Args:
+            period (int): steps between two reductions, usually the log period of the writers.
+            group: communication group of the reduction, all workers by default.
+        """
+        self.period = max(int(period), 1)
+        self.group = group
+        self.prefix = ""
+        self._sums = {}
+        self._counts = {}
+
+    def add(self, loss_dict, prefix=""):
+        """
+        Add the losses of one step, without leaving the device.
+        """
+        self.prefix = prefix
+        with paddle.no_grad():
+            for k, v in loss_dict.items():
+                v = v.detach().astype("float32").reshape([1])
+                self._sums[k] = self._sums[k] + v if k in self._sums else v
+                self._counts[k] = self._counts.get(k, 0) + 1
+
+    def should_flush(self, iteration, max_iter):
+        return (iteration + 1) % self.period == 0 or iteration + 1 >= max_iter
+
+    def flush(self):
+        """
+        Reduce the accumulated losses among workers and reset.
+
+        Returns:
+            dict[str, float]: the mean of every loss over the period and the workers.
+        """
+        if not self._sums:
+            return {}
+        names = sorted(self._sums.keys())
+        # 所有loss打包成一个tensor, 一次all_reduce, 一次拷回host
+        packed = paddle.concat([self._sums[k] for k in names])
+        world_size = comm.get_world_size(self.group)
+        if world_size > 1:
+            paddle.distributed.all_reduce(packed, group=self.group)
+        values = packed.numpy()
+        metrics_dict = {
+            k: float(v) / (self._counts[k] * world_size) for k, v in zip(names, values)
+        }
+        self._sums = {}
+        self._counts = {}
+        return metrics_dict
+
+
+class GradBuckets:
+    """
+    Bucketed gradient all_reduce of a fixed list of parameters in one group.
+
+    Gradients are flattened into contiguous buckets of about `bucket_size_mb` (one dtype per
+    bucket). Each bucket is divided by `div_factor` and all_reduced once, then copied back into
+    the grads. This replaces one all_reduce and one divide per tensor by one of each per bucket.
+
+    The layout depends only on the parameters, so it is the same on all ranks; missing grads
+    are sent as zeros to keep the collectives matched and are not written back.
+    `num_collectives` and `num_bytes` count the collectives since the last `reset_stats`.
+    """
+
+    def __init__(self, params, group, bucket_size_mb=25, div_factor=None, reverse=True):
+        """
+        Args:
+            params: parameters whose grads are reduced, frozen ones are ignored.
+            group: communication group, a :class:`utils.comm.SimulatedGroup` for tests.
+            bucket_size_mb (float): bucket size.
+            div_factor (int): grads are divided by it, group.nranks by default.
+            reverse (bool): bucket the parameters in reverse order, roughly the order
+                backward produces their grads. False keeps the given order.
+        """
+        self.group = group
+        self.div_factor = div_factor
+        params = [p for p in params if not p.stop_gradient]
+        if reverse:
+            params = params[::-1]
+        self.buckets = []
+        bucket_bytes = bucket_size_mb * 1024 * 1024
+        open_buckets = {}
+        for p in params:
+            dtype = str(p.dtype)
+            bucket, size = open_buckets.get(dtype, ([], 0))
+            bucket.append(p)
+            size += comm.tensor_nbytes(p)
+            if size >= bucket_bytes:
+                self.buckets.append(bucket)
+                bucket, size = [], 0
+            open_buckets[dtype] = (bucket, size)
+        self.buckets.extend(bucket for bucket, _ in open_buckets.values() if bucket)
+        self._pending = []
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_collectives = 0
+        self.num_bytes = 0
+
+    @property
+    def active(self):
+        return self.group is not None and self.group.nranks > 1 or \
+            self.group is None and comm.get_world_size() > 1
+
+    def reduce(self, comm_flag=True):
+        """
+        Reduce all buckets and wait for them.
+
+        Args:
+            comm_flag (bool): False only divides the grads, without communication.
+        """
+        self.reset_stats()
+        if not self.active:
+            return
+        for index in range(len(self.buckets)):
+            self.launch(index, comm_flag)
+        self.wait()
+
+    def launch(self, index, comm_flag=True):
+        """
+        Flatten and divide the grads of a bucket and start its all_reduce, which runs
+        concurrently with the following kernels until `wait`.
+        """
+        bucket = self.buckets[index]
+        grads = [p.grad for p in bucket]
+        if not comm_flag and all(g is None for g in grads):
+            return
+        div_factor = comm.get_world_size(self.group) if self.div_factor is None else self.div_factor
+        with paddle.no_grad():
+            flat = paddle.concat([
+                g.flatten() if g is not None else paddle.zeros([int(np.prod(p.shape))], dtype=p.dtype)
+                for p, g in zip(bucket, grads)])
+            # 先除再求和, 除法与通信都是每个bucket一次
+            flat = flat.scale(1.0 / div_factor)
+        work = None
+        if comm_flag:
+            work = comm.all_reduce_async(flat, group=self.group)
+            self.num_collectives += 1
+            self.num_bytes += comm.tensor_nbytes(flat)
+        self._pending.append((index, grads, flat, work))
+
+    def wait(self, skip=()):
+        """
+        Wait for the launched buckets and copy them back into the grads, except for the
+        buckets in `skip` whose grads are left as they are.
+        """
+        with paddle.no_grad():
+            for index, grads, flat, work in self._pending:
+                if work is not None:
+                    work.wait()
+                if index in skip:
+                    continue
+                offset = 0
+                for p, g in zip(self.buckets[index], grads):
+                    numel = int(np.prod(p.shape))
+                    if g is not None:
+                        paddle.assign(flat[offset:offset + numel].reshape(g.shape), output=g)
+                        p._reset_grad_inplace_version(True)
+                    offset += numel
+        self._pending = []
+
+
+class OverlappedGradReducer:
+    """
+    Reduces the grads of a multi-task step bucket by bucket while the backward of the step
+    is still running, instead of all at once after the last task.
+
+    A grad is final after the backward of the last task of the step that uses the parameter:
+    the head of a task is final right after its own backward, the backbone only during the
+    backward of the last task. Which task uses which parameter is recorded by grad hooks;
+    the first step only records it and reduces at the end. The buckets are then laid out in
+    the order the grads become final, and a hook launches every bucket whose grads are all
+    final. The usage recorded by all ranks is merged before the layout is built, and buckets
+    are always launched in index order, so all ranks issue the same sequence of collectives.
+
+    If a parameter gets a grad after its bucket was launched (a task started using it), the
+    ranks agree on the affected buckets with one small all_reduce at the end of every step,
+    reduce them again from the complete grads and rebuild the layout with the new usage.
+
+    Usage per step: `begin_step(tasks)`, `begin_task(task, final)` before every backward
+    (final: last micro-batch of the task), `finish_step()` before the optimizer step.
+    """
+
+    def __init__(self, model, group=None, bucket_size_mb=25):
+        """
+        Args:
+            model: the model whose trainable parameters are reduced.
+            group: communication group, all workers by default, or a
+                :class:`utils.comm.SimulatedGroup` for tests.
+            bucket_size_mb (float): bucket size.
+        """
+        self.params = [p for p in model.parameters() if not p.stop_gradient]
+        self.group = group
+        self.bucket_size_mb = bucket_size_mb
+        self.buckets = None
+        self.task_params = {}
+        self.num_overlapped = 0
+        self._task = None
+        for i, p in enumerate(self.params):
+            p._register_backward_hook(functools.partial(self._on_grad_ready, i))
+
+    def begin_step(self, tasks):
+        self._tasks = list(tasks)
+        self._task = None
+        self._task_idx = -1
+        self._late = set()
+        self.num_overlapped = 0
+        if self.buckets is None:
+            return
+        self.buckets.reset_stats()
+        self._last_task = self._last_tasks(self._tasks)
+        # 每个bucket还没有得到最终梯度的参数个数
+        self._remaining = [
+            sum(int(self._last_task[i] >= 0) for i in indices) for indices in self._bucket_indices]
+        self._next_launch = 0
+        self._launch_ready()
+
+    def begin_task(self, task, final=True):
+        if task != self._task:
+            self._task_idx += 1
+        self._task = task
+        self._final = final
+
+    def finish_step(self):
+        """launch the remaining buckets, wait for all of them and write the grads back"""
+        if self.buckets is None:
+            self._build_buckets()
+            self.buckets.reduce()
+        else:
+            self.num_overlapped = self._next_launch
+            for index in range(self._next_launch, len(self.buckets.buckets)):
+                self.buckets.launch(index)
+            self._next_launch = len(self.buckets.buckets)
+            late = self._agree_late_buckets()
+            # 过早归约的bucket不写回, 梯度仍是本rank完整的梯度
+            self.buckets.wait(skip=late)
+            if late:
+                num_collectives, num_bytes = self.buckets.num_collectives, self.buckets.num_bytes
+                for index in late:
+                    self.buckets.launch(index)
+                self.buckets.wait()
+                num_collectives += self.buckets.num_collectives
+                num_bytes += self.buckets.num_bytes
+                logging.getLogger(__name__).warning(
+                    "{} grad buckets were reduced before all their grads were ready, the parameters "
+                    "used by a task changed. Reduced them again and rebuilt the buckets.".format(len(late)))
+                self._build_buckets()
+                # 本步的通信量记在新的buckets上
+                self.buckets.num_collectives, self.buckets.num_bytes = num_collectives, num_bytes
+        self._task = None
+
+    def _agree_late_buckets(self):
+        """indices of the buckets launched too early on any rank"""
+        flags = np.zeros(len(self.buckets.buckets), dtype=np.float32)
+        flags[list(self._late)] = 1
+        flags = paddle.to_tensor(flags)
+        comm.all_reduce_async(flags, group=self.group).wait()
+        return set(int(b) for b in np.nonzero(flags.numpy())[0])
+
+    def _agree_task_params(self):
+        """
+        Merge the recorded usage of all ranks: a rank may skip a branch (empty ground truth,
+        routing), and the layout must be the same on every rank. Tasks follow rank 0's order.
+        """
+        gathered = comm.all_gather_object(
+            (self._tasks, {task: sorted(used) for task, used in self.task_params.items()}), self.group)
+        task_params = {}
+        for _, used in gathered:
+            for task, indices in used.items():
+                task_params.setdefault(task, set()).update(indices)
+        self.task_params = task_params
+        return gathered[0][0]
+
+    def _last_tasks(self, tasks):
+        """index of the last task using every parameter in this step, -1 if none"""
+        last = np.full(len(self.params), -1, dtype=np.int64)
+        for t, task in enumerate(tasks):
+            used = self.task_params.get(task)
+            if used is None:
+                # 没见过的task按使用全部参数处理
+                last[:] = t
+            else:
+                last[list(used)] = t
+        return last
+
+    def _build_buckets(self):
+        tasks = self._agree_task_params()
+        last = self._last_tasks(tasks)
+        last[last < 0] = len(tasks)
+        # 先得到最终梯度的参数排在前面, 同一task内按反向的顺序
+        order = sorted(range(len(self.params)), key=lambda i: (last[i], -i))
+        self.buckets = GradBuckets([self.params[i] for i in order], self.group,
+                                   self.bucket_size_mb, reverse=False)
+        index_of = {id(p): i for i, p in enumerate(self.params)}
+        self._bucket_indices = [[index_of[id(p)] for p in bucket] for bucket in self.buckets.buckets]
+        self._bucket_of = np.zeros(len(self.params), dtype=np.int64)
+        for b, indices in enumerate(self._bucket_indices):
+            self._bucket_of[indices] = b
+
+    def _on_grad_ready(self, i):
+        """called after the grad of parameter i was accumulated"""
+        if self._task is None:
+            return
+        self.task_params.setdefault(self._task, set()).add(i)
+        if self.buckets is None:
+            return
+        b = self._bucket_of[i]
+        if self._task_idx > self._last_task[i]:
+            if b < self._next_launch:
+                # bucket已经发出, 在finish_step中重新归约
+                self._late.add(b)
+            return
+        if self._task_idx < self._last_task[i] or not self._final:
+            # 后面的task或micro-batch还会累加这个梯度
+            return
+        self._remaining[b] -= 1
+        self._launch_ready()
+
+    def _launch_ready(self):
+        while self._next_launch < len(self._remaining) and self._remaining[self._next_launch] <= 0:
+            self.buckets.launch(self._next_launch)
+            self._next_launch += 1
+
+
+# BatchCompose(collate_batch=False)不堆叠这些字段, 保留逐样本的列表
+_PER_SAMPLE_KEYS = ('gt_', 'is_crowd', 'difficult')
+
+
+def _is_per_sample_list(batch, key):
+    """
+    Lists the collators leave per sample: strings passed through by `fast_batch_collator`
+    and the ground truth fields of `BatchCompose(collate_batch=False)`. Other lists are
+    collated fields (tuple elements) or plain values.
+    """
+    if len(batch) > 0 and all(isinstance(v, str) for v in batch):
+        return True
+    return any(k in key for k in _PER_SAMPLE_KEYS)
+
+
+def _batch_size(batch, key=''):
+    """number of samples of a collated batch, None if it has no per-sample field"""
+    if isinstance(batch, (np.ndarray, paddle.Tensor)):
+        return batch.shape[0] if len(batch.shape) > 0 else None
+    if isinstance(batch, Mapping):
+        items = batch.items()
+    elif isinstance(batch, (list, tuple)):
+        if _is_per_sample_list(batch, key):
+            return len(batch)
+        items = ((key, v) for v in batch)
+    else:
+        return None
+    for k, v in items:
+        size = _batch_size(v, k)
+        if size is not None:
+            return size
+    return None
+
+
+def _slice_batch(batch, start, end, batch_size, key=''):
+    if isinstance(batch, (np.ndarray, paddle.Tensor)):
+        return batch[start:end] if len(batch.shape) > 0 and batch.shape[0] == batch_size else batch
+    if isinstance(batch, Mapping):
+        return {k: _slice_batch(v, start, end, batch_size, k) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        if _is_per_sample_list(batch, key):
+            return batch[start:end] if len(batch) == batch_size else batch
+        return type(batch)(_slice_batch(v, start, end, batch_size, key) for v in batch)
+    return batch
+
+
+def split_batch(batch, num_splits):
+    """
+    Split a collated task batch into `num_splits` micro-batches along the sample dimension.
+    Arrays and tensors whose first dimension is the batch size are sliced, so are the lists
+    the collators keep per sample (strings, ground truth of detection batches). Other lists
+    are walked into, anything else is shared by all micro-batches.
+
+    Returns:
+        list[(micro_batch, fraction of the samples)]
+    """
+    batch_size = _batch_size(batch)
+    if batch_size is None or num_splits <= 1:
+        return [(batch, 1.0)]
+    bounds = np.linspace(0, batch_size, min(num_splits, batch_size) + 1).round().astype(int)
+    return [(_slice_batch(batch, start, end, batch_size), (end - start) / batch_size)
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+class MicroBatchPlanner:
+    """
+    Chooses the number K of micro-batches every task batch is split into for gradient
+    accumulation: a fixed K per task, or the smallest K whose micro-batch fits a memory
+    budget. The memory of one sample is given per task or, on GPU, measured as the peak
+    memory of the forward/backward of the micro-batches (the largest value seen is kept).
+    A task is trained one sample per micro-batch until it was measured.
+    """
+
+    def __init__(self, num_micro_batches=None, memory_budget_mb=None, sample_memory_mb=None):
+        """
+        Args:
+            num_micro_batches (dict[str, int]): fixed K of some tasks.
+            memory_budget_mb (float): memory a micro-batch may use for its forward/backward,
+                on top of the model, grads and optimizer states.
+            sample_memory_mb (dict[str, float]): memory of one sample of some tasks, e.g. from a
+                previous run; measured for the others.
+        """
+        self.num_micro_batches = dict(num_micro_batches or {})
+        self.memory_budget_mb = memory_budget_mb
+        self.sample_memory_mb = dict(sample_memory_mb or {})
+        self.measure = memory_budget_mb is not None and paddle.is_compiled_with_cuda() \
+            and hasattr(paddle.device.cuda, "reset_max_memory_allocated")
+        if memory_budget_mb is not None and not self.measure:
+            logging.getLogger(__name__).warning(
+                "Cannot measure the GPU memory of this paddle/device, memory_budget_mb={} only "
+                "applies to the tasks in sample_memory_mb {}.".format(
+                    memory_budget_mb, sorted(self.sample_memory_mb)))
+        self._warned = set()
+
+    def plan(self, task, batch_size):
+        """K of a task batch of `batch_size` samples"""
+        if task in self.num_micro_batches:
+            k = self.num_micro_batches[task]
+        elif self.memory_budget_mb is None:
+            k = 1
+        elif task in self.sample_memory_mb:
+            k = math.ceil(batch_size * self.sample_memory_mb[task] / self.memory_budget_mb)
+        elif self.measure:
+            # 还没有测量过, 先用最小的micro-batch测量
+            k = batch_size
+        else:
+            if task not in self._warned:
+                self._warned.add(task)
+                logging.getLogger(__name__).warning(
+                    "No sample_memory_mb for task {}, it is trained without micro-batches.".format(task))
+            k = 1
+        return int(min(max(k, 1), batch_size))
+
+    def begin_micro_batch(self):
+        if self.measure:
+            paddle.device.cuda.reset_max_memory_allocated()
+            self._base_memory = paddle.device.cuda.memory_allocated()
+
+    def end_micro_batch(self, task, micro_batch_size):
+        """record the peak memory of the forward/backward of a micro-batch"""
+        if not self.measure or task in self.num_micro_batches or micro_batch_size == 0:
+            return
+        # 第一次backward分配的梯度会一直保留, 不算作这个micro-batch的显存
+        persistent = max(paddle.device.cuda.memory_allocated() - self._base_memory, 0)
+        used_mb = (paddle.device.cuda.max_memory_allocated() - self._base_memory - persistent) / 1024 ** 2
+        self.sample_memory_mb[task] = max(self.sample_memory_mb.get(task, 0), used_mb / micro_batch_size)
+
+
 class SimpleTrainer(TrainerBase):
     """
     A simple trainer for the most common type of task:
@@ -237,13 +706,23 @@ class SimpleTrainer(TrainerBase):
     or write your own training loop.
     """
 
-    def __init__(self, model, data_loader, optimizer):
+    def __init__(self, model, data_loader, optimizer, metrics_period=20,
+                 overlap_grad_reduce=False, bucket_size_mb=25, grad_group=None, micro_batch=None):
         """
         Args:
             model: a torch Module. Takes a data from data_loader and returns a
                 dict of losses.
             data_loader: an iterable. Contains data to be used to call model.
             optimizer: a torch optimizer.
+            metrics_period (int): losses are reduced among workers and written to the
+                storage every `metrics_period` steps, see :class:`MetricsAccumulator`.
+            overlap_grad_reduce (bool): reduce the grads in buckets during the backward of the
+                tasks instead of after the last one, see :class:`OverlappedGradReducer`.
+            bucket_size_mb (float): bucket size of overlap_grad_reduce.
+            grad_group: communication group of overlap_grad_reduce, all workers by default.
+            micro_batch (dict): kwargs of a :class:`MicroBatchPlanner`. Every task batch is then
+                split into micro-batches whose grads are accumulated before the single
+                optimizer step, see :meth:`_forward_backward`.
         """
         super().__init__()
 
@@ -261,6 +740,11 @@ class SimpleTrainer(TrainerBase):
         self.optimizer = optimizer
         self.grad_scaler = None
         self.data = None
+        self._metrics = MetricsAccumulator(metrics_period)
+        self._grad_reducer = None
+        if overlap_grad_reduce and comm.get_world_size(grad_group) > 1:
+            self._grad_reducer = OverlappedGradReducer(model, grad_group, bucket_size_mb)
+        self._micro_batch = MicroBatchPlanner(**micro_batch) if micro_batch else None
 
     def run_step(self):
         """
@@ -278,6 +762,7 @@ class SimpleTrainer(TrainerBase):
         #     data = self.data
         data = next(self._data_loader_iter)
         data_time = time.perf_counter() - start
+        self._write_data_stats()
 
         """
         If you want to do something with the losses, you can wrap the model.
@@ -300,18 +785,22 @@ class SimpleTrainer(TrainerBase):
         # fused_allreduce_gradients(list(self.model.parameters()), None)
         loss_dict = {}
         self.optimizer.clear_grad()
+        self._begin_grad_reduce(data.keys())
         with self.model.no_sync():  #多gpu条件下
             for task_name, val in data.items():
-                task_loss_dict = self.model({task_name: val}, self.iter) #self.teacher)
-                losses = sum(task_loss_dict.values())
-                losses.backward()
+                task_start = time.perf_counter()
+                task_loss_dict, _ = self._forward_backward(
+                    task_name, val,
+                    lambda batch: self.model({task_name: batch}, self.iter), #self.teacher)
+                    lambda losses: losses.backward())
                 loss_dict.update(task_loss_dict)
+                self._report_task_cost(task_name, task_start)
         # for task_name, val in data.items():  #单独gpu
         #     task_loss_dict = self.model({task_name: val}, self.iter) #self.teacher)
         #     losses = sum(task_loss_dict.values())
         #     losses.backward() 
         #     loss_dict.update(task_loss_dict)
-        fused_allreduce_gradients(list(self.model.parameters()), None)  #单机训练可以注释掉
+        self._finish_grad_reduce()
 
         self._write_metrics(loss_dict, data_time)
         """
@@ -321,13 +810,116 @@ class SimpleTrainer(TrainerBase):
         """
         self.optimizer.step()
 
+    def _begin_grad_reduce(self, tasks):
+        if self._grad_reducer is not None:
+            self._grad_reducer.begin_step(tasks)
+
+    def _begin_task_backward(self, task_name, final=True):
+        if self._grad_reducer is not None:
+            self._grad_reducer.begin_task(task_name, final)
+
+    def _forward_backward(self, task_name, val, forward, backward):
+        """
+        Forward and backward of one task batch, micro-batch by micro-batch if `micro_batch` is
+        set. The loss of a micro-batch is weighted by its share of the samples, so the
+        accumulated grads are those of the whole batch for losses averaged over the samples;
+        losses normalized by e.g. the number of boxes of the batch and BatchNorm statistics
+        only match approximately.
+
+        Args:
+            forward: micro-batch -> dict of losses.
+            backward: total loss -> None, or the scaled loss under AMP.
+
+        Returns:
+            (dict, object): the losses of the whole batch and what the last `backward` returned.
+        """
+        if self._micro_batch is None:
+            self._begin_task_backward(task_name)
+            task_loss_dict = forward(val)
+            return task_loss_dict, backward(sum(task_loss_dict.values()))
+
+        planner = self._micro_batch
+        batch_size = _batch_size(val)
+        micro_batches = split_batch(val, planner.plan(task_name, batch_size or 1))
+        task_loss_dict = {}
+        for j, (micro, weight) in enumerate(micro_batches):
+            # 只有最后一个micro-batch得到的才是最终梯度
+            self._begin_task_backward(task_name, final=j == len(micro_batches) - 1)
+            planner.begin_micro_batch()
+            micro_loss_dict = forward(micro)
+            losses = sum(micro_loss_dict.values())
+            out = backward(losses * weight if weight != 1 else losses)
+            if batch_size is not None:
+                planner.end_micro_batch(task_name, _batch_size(micro))
+            for k, v in micro_loss_dict.items():
+                v = v.detach() * weight
+                task_loss_dict[k] = task_loss_dict[k] + v if k in task_loss_dict else v
+        if comm.is_main_process():
+            self.storage.put_scalar("micro_batches/{}".format(task_name), len(micro_batches),
+                                    smoothing_hint=False)
+        return task_loss_dict, out
+
+    def _finish_grad_reduce(self):
+        """
+        Make the grads of all workers equal before the optimizer step.
+        """
+        if self._grad_reducer is None:
+            fused_allreduce_gradients(list(self.model.parameters()), None)  #单机训练可以注释掉
+            return
+        self._grad_reducer.finish_step()
+        if comm.is_main_process():
+            buckets = self._grad_reducer.buckets
+            self.storage.put_scalars(
+                **{"comm/buckets": len(buckets.buckets),
+                   "comm/overlapped_buckets": self._grad_reducer.num_overlapped,
+                   "comm/grad_mb": buckets.num_bytes / 1024 ** 2},
+                smoothing_hint=False)
+
+    def _write_data_stats(self):
+        """
+        Log per-task prefetch queue depth, wait time and worker memory, if the data loader
+        exposes them (see :class:`data.build.MultiTaskDataLoader`), to find the task
+        starving the step.
+        """
+        if not hasattr(self.data_loader, "prefetch_stats") or not comm.is_main_process():
+            return
+        self.storage.put_scalars(**self.data_loader.prefetch_stats())
+        self.storage.put_scalars(**self.data_loader.worker_stats(), smoothing_hint=False)
+
+    def _report_task_cost(self, task_name, start):
+        """
+        Report the forward/backward time of one task to the data loader, used by
+        cost-based task sampling (see :class:`data.build.TaskSampler`).
+        """
+        if not getattr(self.data_loader, "track_task_cost", False):
+            return
+        if paddle.is_compiled_with_cuda():
+            # kernels are asynchronous, wait for them to get the real cost
+            paddle.device.cuda.synchronize()
+        self.data_loader.update_task_cost(task_name, time.perf_counter() - start)
+
     def _write_metrics(
         self,
         loss_dict,
         data_time,
         prefix="",
     ):
-        SimpleTrainer.write_metrics(loss_dict, data_time, prefix)
+        """
+        Accumulate the losses on device and write them every `metrics_period` steps.
+        Unlike :meth:`write_metrics`, only the flushing steps communicate.
+
+        The losses are written as one mean per period (see :class:`MetricsAccumulator`),
+        data_time is still written every step so its logs and hooks are unchanged.
+        """
+        self._metrics.add(loss_dict, prefix)
+        if comm.is_main_process():
+            # data_time is already on host
+            self.storage.put_scalar("data_time", data_time)
+        if not self._metrics.should_flush(self.iter, self.max_iter):
+            return
+        metrics_dict = self._metrics.flush()
+        if comm.is_main_process():
+            self._put_losses(metrics_dict, self._metrics.prefix)
 
     @staticmethod
     def write_metrics(
@@ -336,45 +928,34 @@ class SimpleTrainer(TrainerBase):
         prefix="",
     ):
         """
+        Reduce and write the losses of a single step, for callers that don't accumulate them.
+        All losses go in one packed all_reduce, see :class:`MetricsAccumulator`.
+
         Args:
             loss_dict (dict): dict of scalar losses
             data_time (float): time taken by the dataloader iteration
             prefix (str): prefix for logging keys
         """
-        # metrics_dict = {k: v.detach().cpu().item() for k, v in loss_dict.items()}
-        
-
-        # Gather metrics among all workers for logging
-        # This assumes we do DDP-style training, which is currently the only
-        # supported method in detectron2.
-
-        metrics_dict = {}
-        for k, v in loss_dict.items():
-            v_list = comm.gather_v(v)
-            metrics_dict[k] = np.mean([v.detach().cpu().numpy() for v in v_list])
-        # metrics_dict["data_time"] = data_time
+        metrics = MetricsAccumulator(period=1)
+        metrics.add(loss_dict, prefix)
+        metrics_dict = metrics.flush()
         if comm.is_main_process():
-            storage = get_event_storage()
-
-            # data_time among workers can have high variance. The actual latency
-            # caused by data_time is the maximum among workers.
-            # data_time = metrics_dict["data_time"]
-            storage.put_scalar("data_time", data_time)
-
-            # average the rest metrics
-            # metrics_dict = {
-            #     k: np.mean([x[k].detach().cpu().numpy() for x in all_metrics_dict]) for k in all_metrics_dict[0].keys()
-            # }
-            total_losses_reduced = sum(metrics_dict.values())
-            if not np.isfinite(total_losses_reduced):
-                raise FloatingPointError(
-                    "Loss became infinite or NaN at iteration={storage.iter}!\n"
-                    "loss_dict = {metrics_dict}"
-                )
-
-            storage.put_scalar("{}total_loss".format(prefix), total_losses_reduced)
-            if len(metrics_dict) > 1:
-                storage.put_scalars(**metrics_dict)
+            get_event_storage().put_scalar("data_time", data_time)
+            SimpleTrainer._put_losses(metrics_dict, prefix)
+
+    @staticmethod
+    def _put_losses(metrics_dict, prefix=""):
+        storage = get_event_storage()
+        total_losses_reduced = sum(metrics_dict.values())
+        if not np.isfinite(total_losses_reduced):
+            raise FloatingPointError(
+                "Loss became infinite or NaN at iteration={}!\n"
+                "loss_dict = {}".format(storage.iter, metrics_dict)
+            )
+
+        storage.put_scalar("{}total_loss".format(prefix), total_losses_reduced)
+        if len(metrics_dict) > 1:
+            storage.put_scalars(**metrics_dict)
 
     def state_dict(self):
         ret = super().state_dict()
@@ -396,10 +977,12 @@ class AMPTrainer(SimpleTrainer):
     in the training loop.
     """
 
-    def __init__(self, model, data_loader, optimizer, grad_scaler=None):
+    def __init__(self, model, data_loader, optimizer, grad_scaler=None, metrics_period=20,
+                 overlap_grad_reduce=False, bucket_size_mb=25, grad_group=None, micro_batch=None):
         """
         Args:
-            model, data_loader, optimizer: same as in :class:`SimpleTrainer`.
+            model, data_loader, optimizer, metrics_period, overlap_grad_reduce,
+            bucket_size_mb, grad_group, micro_batch: same as in :class:`SimpleTrainer`.
             grad_scaler: torch GradScaler to automatically scale gradients.
         """
         unsupported = "AMPTrainer does not support single-process multi-device training!"
@@ -407,7 +990,9 @@ class AMPTrainer(SimpleTrainer):
         #     assert not (model.device_ids and len(model.device_ids) > 1), unsupported
         # assert not isinstance(model, DataParallel), unsupported
 
-        super().__init__(model, data_loader, optimizer)
+        super().__init__(model, data_loader, optimizer, metrics_period=metrics_period,
+                         overlap_grad_reduce=overlap_grad_reduce, bucket_size_mb=bucket_size_mb,
+                         grad_group=grad_group, micro_batch=micro_batch)
 
         if grad_scaler is None:
             grad_scaler = paddle.amp.GradScaler(init_loss_scaling=1024.0)
@@ -421,6 +1006,7 @@ class AMPTrainer(SimpleTrainer):
         start = time.perf_counter()
         data = next(self._data_loader_iter)
         data_time = time.perf_counter() - start
+        self._write_data_stats()
         # with paddle.amp.auto_cast():
         #     loss_dict = self.model(data) #self.teacher)
         #     if isinstance(loss_dict, paddle.Tensor):
@@ -457,17 +1043,25 @@ class AMPTrainer(SimpleTrainer):
         loss_dict = {}
         with paddle.amp.auto_cast():
             self.optimizer.clear_grad()
+            self._begin_grad_reduce(data.keys())
             with self.model.no_sync():
                 for task_name, val in data.items():
-                    task_loss_dict = self.model({task_name: val}) #self.teacher)
-                    losses = sum(task_loss_dict.values())       
-                    scaled = self.grad_scaler.scale(losses)
-                    scaled.backward()
+                    task_start = time.perf_counter()
+                    task_loss_dict, scaled = self._forward_backward(
+                        task_name, val,
+                        lambda batch: self.model({task_name: batch}), #self.teacher)
+                        self._scaled_backward)
                     loss_dict.update(task_loss_dict)
-            fused_allreduce_gradients(list(self.model.parameters()), None)
+                    self._report_task_cost(task_name, task_start)
+            self._finish_grad_reduce()
             self.grad_scaler.minimize(self.optimizer, scaled)
         self._write_metrics(loss_dict, data_time)
 
+    def _scaled_backward(self, losses):
+        scaled = self.grad_scaler.scale(losses)
+        scaled.backward()
+        return scaled
+
     def state_dict(self):
         ret = super().state_dict()
         ret["grad_scaler"] = self.grad_scaler.state_dict()
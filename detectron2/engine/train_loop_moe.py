@@ -15,9 +15,9 @@ from utils import comm
 # import fastreid.engine
 from detectron2.utils.events import EventStorage, get_event_storage
 from detectron2.utils.logger import _log_api_usage
-from .train_loop import HookBase, TrainerBase
+from .train_loop import HookBase, TrainerBase, GradBuckets
 
-__all__ = ["SimpleTrainer"]
+__all__ = ["SimpleTrainer", "GradBuckets"]
 
 
 def all_reduce_parameters(params, group, monitor=None, comm_flag=True):
@@ -61,13 +61,15 @@ class SimpleTrainer(TrainerBase):
     or write your own training loop.
     """
 
-    def __init__(self, model, data_loader, optimizer, monitor=None):
+    def __init__(self, model, data_loader, optimizer, monitor=None, bucket_size_mb=25):
         """
         Args:
             model: 
             data_loader: an iterable. Contains data to be used to call model.
             optimizer: optimizer.
             dp_group: data parallel group.
+            bucket_size_mb (float): size of the gradient buckets of the all_reduce, see
+                :class:`GradBuckets`. None all_reduces every gradient separately.
         """
         super().__init__()
 
@@ -94,6 +96,17 @@ class SimpleTrainer(TrainerBase):
             model)
         self.initial_param()
 
+        self.bucket_size_mb = bucket_size_mb
+        if bucket_size_mb is not None:
+            div_factor = self.moe_group.nranks
+            self.grad_buckets = {
+                "other": GradBuckets(self.other_param, self.moe_group, bucket_size_mb, div_factor),
+                # 没有sub_group时专家参数只做除法
+                "expert": GradBuckets(self.specific_expert_param, self.moe_group if self.sub_group is None
+                                      else self.sub_group, bucket_size_mb, div_factor),
+                "dp": GradBuckets(self.model.parameters(), self.dp_group, bucket_size_mb),
+            }
+
 
     def initial_param(self):
         # NOTE: other_param is shared in data parallel, they should be same in all dp ranks.
@@ -173,16 +186,19 @@ class SimpleTrainer(TrainerBase):
         else:
             losses = sum(loss_dict.values())
         losses.backward()
-        # NOTE: shared param should be all_reduced in task MOE.
-        all_reduce_parameters(self.other_param, self.moe_group, monitor=self.monitor)
-        
-        if self.sub_group is None:
-            all_reduce_parameters(self.specific_expert_param, self.moe_group, monitor=self.monitor, comm_flag=False)
+        if self.bucket_size_mb is not None:
+            self.reduce_grad_buckets()
         else:
-            all_reduce_parameters(self.specific_expert_param, self.sub_group, monitor=self.monitor)
+            # NOTE: shared param should be all_reduced in task MOE.
+            all_reduce_parameters(self.other_param, self.moe_group, monitor=self.monitor)
 
-        #Note all_redcue in outsize dp.
-        all_reduce_parameters(self.model.parameters(), self.dp_group)
+            if self.sub_group is None:
+                all_reduce_parameters(self.specific_expert_param, self.moe_group, monitor=self.monitor, comm_flag=False)
+            else:
+                all_reduce_parameters(self.specific_expert_param, self.sub_group, monitor=self.monitor)
+
+            #Note all_redcue in outsize dp.
+            all_reduce_parameters(self.model.parameters(), self.dp_group)
 
         self._write_metrics(loss_dict, data_time)
 
@@ -193,6 +209,24 @@ class SimpleTrainer(TrainerBase):
         """
         self.optimizer.step()
 
+    def reduce_grad_buckets(self):
+        """
+        Same reduction as the per-tensor `all_reduce_parameters` calls, with one collective
+        per bucket. The number of collectives and MB sent per group are put in the storage.
+        """
+        # NOTE: shared param should be all_reduced in task MOE.
+        self.grad_buckets["other"].reduce()
+        self.grad_buckets["expert"].reduce(comm_flag=self.sub_group is not None)
+        #Note all_redcue in outsize dp.
+        self.grad_buckets["dp"].reduce()
+
+        if comm.is_main_process():
+            for name, buckets in self.grad_buckets.items():
+                self.storage.put_scalar("comm/{}_collectives".format(name), buckets.num_collectives,
+                                        smoothing_hint=False)
+                self.storage.put_scalar("comm/{}_mb".format(name), buckets.num_bytes / 1024 ** 2,
+                                        smoothing_hint=False)
+
     def _write_metrics(
             self,
             loss_dict,
@@ -5,7 +5,11 @@ import numpy as np
 import time
 from pycocotools.cocoeval import COCOeval
 
-from detectron2 import _C
+try:
+    from detectron2 import _C
+except ImportError:
+    # only COCOeval_opt needs the compiled ops
+    _C = None
 
 logger = logging.getLogger(__name__)
 
@@ -119,3 +123,90 @@ class COCOeval_opt(COCOeval):
         self.eval["scores"] = np.array(self.eval["scores"]).reshape(self.eval["counts"])
         toc = time.time()
         logger.info("COCOeval_opt.accumulate() finished in {:0.2f} seconds.".format(toc - tic))
+
+
+class COCOeval_sharded(COCOeval):
+    """
+    COCOeval whose per image evaluation (the evaluateImg stage) is split across processes.
+    Every process runs `evaluate_shard()` on the images it has detections for and returns
+    compact match tables; one process merges them with `merge_shards()`, which evaluates the
+    remaining images (ground truth only) and leaves the object ready for `accumulate()`.
+    """
+
+    def _setup_params(self):
+        p = self.params
+        # add backward compatibility if useSegm is specified in params
+        if p.useSegm is not None:
+            p.iouType = "segm" if p.useSegm == 1 else "bbox"
+        p.imgIds = list(np.unique(p.imgIds))
+        if p.useCats:
+            p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+        return p
+
+    def _evaluate_images(self, img_ids):
+        """evaluateImg of img_ids, as {(catId, areaIdx, imgId): compact match table}"""
+        p = self._setup_params()
+        all_img_ids = p.imgIds
+        img_ids = set(img_ids)
+        p.imgIds = [i for i in all_img_ids if i in img_ids]
+        self._prepare()
+        catIds = p.catIds if p.useCats else [-1]
+        computeIoU = self.computeOks if p.iouType == "keypoints" else self.computeIoU
+        self.ious = {
+            (imgId, catId): computeIoU(imgId, catId) for imgId in p.imgIds for catId in catIds
+        }
+        maxDet = p.maxDets[-1]
+        tables = {}
+        for catId in catIds:
+            for a, areaRng in enumerate(p.areaRng):
+                for imgId in p.imgIds:
+                    e = self.evaluateImg(imgId, catId, areaRng, maxDet)
+                    if e is None:
+                        continue
+                    # accumulate() only needs whether a detection matched, not the gt id
+                    tables[catId, a, imgId] = {
+                        "dtScores": np.asarray(e["dtScores"], dtype=np.float32),
+                        "dtMatches": e["dtMatches"] > 0,
+                        "dtIgnore": np.asarray(e["dtIgnore"], dtype=bool),
+                        "gtIgnore": np.asarray(e["gtIgnore"], dtype=bool),
+                    }
+        p.imgIds = all_img_ids
+        return tables
+
+    def evaluate_shard(self, img_ids=None):
+        """
+        Evaluate the images of this shard, by default those with detections.
+
+        Returns:
+            dict: {(catId, areaIdx, imgId): match table}, small enough to be gathered.
+        """
+        tic = time.time()
+        if img_ids is None:
+            img_ids = set(ann["image_id"] for ann in self.cocoDt.anns.values())
+        tables = self._evaluate_images(img_ids)
+        logger.info("COCOeval_sharded.evaluate_shard() on {} images finished in {:0.2f} seconds.".format(
+            len(set(img_ids)), time.time() - tic))
+        return tables
+
+    def merge_shards(self, shard_tables):
+        """
+        Merge the tables of all shards into `self.evalImgs`, in the order of `evaluate()`.
+        Images no shard evaluated have no detections and are evaluated here.
+        """
+        tables = {}
+        for shard in shard_tables:
+            for key, table in shard.items():
+                tables.setdefault(key, table)
+        p = self._setup_params()
+        done = set(key[2] for key in tables)
+        tables.update(self._evaluate_images([i for i in p.imgIds if i not in done]))
+        catIds = p.catIds if p.useCats else [-1]
+        self.evalImgs = [
+            tables.get((catId, a, imgId))
+            for catId in catIds
+            for a in range(len(p.areaRng))
+            for imgId in p.imgIds
+        ]
+        self._paramsEval = copy.deepcopy(self.params)
@@ -48,3 +48,36 @@ class LRScheduler(HookBase):
         """set_state_dict
         """
         self._scheduler.set_state_dict(state_dict)
+
+
+class DatasetIterSync(HookBase):
+    """
+    Tell the training datasets the iteration training starts from, so that their
+    augmentation schedules (e.g. the Mosaic `stop_iter` of `BDD100K`) follow the
+    trainer iteration, also after resuming. The iteration is exact with
+    `sample_mode='batch'` only, see :class:`data.samplers.iteration_sampler.IterationBatchSampler`.
+    """
+
+    def __init__(self, data_loader):
+        """
+        Args:
+            data_loader: a `MultiTaskDataLoader` or a single paddle DataLoader
+        """
+        self._data_loader = data_loader
+        if hasattr(data_loader, 'task_loaders'):
+            self._loaders = list(data_loader.task_loaders.values())
+        else:
+            self._loaders = [data_loader]
+
+    def before_train(self):
+        """before_train
+        """
+        synced = False
+        for loader in self._loaders:
+            dataset = getattr(loader, 'dataset', None)
+            if hasattr(dataset, 'set_start_iter'):
+                dataset.set_start_iter(self.trainer.start_iter)
+                synced = True
+        # batches prefetched before resuming were tagged with iteration 0, drop them
+        if synced and self.trainer.start_iter > 0 and hasattr(self._data_loader, 'reset'):
+            self._data_loader.reset()
@@ -18,15 +18,49 @@ from __future__ import print_function
 
 import os
 import sys
+import copy
 import numpy as np
 import itertools
 import logging
 
+from utils import comm
 from evaluation.json_results import get_det_res, get_det_poly_res, get_seg_res, get_solov2_segm_res, get_keypoint_res
 
 
 logger = logging.getLogger("ufo.cocodet_evaluator")
 
+# parsed ground truth of every annotation file, reused by all eval rounds
+_COCO_GT_CACHE = {}
+
+
+def load_coco_gt(anno_file, style='bbox'):
+    """
+    COCO(anno_file), parsed once per process and reused until the file changes.
+    """
+    if style == 'keypoints_crowd':
+        from xtcocotools.coco import COCO
+    else:
+        from pycocotools.coco import COCO
+    key = (os.path.abspath(anno_file), os.path.getmtime(anno_file), COCO.__module__)
+    if key not in _COCO_GT_CACHE:
+        _COCO_GT_CACHE.clear()
+        _COCO_GT_CACHE[key] = COCO(anno_file)
+    return _COCO_GT_CACHE[key]
+
+
+def load_coco_res(coco_gt, res):
+    """coco_gt.loadRes, which also accepts an empty list or array of detections"""
+    if isinstance(res, str) or len(res) > 0:
+        return coco_gt.loadRes(res)
+    coco_dt = type(coco_gt)()
+    coco_dt.dataset = {
+        'images': list(coco_gt.dataset['images']),
+        'categories': copy.deepcopy(coco_gt.dataset['categories']),
+        'annotations': []
+    }
+    coco_dt.createIndex()
+    return coco_dt
+
 
 def draw_pr_curve(precision,
                   recall,
@@ -98,10 +132,13 @@ def cocoapi_eval(jsonfile,
                  max_dets=(100, 300, 1000),
                  classwise=False,
                  sigmas=None,
-                 use_area=True):
+                 use_area=True,
+                 sharded=False):
     """
     Args:
-        jsonfile (str): Evaluation json file, eg: bbox.json, mask.json.
+        jsonfile (str|list|np.ndarray): Evaluation json file, eg: bbox.json, mask.json, or the
+                 detections themselves: a list of result dicts or an [N, 7] array of
+                 [image_id, x, y, w, h, score, category_id] rows.
         style (str): COCOeval style, can be `bbox` , `segm` , `proposal`, `keypoints` and `keypoints_crowd`.
         coco_gt (str): Whether to load COCOAPI through anno_file,
                  eg: coco_gt = COCO(anno_file)
@@ -111,29 +148,38 @@ def cocoapi_eval(jsonfile,
         sigmas (nparray): keypoint labelling sigmas.
         use_area (bool): If gt annotations (eg. CrowdPose, AIC)
                          do not have 'area', please set use_area=False.
+        sharded (bool): Called on every rank with the detections of that rank: the per image
+                 matching runs on all ranks and only the match tables are gathered for the
+                 accumulation on the main process. Other ranks return None. bbox and segm only.
     """
     assert coco_gt != None or anno_file != None
     if style == 'keypoints_crowd':
         #please install xtcocotools==1.6
-        from xtcocotools.coco import COCO
         from xtcocotools.cocoeval import COCOeval
     else:
-        from pycocotools.coco import COCO
         from pycocotools.cocoeval import COCOeval
 
     if coco_gt == None:
-        coco_gt = COCO(anno_file)
+        coco_gt = load_coco_gt(anno_file, style)
     logger.info("Start evaluate...")
-    coco_dt = coco_gt.loadRes(jsonfile)
-    if style == 'proposal':
-        coco_eval = COCOeval(coco_gt, coco_dt, 'bbox')
-        coco_eval.params.useCats = 0
-        coco_eval.params.maxDets = list(max_dets)
-    elif style == 'keypoints_crowd':
-        coco_eval = COCOeval(coco_gt, coco_dt, style, sigmas, use_area)
+    coco_dt = load_coco_res(coco_gt, jsonfile)
+    if sharded and comm.get_world_size() > 1:
+        from detectron2.evaluation.fast_eval_api import COCOeval_sharded
+        coco_eval = COCOeval_sharded(coco_gt, coco_dt, style)
+        shard_tables = comm.all_gather_object(coco_eval.evaluate_shard())
+        if not comm.is_main_process():
+            return None
+        coco_eval.merge_shards(shard_tables)
     else:
-        coco_eval = COCOeval(coco_gt, coco_dt, style)
-    coco_eval.evaluate()
+        if style == 'proposal':
+            coco_eval = COCOeval(coco_gt, coco_dt, 'bbox')
+            coco_eval.params.useCats = 0
+            coco_eval.params.maxDets = list(max_dets)
+        elif style == 'keypoints_crowd':
+            coco_eval = COCOeval(coco_gt, coco_dt, style, sigmas, use_area)
+        else:
+            coco_eval = COCOeval(coco_gt, coco_dt, style)
+        coco_eval.evaluate()
     coco_eval.accumulate()
     coco_eval.summarize()
     # print('coco_eval: ', coco_eval.eval)
@@ -28,6 +28,7 @@ import copy
 import itertools
 
 from evaluation.coco_utils import get_infer_results, cocoapi_eval
+from evaluation.json_results import get_det_res_array, det_res_array_to_json
 from evaluation.evaluator import DatasetEvaluator
 from utils import comm
 
@@ -49,6 +50,10 @@ class CocoDetEvaluatorSingleTask(DatasetEvaluator):
         self.iou_type = IouType
         self.parallel_evaluator = kwargs.get('parallel_evaluator', True)
         self.num_valid_samples = kwargs.get('num_valid_samples', None)
+        # bbox.json is only written if asked for, the detections are evaluated in memory
+        self.save_json = kwargs.get('save_json', False)
+        # 多卡时每张卡只做自己图片的匹配, 只汇总匹配表到主进程
+        self.sharded_eval = kwargs.get('sharded_eval', True)
 
         if self.output_eval is not None:
             Path(self.output_eval).mkdir(exist_ok=True)
@@ -60,6 +65,7 @@ class CocoDetEvaluatorSingleTask(DatasetEvaluator):
         """
         self.results = []
         self.infer_results = {'bbox': [], 'mask': [], 'segm': [], 'keypoint': []}
+        self.bbox_arrays = []
         self.eval_results = {}
 
     def process(self, inputs, outputs):
@@ -83,9 +89,37 @@ class CocoDetEvaluatorSingleTask(DatasetEvaluator):
             outputs[k] = v.cpu()
         self.results.append(outputs)
     
+    def evaluate_sharded(self):
+        """bbox evaluation with the per image matching done on every rank, see cocoapi_eval(sharded=True)
+        """
+        bbox_arrays = []
+        for result in self.results:
+            result = {k: v.numpy() if isinstance(v, paddle.Tensor) else v for k, v in result.items()}
+            assert len(result['bbox']) == 0 or len(result['bbox'][0]) <= 6, \
+                'sharded evaluation supports only plain boxes, set sharded_eval=False'
+            bbox_arrays.append(get_det_res_array(
+                result['bbox'], result['bbox_num'], result['im_id'], self.clsid2catid, bias=self.bias))
+        bbox_res = np.concatenate(bbox_arrays) if bbox_arrays else np.zeros((0, 7), dtype='float64')
+        # 所有卡都要调用, 其中包含一次all_gather
+        bbox_stats = cocoapi_eval(
+            bbox_res,
+            'bbox',
+            anno_file=self.anno_file,
+            classwise=self.classwise,
+            sharded=True)
+        if not comm.is_main_process():
+            return {}
+        self.eval_results['bbox'] = bbox_stats
+        sys.stdout.flush()
+        return self.bbox_metrics(bbox_stats)
+
     def evaluate(self):
         """evaluate
         """
+        if self.sharded_eval and self.parallel_evaluator and self.iou_type == 'bbox' \
+                and comm.get_world_size() > 1 and not (self.save_json or self.save_prediction_only):
+            # 补齐用的重复样本给出相同的匹配表, 合并时去重, 无需按num_valid_samples截断
+            return self.evaluate_sharded()
         if self.parallel_evaluator and  comm.get_world_size() > 1:
             comm.synchronize()
             results = comm.gather(self.results)
@@ -102,26 +136,35 @@ class CocoDetEvaluatorSingleTask(DatasetEvaluator):
             for k, v in result.items():
                 result[k] = v.numpy() if isinstance(v, paddle.Tensor) else v
 
-            infer_result = get_infer_results(result, self.clsid2catid, bias=self.bias)
-            self.infer_results['bbox'] += infer_result['bbox'] if 'bbox' in infer_result else []
-            self.infer_results['mask'] += infer_result['mask'] if 'mask' in infer_result else []
-            self.infer_results['segm'] += infer_result['segm'] if 'segm' in infer_result else []
-            self.infer_results['keypoint'] += infer_result['keypoint'] if 'keypoint' in infer_result else []
-        
-        if len(self.infer_results['bbox']) > 0:
+            # plain boxes are kept as arrays, other outputs go through the result dicts
+            plain_bbox = 'bbox' in result and not (len(result['bbox']) > 0 and len(result['bbox'][0]) > 6)
+            if plain_bbox:
+                self.bbox_arrays.append(get_det_res_array(
+                    result['bbox'], result['bbox_num'], result['im_id'], self.clsid2catid, bias=self.bias))
+            if not plain_bbox or any(k in result for k in ('mask', 'segm', 'keypoint')):
+                infer_result = get_infer_results(result, self.clsid2catid, bias=self.bias)
+                if not plain_bbox:
+                    self.infer_results['bbox'] += infer_result['bbox'] if 'bbox' in infer_result else []
+                self.infer_results['mask'] += infer_result['mask'] if 'mask' in infer_result else []
+                self.infer_results['segm'] += infer_result['segm'] if 'segm' in infer_result else []
+                self.infer_results['keypoint'] += infer_result['keypoint'] if 'keypoint' in infer_result else []
+
+        bbox_res = np.concatenate(self.bbox_arrays) if self.bbox_arrays else self.infer_results['bbox']
+        if len(bbox_res) > 0:
             output = "bbox.json"
             if self.output_eval:
                 output = os.path.join(self.output_eval, output)
-            with open(output, 'w') as f:
-                json.dump(self.infer_results['bbox'], f)
-                logger.info('The bbox result is saved to bbox.json.')
+            if self.save_json or self.save_prediction_only:
+                with open(output, 'w') as f:
+                    json.dump(det_res_array_to_json(bbox_res) if isinstance(bbox_res, np.ndarray) else bbox_res, f)
+                    logger.info('The bbox result is saved to bbox.json.')
 
             if self.save_prediction_only:
                 logger.info('The bbox result is saved to {} and do not '
                             'evaluate the mAP.'.format(output))
             else:
                 bbox_stats = cocoapi_eval(
-                    output,
+                    bbox_res,
                     'bbox',
                     anno_file=self.anno_file,
                     classwise=self.classwise)
@@ -193,20 +236,25 @@ class CocoDetEvaluatorSingleTask(DatasetEvaluator):
                     use_area=use_area)
                 self.eval_results['keypoint'] = keypoint_stats
                 sys.stdout.flush()
-        
+
+        return self.bbox_metrics(self.eval_results['bbox'])
+
+    def bbox_metrics(self, bbox_stats):
+        """named metrics of the 12 COCO bbox stats
+        """
         eval_results = {}
-        eval_results['precision_avg_all_100'] = self.eval_results['bbox'][0]
-        eval_results['precision_0.50_all_100'] = self.eval_results['bbox'][1]
-        eval_results['precision_0.75_all_100'] = self.eval_results['bbox'][2]
-        eval_results['precision_avg_small_100'] = self.eval_results['bbox'][3]
-        eval_results['precision_avg_medium_100'] = self.eval_results['bbox'][4]
-        eval_results['precision_avg_large_100'] = self.eval_results['bbox'][5]
-        eval_results['recall_avg_all_1'] = self.eval_results['bbox'][6]
-        eval_results['recall_avg_all_10'] = self.eval_results['bbox'][7]
-        eval_results['recall_avg_all_100'] = self.eval_results['bbox'][8]
-        eval_results['recall_avg_small_100'] = self.eval_results['bbox'][9]
-        eval_results['recall_avg_medium_100'] = self.eval_results['bbox'][10]
-        eval_results['recall_avg_large_100'] = self.eval_results['bbox'][11]
+        eval_results['precision_avg_all_100'] = bbox_stats[0]
+        eval_results['precision_0.50_all_100'] = bbox_stats[1]
+        eval_results['precision_0.75_all_100'] = bbox_stats[2]
+        eval_results['precision_avg_small_100'] = bbox_stats[3]
+        eval_results['precision_avg_medium_100'] = bbox_stats[4]
+        eval_results['precision_avg_large_100'] = bbox_stats[5]
+        eval_results['recall_avg_all_1'] = bbox_stats[6]
+        eval_results['recall_avg_all_10'] = bbox_stats[7]
+        eval_results['recall_avg_all_100'] = bbox_stats[8]
+        eval_results['recall_avg_small_100'] = bbox_stats[9]
+        eval_results['recall_avg_medium_100'] = bbox_stats[10]
+        eval_results['recall_avg_large_100'] = bbox_stats[11]
 
         return eval_results
 
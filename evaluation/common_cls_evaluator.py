@@ -104,6 +104,11 @@ class CommonClasEvaluatorSingleTaskInfer(DatasetEvaluator):
         """
         self._predictions = []
 
+    def set_dataset(self, dataset):
+        """keep the im_id -> image path table of the dataset, samples only carry im_id
+        """
+        self.id2imgname = dataset.id2imgname
+
     def process(self, inputs, outputs):
         """process
         """
@@ -114,7 +119,6 @@ class CommonClasEvaluatorSingleTaskInfer(DatasetEvaluator):
 
         pred_logits = outputs
         im_id = inputs["im_id"]
-        self.id2imgname = inputs["id2imgname"]
         batch_size = im_id.shape[0]
         with paddle.no_grad():
             maxk = max(self.topk)
@@ -141,7 +145,7 @@ class CommonClasEvaluatorSingleTaskInfer(DatasetEvaluator):
             img_path = self.id2imgname[int(prediction[1])]
             pred = int(prediction[0])
             tmp = dict()
-            tmp[os.path.basename(img_path[0])] = pred
+            tmp[os.path.basename(str(img_path))] = pred
             pred_res.append(tmp)
             
         return {'cls': pred_res}
\ No newline at end of file
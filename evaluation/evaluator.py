@@ -5,9 +5,12 @@ import time
 import datetime
 from contextlib import contextmanager
 
+import numpy as np
 import paddle
+import paddle.nn.functional as F
 from utils import comm
 from utils.logger import log_every_n_seconds
+from modeling.post_process import batched_nms, soft_nms, weighted_boxes_fusion
 
 class DatasetEvaluator:
     """
@@ -53,7 +56,8 @@ class DatasetEvaluator:
         """
         pass
 
-def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, moe_group=None):
+def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, moe_group=None,
+                         det_scales=None, det_flip=False, det_fusion='wbf', det_fusion_iou=0.55):
     """
     Run model on the data_loader and evaluate the metrics with evaluator.
     The model will be used in eval mode.
@@ -68,6 +72,10 @@ def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, m
             :class:`DatasetEvaluators([])` if you only want to benchmark, but
             don't want to do any evaluation.
         flip_test (bool): If get features with flipped images
+        det_scales (list[float]): Scales of the trafficsign test-time augmentation, None for no TTA.
+        det_flip (bool): Add horizontally flipped variants to the trafficsign TTA.
+        det_fusion (str): How the TTA boxes are merged, 'wbf', 'nms' or 'soft_nms'.
+        det_fusion_iou (float): IoU threshold of the fusion.
     Returns:
         The return value of `evaluator.evaluate()`
     """
@@ -79,9 +87,15 @@ def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, m
 
     total = len(data_loader)  # inference data loader must have a fixed length
     evaluator.reset()
+    # 样本只携带im_id, 查找表由评估器从数据集取一次
+    if hasattr(evaluator, 'set_dataset'):
+        for task_loader in getattr(data_loader, 'task_loaders', {}).values():
+            evaluator.set_dataset(task_loader.dataset)
 
     if flip_horizontal:
         print('====================>use flip in cls!')
+    det_tta = det_scales is not None or det_flip
+    tta_costs = {}
     num_warmup = min(5, total - 1)
     start_time = time.perf_counter()
     total_compute_time = 0
@@ -93,7 +107,12 @@ def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, m
                 total_compute_time = 0
 
             start_compute_time = time.perf_counter()
-            outputs = model(inputs, moe_group) if moe_group is not None else model(inputs)
+            if det_tta and 'trafficsign' in inputs:
+                outputs = {'trafficsign': detection_tta(
+                    model, inputs['trafficsign'], scales=det_scales or [1.0], flip=det_flip,
+                    fusion=det_fusion, fusion_iou=det_fusion_iou, tta_costs=tta_costs, moe_group=moe_group)}
+            else:
+                outputs = model(inputs, moe_group) if moe_group is not None else model(inputs)
 
             # Flip test
             if flip_horizontal:
@@ -141,6 +160,8 @@ def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, m
             total_compute_time_str, total_compute_time / (total - num_warmup), num_devices
         )
     )
+    if det_tta:
+        log_tta_costs(tta_costs)
     results = evaluator.evaluate()
 
     # An evaluator may return None when not in main process.
@@ -148,3 +169,108 @@ def inference_on_dataset(model, data_loader, evaluator, flip_horizontal=False, m
     if results is None:
         results = {}
     return results
+
+
+def _scale_det_inputs(inputs, scale, pad_stride=32):
+    """resize a padded detection batch by `scale`; im_shape and scale_factor follow so that the
+    post-processed boxes stay in the coordinates of the original images"""
+    image = inputs['image']
+    if scale != 1.0:
+        h, w = image.shape[2:]
+        size = [int(round(h * scale)), int(round(w * scale))]
+        image = F.interpolate(image, size=size, mode='bilinear', align_corners=False)
+        image = F.pad(image, [0, -size[1] % pad_stride, 0, -size[0] % pad_stride])
+    im_shape = paddle.round(inputs['im_shape'] * scale)
+    scale_factor = inputs['scale_factor'] * im_shape / inputs['im_shape']
+    return {'image': image, 'im_shape': im_shape, 'scale_factor': scale_factor}
+
+
+def _flip_det_inputs(inputs):
+    """flip the images horizontally, keeping every image at the top left of its padding"""
+    image = inputs['image']
+    pad_w = image.shape[3] - inputs['im_shape'][:, 1].numpy().astype('int64')
+    image = paddle.stack([
+        paddle.roll(image[i].flip([2]), shifts=-int(pad_w[i]), axis=2) for i in range(image.shape[0])])
+    return dict(inputs, image=image)
+
+
+def _split_det_outputs(outputs, bs):
+    """[N, 6] boxes and [bs] counts -> list of bs numpy arrays"""
+    bbox = outputs['bbox'].numpy()
+    ends = np.cumsum(outputs['bbox_num'].numpy()[:bs])
+    return np.split(bbox, ends[:-1])
+
+
+def detection_tta(model, inputs, scales=(1.0, ), flip=False, fusion='wbf', fusion_iou=0.55,
+                  tta_costs=None, moe_group=None):
+    """
+    Test-time augmentation of a trafficsign batch. Every scale is one forward pass, with the
+    flipped images batched together with the unflipped ones; the boxes are mapped back to the
+    original images and merged per image.
+
+    Args:
+        inputs (dict): the trafficsign batch, with image, im_shape and scale_factor.
+        fusion (str): 'wbf' (weighted boxes fusion), 'nms' or 'soft_nms', all class-aware.
+        tta_costs (dict): if given, `tta_costs['scale_<s>']` accumulates the seconds and number
+            of variants of every scale.
+    Returns:
+        dict: {'bbox': [N, 6] label, score, x1, y1, x2, y2, 'bbox_num': [bs]}
+    """
+    bs = inputs['image'].shape[0]
+    origin_w = paddle.floor(inputs['im_shape'][:, 1] / inputs['scale_factor'][:, 1] + 0.5).numpy()
+    variants = [[] for _ in range(bs)]
+    max_dets = 0
+    for scale in scales:
+        start = time.perf_counter()
+        scaled = _scale_det_inputs(inputs, scale)
+        batch = scaled
+        if flip:
+            flipped = _flip_det_inputs(scaled)
+            batch = {k: paddle.concat([scaled[k], flipped[k]]) for k in scaled}
+        outputs = model({'trafficsign': batch}, moe_group) if moe_group is not None else \
+            model({'trafficsign': batch})
+        dets = _split_det_outputs(outputs['trafficsign'], batch['image'].shape[0])
+        if tta_costs is not None:
+            cost = tta_costs.setdefault('scale_{}'.format(scale), {'seconds': 0., 'variants': 0})
+            cost['seconds'] += time.perf_counter() - start
+            cost['variants'] += 2 if flip else 1
+        for i in range(bs):
+            variants[i].append(dets[i])
+            max_dets = max(max_dets, len(dets[i]))
+            if flip:
+                unflipped = dets[bs + i].copy()
+                unflipped[:, 2] = origin_w[i] - dets[bs + i][:, 4]
+                unflipped[:, 4] = origin_w[i] - dets[bs + i][:, 2]
+                variants[i].append(unflipped)
+
+    fused = [_fuse_dets(v, fusion, fusion_iou)[:max_dets] for v in variants]
+    return {
+        'bbox': paddle.to_tensor(np.concatenate(fused).astype('float32').reshape([-1, 6])),
+        'bbox_num': paddle.to_tensor(np.array([len(f) for f in fused], dtype='int32')),
+    }
+
+
+def _fuse_dets(variants, fusion, fusion_iou):
+    """merge the [n_i, 6] detections of the variants of one image, by decreasing score"""
+    dets = np.concatenate(variants)
+    if fusion == 'wbf':
+        boxes, scores, labels = weighted_boxes_fusion(
+            [v[:, 2:] for v in variants], [v[:, 1] for v in variants], [v[:, 0] for v in variants],
+            iou_thresh=fusion_iou)
+        return np.concatenate([labels[:, None], scores[:, None], boxes], axis=1)
+    elif fusion == 'nms':
+        return dets[batched_nms(dets[:, 2:], dets[:, 1], dets[:, 0], fusion_iou)]
+    elif fusion == 'soft_nms':
+        keep, scores = soft_nms(dets[:, 2:], dets[:, 1], dets[:, 0], iou_thresh=fusion_iou)
+        dets = dets[keep]
+        dets[:, 1] = scores
+        return dets
+    raise ValueError("Unknown detection TTA fusion: {}".format(fusion))
+
+
+def log_tta_costs(tta_costs):
+    """log the average cost of one test-time augmentation variant of every scale"""
+    logger = logging.getLogger(__name__)
+    for name, cost in tta_costs.items():
+        logger.info("TTA {}: {} variants, {:.4f} s / variant".format(
+            name, cost['variants'], cost['seconds'] / max(cost['variants'], 1)))
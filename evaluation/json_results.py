@@ -43,6 +43,38 @@ def get_det_res(bboxes, bbox_nums, image_id, label_to_cat_id_map, bias=0):
     return det_res
 
 
+def get_det_res_array(bboxes, bbox_nums, image_id, label_to_cat_id_map, bias=0):
+    """
+    Vectorized `get_det_res`: rows of [image_id, xmin, ymin, w, h, score, category_id],
+    the ndarray format accepted by `COCO.loadRes`.
+    """
+    bbox_nums = np.asarray(bbox_nums).reshape([-1]).astype('int64')
+    bboxes = np.asarray(bboxes).reshape([-1, 6])[:bbox_nums.sum()].astype('float64')
+    image_ids = np.repeat(np.asarray(image_id).reshape([-1])[:len(bbox_nums)], bbox_nums)
+    labels = bboxes[:, 0].astype('int64')
+    cat_lut = np.full([max(label_to_cat_id_map.keys(), default=-1) + 1], -1, dtype='int64')
+    for label, cat_id in label_to_cat_id_map.items():
+        cat_lut[int(label)] = cat_id
+    valid = (labels >= 0) & (labels < len(cat_lut))
+    valid[valid] = cat_lut[labels[valid]] >= 0
+    bboxes, labels, image_ids = bboxes[valid], labels[valid], image_ids[valid]
+    return np.stack([
+        image_ids.astype('float64'), bboxes[:, 2], bboxes[:, 3],
+        bboxes[:, 4] - bboxes[:, 2] + bias, bboxes[:, 5] - bboxes[:, 3] + bias,
+        bboxes[:, 1], cat_lut[labels].astype('float64')
+    ], axis=1)
+
+
+def det_res_array_to_json(det_res):
+    """rows of `get_det_res_array` -> the list of dicts of `get_det_res`"""
+    return [{
+        'image_id': int(row[0]),
+        'category_id': int(row[6]),
+        'bbox': row[1:5].tolist(),
+        'score': float(row[5])
+    } for row in det_res]
+
+
 def get_det_poly_res(bboxes, bbox_nums, image_id, label_to_cat_id_map, bias=0):
     det_res = []
     k = 0
@@ -201,3 +201,104 @@ def evaluate_rank(
         return evaluate_cy(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_metric_cuhk03)
     else:
         return evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_metric_cuhk03)
+
+
+class StreamingRankEvaluator(object):
+    """
+    Market1501 CMC, AP and INP from blocks of distance rows, without sorting the gallery.
+
+    Each query only needs the distances of its positives and, per positive, the number of
+    kept gallery samples closer than it, so a row is handled with a searchsorted against its
+    few positives and a bincount instead of a full argsort. The results equal those of a
+    stable argsort. Blocks are the (first row, [rows, num_gallery] distances) pairs yielded by
+    `utils.compute_dist.iter_dist_blocks`, so the full matrix never exists.
+
+    Args:
+        max_rank (int): length of the CMC curve.
+        topk (int): also keep the indices of the topk nearest gallery samples of every query
+            in `self.topk_indices`, e.g. for visualization. 0 keeps nothing.
+    """
+
+    def __init__(self, q_pids, g_pids, q_camids, g_camids, max_rank=50, topk=0):
+        self.q_pids = np.asarray(q_pids)
+        self.g_pids = np.asarray(g_pids)
+        self.q_camids = np.asarray(q_camids)
+        self.g_camids = np.asarray(g_camids)
+        self.max_rank = max_rank
+        self.topk = min(topk, len(self.g_pids))
+        # 每个query的第一个正样本的名次, AP, INP; 无正样本的query为-1/nan
+        self.first_pos_rank = np.full(len(self.q_pids), -1, dtype=np.int64)
+        self.all_AP = np.full(len(self.q_pids), np.nan, dtype=np.float64)
+        self.all_INP = np.full(len(self.q_pids), np.nan, dtype=np.float64)
+        self.topk_indices = np.zeros((len(self.q_pids), self.topk), dtype=np.int64)
+
+    def update(self, q_start, distmat):
+        """process distance rows [q_start, q_start + len(distmat)) against the whole gallery"""
+        distmat = np.asarray(distmat)
+        q_idx = np.arange(q_start, q_start + len(distmat))
+        same_pid = self.g_pids[None, :] == self.q_pids[q_idx, None]
+        # 同pid同camera的gallery样本不参与排序
+        junk = same_pid & (self.g_camids[None, :] == self.q_camids[q_idx, None])
+        for row, q in enumerate(q_idx):
+            self._update_row(q, distmat[row], same_pid[row] & ~junk[row], ~(same_pid[row] | junk[row]))
+        if self.topk > 0:
+            kth = np.partition(distmat, self.topk - 1, axis=1)[:, self.topk - 1]
+            for row in range(len(distmat)):
+                # 与第k个距离相同的样本都参与排序, 距离相同时按gallery下标, 与稳定排序一致
+                cand = np.flatnonzero(distmat[row] <= kth[row])
+                order = np.lexsort((cand, distmat[row, cand]))[:self.topk]
+                self.topk_indices[q_idx[row]] = cand[order]
+
+    def _update_row(self, q, dist, pos, neg):
+        pos_idx = np.flatnonzero(pos)
+        if len(pos_idx) == 0:
+            # this condition is true when query identity does not appear in gallery
+            return
+        pos_dist = dist[pos_idx]
+        order = np.lexsort((pos_idx, pos_dist))
+        pos_idx, pos_dist = pos_idx[order], pos_dist[order]
+
+        neg_idx = np.flatnonzero(neg)
+        neg_dist = dist[neg_idx]
+        # 负样本排在 right 及之后的所有正样本前面
+        right = np.searchsorted(pos_dist, neg_dist, side='right')
+        neg_before = np.cumsum(np.bincount(right, minlength=len(pos_idx) + 1))[:len(pos_idx)]
+        # 距离相等时下标小的在前
+        left = np.searchsorted(pos_dist, neg_dist, side='left')
+        for n in np.flatnonzero(left < right):
+            for j in range(left[n], right[n]):
+                if neg_idx[n] < pos_idx[j]:
+                    neg_before[j] += 1
+
+        ranks = np.arange(len(pos_idx)) + neg_before  # 0-based rank of each positive
+        self.first_pos_rank[q] = ranks[0]
+        self.all_AP[q] = np.mean((np.arange(len(pos_idx)) + 1.) / (ranks + 1.))
+        self.all_INP[q] = len(pos_idx) / (ranks[-1] + 1.)
+
+    def compute(self):
+        """
+        Returns:
+            the same (cmc, all_AP, all_INP) as `eval_market1501`
+        """
+        valid = self.first_pos_rank >= 0
+        assert valid.any(), 'Error: all query identities do not appear in gallery'
+        max_rank = min(self.max_rank, len(self.g_pids))
+        cmc = (self.first_pos_rank[valid, None] <= np.arange(max_rank)[None, :]).astype(np.float32)
+        all_cmc = cmc.sum(0) / valid.sum()
+        return all_cmc, list(self.all_AP[valid]), list(self.all_INP[valid])
+
+
+def evaluate_rank_streaming(dist_blocks, q_pids, g_pids, q_camids, g_camids, max_rank=50, topk=0):
+    """Market1501 evaluation of streamed distance blocks, see StreamingRankEvaluator.
+    Args:
+        dist_blocks: iterable of (first query row, [rows, num_gallery] distances), e.g.
+            `utils.compute_dist.iter_dist_blocks(query_feats, gallery_feats)`.
+    Returns:
+        cmc, all_AP, all_INP, and the [num_query, topk] nearest gallery indices if topk > 0.
+    """
+    evaluator = StreamingRankEvaluator(q_pids, g_pids, q_camids, g_camids, max_rank, topk)
+    for q_start, distmat in dist_blocks:
+        evaluator.update(q_start, distmat)
+    if topk > 0:
+        return evaluator.compute() + (evaluator.topk_indices,)
+    return evaluator.compute()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import functools
 from unittest import result
 from PIL import Image
 import numpy as np
@@ -22,6 +23,7 @@ import paddle.nn.functional as F
 import json
 
 from utils import comm
+from evaluation.seg_export import mask2polygon, PolygonExporter, shard_file, merge_shards
 import collections.abc
 import cv2
 from tqdm import tqdm 
@@ -40,6 +42,8 @@ def seg_inference_on_dataset(model,
              is_slide=False,
              stride=None,
              crop_size=None,
+             slide_batch_size=None,
+             slide_gaussian_sigma=None,
              precision='fp32',
              amp_level='O1',
              print_detail=True,
@@ -59,6 +63,9 @@ def seg_inference_on_dataset(model,
             It should be provided when `is_slide` is True.
         crop_size (tuple|list, optional):  The crop size of sliding window, the first is width and the second is height.
             It should be provided when `is_slide` is True.
+        slide_batch_size (int, optional): The number of sliding windows per forward pass. Default: None (all windows).
+        slide_gaussian_sigma (float, optional): If given, overlapping windows are merged with gaussian weights of
+            std `slide_gaussian_sigma` times the window size. Default: None.
         precision (str, optional): Use AMP if precision='fp16'. If precision='fp32', the evaluation is normal.
         amp_level (str, optional): Auto mixed precision level. Accepted values are “O1” and “O2”: O1 represent mixed precision, the input data type of each operator will be casted by white_list and black_list; O2 represent Pure fp16, all operators parameters and input data will be casted to fp16, except operators in black_list, don’t support fp16 kernel and batchnorm. Default is O1(amp)
         num_workers (int, optional): Num workers for data loader. Default: 0.
@@ -86,6 +93,7 @@ def seg_inference_on_dataset(model,
 
     if aug_eval and flip_horizontal:
         print('================>use aug_eval with flip_horizontal in seg')
+    tta_costs = {}
 
     with paddle.no_grad():
         for iter, data in enumerate(data_loader):
@@ -101,7 +109,10 @@ def seg_inference_on_dataset(model,
                     flip_vertical=flip_vertical,
                     is_slide=is_slide,
                     stride=stride,
-                    crop_size=crop_size)
+                    crop_size=crop_size,
+                    slide_batch_size=slide_batch_size,
+                    slide_gaussian_sigma=slide_gaussian_sigma,
+                    tta_costs=tta_costs)
             else:
                 pred, logits = inference(
                     model,
@@ -109,7 +120,9 @@ def seg_inference_on_dataset(model,
                     trans_info=trans_info,
                     is_slide=is_slide,
                     stride=stride,
-                    crop_size=crop_size)
+                    crop_size=crop_size,
+                    slide_batch_size=slide_batch_size,
+                    slide_gaussian_sigma=slide_gaussian_sigma)
             
             intersect_area, pred_area, label_area = metrics.calculate_area(
                 pred,
@@ -165,6 +178,8 @@ def seg_inference_on_dataset(model,
     class_dice, mdice = metrics.dice(*metrics_input)
     
     model.train()
+    if aug_eval and print_detail:
+        log_tta_costs(tta_costs)
     
     if auc_roc:
         auc_roc = metrics.auc_roc(
@@ -186,27 +201,6 @@ def seg_inference_on_dataset(model,
 
     return result
 
-import copy
-def mask2polygon(mask_image):
-
-    """
-    :param mask_image: 输入mask图片地址, 默认为gray, 且像素值为0或255
-    :return: list, 每个item为一个labelme的points
-    """
-    cls_2_polygon = {}
-    for i in range(19):
-        mask = copy.deepcopy(mask_image)
-        mask[mask != i] = 0
-        mask[mask == i] = 1
-        mask.astype('uint8')
-
-        contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        results = [item.squeeze().tolist() for item in contours]
-        cls_2_polygon[i] = results
-
-    return cls_2_polygon  #results
-
-
 def seg_inference_on_test_dataset(model,
              data_loader,
              evaluate,
@@ -217,12 +211,16 @@ def seg_inference_on_test_dataset(model,
              is_slide=False,
              stride=None,
              crop_size=None,
+             slide_batch_size=None,
+             slide_gaussian_sigma=None,
              precision='fp32',
              amp_level='O1',
              print_detail=True,
-             auc_roc=False):
+             auc_roc=False,
+             export_workers=4,
+             shard_results=None):
     """
-    Launch evalution.
+    Launch inference on the test set and export the predictions as polygons.
 
     Args:
         model（nn.Layer): A semantic segmentation model.
@@ -236,15 +234,24 @@ def seg_inference_on_test_dataset(model,
             It should be provided when `is_slide` is True.
         crop_size (tuple|list, optional):  The crop size of sliding window, the first is width and the second is height.
             It should be provided when `is_slide` is True.
+        slide_batch_size (int, optional): The number of sliding windows per forward pass. Default: None (all windows).
+        slide_gaussian_sigma (float, optional): If given, overlapping windows are merged with gaussian weights of
+            std `slide_gaussian_sigma` times the window size. Default: None.
         precision (str, optional): Use AMP if precision='fp16'. If precision='fp32', the evaluation is normal.
         amp_level (str, optional): Auto mixed precision level. Accepted values are “O1” and “O2”: O1 represent mixed precision, the input data type of each operator will be casted by white_list and black_list; O2 represent Pure fp16, all operators parameters and input data will be casted to fp16, except operators in black_list, don’t support fp16 kernel and batchnorm. Default is O1(amp)
         num_workers (int, optional): Num workers for data loader. Default: 0.
         print_detail (bool, optional): Whether to print detailed information about the evaluation process. Default: True.
         auc_roc(bool, optional): whether add auc_roc metric
+        export_workers (int, optional): Number of processes computing polygons. Default: 4.
+        shard_results (bool, optional): If True, every rank exports its own predictions to a shard file
+            next to `seg_polygons.jsonl` and the main process merges the shards once at the end, so
+            `evaluate.save_path` must be a path shared by all ranks (e.g. on all nodes). If False, the
+            predictions are all-gathered to the main process after every image. Default: None, which
+            takes `evaluate.shard_results` and is False when the evaluator does not set it.
 
     Returns:
-        float: The mIoU of validation datasets.
-        float: The accuracy of validation datasets.
+        dict: On the main process, {'seg': StreamedJsonList} of {imgname: polygons} items,
+            streamed to `seg_polygons.jsonl` under `evaluate.save_path`.
     """
     
     if print_detail: #and hasattr(data_loader, 'dataset'):
@@ -253,9 +260,22 @@ def seg_inference_on_test_dataset(model,
 
     model.eval()
 
-    pred_res = []
+    save_dir = getattr(evaluate, 'save_path', './')
+    save_file = os.path.join(save_dir, 'seg_polygons.jsonl')
+    world_size = comm.get_world_size()
+    if shard_results is None:
+        shard_results = getattr(evaluate, 'shard_results', False)
+    shard_results = shard_results and world_size > 1
+    exporter = None
+    if shard_results:
+        os.makedirs(save_dir, exist_ok=True)
+        exporter = PolygonExporter(shard_file(save_file, comm.get_rank()), num_workers=export_workers)
+    elif comm.is_main_process():
+        os.makedirs(save_dir, exist_ok=True)
+        exporter = PolygonExporter(save_file, num_workers=export_workers)
     if aug_eval:
         print('===============>use flip aug in seg')
+    tta_costs = {}
     with paddle.no_grad():
         for iter, data in enumerate(tqdm(data_loader, mininterval=10)):
             trans_info = data['segmentation']['trans_info']
@@ -273,7 +293,10 @@ def seg_inference_on_test_dataset(model,
                     flip_vertical=flip_vertical,
                     is_slide=is_slide,
                     stride=stride,
-                    crop_size=crop_size)
+                    crop_size=crop_size,
+                    slide_batch_size=slide_batch_size,
+                    slide_gaussian_sigma=slide_gaussian_sigma,
+                    tta_costs=tta_costs)
             else:
                 pred, _ = inference(
                     model,
@@ -281,26 +304,44 @@ def seg_inference_on_test_dataset(model,
                     trans_info=trans_info,
                     is_slide=is_slide,
                     stride=stride,
-                    crop_size=crop_size)
+                    crop_size=crop_size,
+                    slide_batch_size=slide_batch_size,
+                    slide_gaussian_sigma=slide_gaussian_sigma)
 
-            results = []
-            results_id = []
-            paddle.distributed.all_gather(results, pred)
-            paddle.distributed.all_gather(results_id, im_id)
+            if shard_results or world_size == 1:
+                results, results_id = [pred], [im_id]
+            else:
+                results = []
+                results_id = []
+                paddle.distributed.all_gather(results, pred)
+                paddle.distributed.all_gather(results_id, im_id)
 
-            if not comm.is_main_process():
+            if exporter is None:
                 continue
             for k, result in enumerate(results):                               
-                res = mask2polygon(result.numpy().squeeze(0).squeeze(0).astype(np.uint8))
-                tmp = dict()
                 id = results_id[k].numpy()[0]
                 imgname = os.path.splitext(os.path.basename(id2path[0][id][0]))[0] + '.png'
-                tmp[imgname] = res
-                pred_res.append(tmp)
-
+                exporter.submit(imgname, result.numpy().squeeze(0).squeeze(0).astype(np.uint8))
+
+    if aug_eval and print_detail:
+        log_tta_costs(tta_costs)
+    if shard_results:
+        exporter.close()
+        # 所有rank写完shard后由主进程合并
+        comm.synchronize()
+        if not comm.is_main_process():
+            return {}
+        return {'seg': merge_shards([shard_file(save_file, r) for r in range(world_size)], save_file)}
     if not comm.is_main_process():
         return {}
-    return {'seg': pred_res}
+    return {'seg': exporter.close()}
+
+
+def log_tta_costs(tta_costs):
+    """log the average cost of one test-time augmentation variant of every scale"""
+    for name, cost in tta_costs.items():
+        logger.info("[EVAL] TTA {}: {} variants, {:.4f} s / variant".format(
+            name, cost['variants'], cost['seconds'] / max(cost['variants'], 1)))
 
 
 def inference(model,
@@ -308,7 +349,9 @@ def inference(model,
               trans_info=None,
               is_slide=False,
               stride=None,
-              crop_size=None):
+              crop_size=None,
+              slide_batch_size=None,
+              slide_gaussian_sigma=None):
     """
     Inference for image.
 
@@ -319,6 +362,8 @@ def inference(model,
         is_slide (bool): Whether to infer by sliding window. Default: False.
         crop_size (tuple|list). The size of sliding window, (w, h). It should be probided if is_slide is True.
         stride (tuple|list). The size of stride, (w, h). It should be probided if is_slide is True.
+        slide_batch_size (int, optional): The number of sliding windows per forward pass. Default: None (all).
+        slide_gaussian_sigma (float, optional): Gaussian weighting of overlapping windows. Default: None.
 
     Returns:
         Tensor: If ori_shape is not None, a prediction with shape (1, 1, h, w) is returned.
@@ -335,7 +380,8 @@ def inference(model,
                 .format(type(logits)))
         logit = logits[0]
     else:
-        logit = slide_inference(model, im, crop_size=crop_size, stride=stride)
+        logit = slide_inference(model, im['segmentation']['image'], crop_size=crop_size, stride=stride,
+                                batch_size=slide_batch_size, gaussian_sigma=slide_gaussian_sigma)
     if hasattr(model, 'data_format') and model.data_format == 'NHWC':
         logit = logit.transpose((0, 3, 1, 2))
     if trans_info is not None:
@@ -354,13 +400,17 @@ def aug_inference(model,
                   flip_vertical=False,
                   is_slide=False,
                   stride=None,
-                  crop_size=None):
+                  crop_size=None,
+                  slide_batch_size=None,
+                  slide_gaussian_sigma=None,
+                  tta_costs=None):
     """
-    Infer with augmentation.
+    Infer with augmentation. The flipped variants of every scale are batched into one
+    forward pass and their softmax probabilities are merged on device.
 
     Args:
         model (paddle.nn.Layer): model to get logits of image.
-        im (Tensor): the input image.
+        data (dict): the input batch, the image is `data['segmentation']['image']`.
         trans_info (list): Transforms for image.
         scales (float|tuple|list):  Scales for resize. Default: 1.
         flip_horizontal (bool): Whether to flip horizontally. Default: False.
@@ -368,6 +418,10 @@ def aug_inference(model,
         is_slide (bool): Whether to infer by sliding wimdow. Default: False.
         crop_size (tuple|list). The size of sliding window, (w, h). It should be probided if is_slide is True.
         stride (tuple|list). The size of stride, (w, h). It should be probided if is_slide is True.
+        slide_batch_size (int, optional): The number of sliding windows per forward pass. Default: None (all).
+        slide_gaussian_sigma (float, optional): Gaussian weighting of overlapping windows. Default: None.
+        tta_costs (dict, optional): If given, the time spent on every scale and the number of
+            variants (flips x images) it ran are accumulated in `tta_costs['scale_<scale>']`.
 
     Returns:
         Tensor: Prediction of image with shape (1, 1, h, w) is returned.
@@ -380,58 +434,78 @@ def aug_inference(model,
                 type(scales)))
     final_logit = 0
     im = data['segmentation']['image']
+    n = im.shape[0]
     h_input, w_input = im.shape[-2], im.shape[-1]
     flip_comb = flip_combination(flip_horizontal, flip_vertical)
     for scale in scales:
+        start = time.perf_counter()
         h = int(h_input * scale + 0.5)
         w = int(w_input * scale + 0.5)
-        im = F.interpolate(im, [h, w], mode='bilinear')
-        for flip in flip_comb:
-            im_flip = tensor_flip(im, flip)
-            data['segmentation']['image'] = im_flip
-            logit = inference(
-                model,
-                data,
-                is_slide=is_slide,
-                crop_size=crop_size,
-                stride=stride)
-            logit = tensor_flip(logit, flip)
+        # always resize from the original input
+        im_scale = im if (h, w) == (h_input, w_input) else F.interpolate(im, [h, w], mode='bilinear')
+        # the flips of one scale have the same size and run as a single batch
+        im_flips = paddle.concat([tensor_flip(im_scale, flip) for flip in flip_comb], axis=0)
+        if is_slide:
+            logits = slide_inference(model, im_flips, crop_size=crop_size, stride=stride,
+                                     batch_size=slide_batch_size, gaussian_sigma=slide_gaussian_sigma)
+        else:
+            logits = segmentation_logit(model, im_flips)
+        for i, flip in enumerate(flip_comb):
+            logit = tensor_flip(logits[i * n:(i + 1) * n], flip)
             logit = F.interpolate(logit, [h_input, w_input], mode='bilinear')
 
             logit = F.softmax(logit, axis=1)
             final_logit = final_logit + logit
 
+        if tta_costs is not None:
+            if paddle.is_compiled_with_cuda():
+                paddle.device.cuda.synchronize()
+            cost = tta_costs.setdefault('scale_{}'.format(scale), {'seconds': 0., 'variants': 0})
+            cost['seconds'] += time.perf_counter() - start
+            cost['variants'] += len(flip_comb) * n
+
     final_logit = reverse_transform(final_logit, trans_info, mode='bilinear')
     pred = paddle.argmax(final_logit, axis=1, keepdim=True, dtype='int32')  #选取最大的
 
     return pred, final_logit
 
 
-def slide_inference(model, im, crop_size, stride):
+def segmentation_logit(model, im):
     """
-    Infer by sliding window.
+    Run the segmentation head of the multi-task model on an image batch.
 
     Args:
         model (paddle.nn.Layer): model to get logits of image.
-        im (Tensor): the input image.
-        crop_size (tuple|list). The size of sliding window, (w, h).
-        stride (tuple|list). The size of stride, (w, h).
+        im (Tensor): the input images with shape (N, C, H, W).
 
     Return:
-        Tensor: The logit of input image.
+        Tensor: The logits with shape (N, num_classes, H, W).
+    """
+    logits = model({'segmentation': {'image': im}})
+    logits = list(logits.values())[0]
+    if not isinstance(logits, collections.abc.Sequence):
+        raise TypeError(
+            "The type of logits must be one of collections.abc.Sequence, e.g. list, tuple. But received {}"
+            .format(type(logits)))
+    return logits[0]
+
+
+def slide_windows(h_im, w_im, crop_size, stride):
+    """
+    Get the sliding windows covering an image.
+
+    Returns:
+        list: List of (h1, h2, w1, w2). All windows have the same size.
     """
-    h_im, w_im = im.shape[-2:]
     w_crop, h_crop = crop_size
     w_stride, h_stride = stride
     # calculate the crop nums
-    rows = np.int(np.ceil(1.0 * (h_im - h_crop) / h_stride)) + 1
-    cols = np.int(np.ceil(1.0 * (w_im - w_crop) / w_stride)) + 1
+    rows = int(np.ceil(1.0 * (h_im - h_crop) / h_stride)) + 1
+    cols = int(np.ceil(1.0 * (w_im - w_crop) / w_stride)) + 1
     # prevent negative sliding rounds when imgs after scaling << crop_size
     rows = 1 if h_im <= h_crop else rows
     cols = 1 if w_im <= w_crop else cols
-    # TODO 'Tensor' object does not support item assignment. If support, use tensor to calculation.
-    final_logit = None
-    count = np.zeros([1, 1, h_im, w_im])
+    windows = []
     for r in range(rows):
         for c in range(cols):
             h1 = r * h_stride
@@ -440,25 +514,81 @@ def slide_inference(model, im, crop_size, stride):
             w2 = min(w1 + w_crop, w_im)
             h1 = max(h2 - h_crop, 0)
             w1 = max(w2 - w_crop, 0)
-            im_crop = im[:, :, h1:h2, w1:w2]
-            logits = model(im_crop)
-            logits = list(logits.values())[0]
-            if not isinstance(logits, collections.abc.Sequence):
-                raise TypeError(
-                    "The type of logits must be one of collections.abc.Sequence, e.g. list, tuple. But received {}"
-                    .format(type(logits)))
-            logit = logits[0].numpy()
-            if final_logit is None:
-                final_logit = np.zeros([1, logit.shape[1], h_im, w_im])
-            final_logit[:, :, h1:h2, w1:w2] += logit[:, :, :h2 - h1, :w2 - w1]
-            count[:, :, h1:h2, w1:w2] += 1
+            windows.append((h1, h2, w1, w2))
+    return windows
+
+
+def window_weight(h, w, gaussian_sigma=None):
+    """
+    Weight of every pixel of a window when merging overlapping windows.
+
+    Args:
+        gaussian_sigma (float, optional): If given, the weight is a gaussian centered on
+            the window with std `gaussian_sigma` times the window size, which down-weights
+            the less reliable window borders. Otherwise all pixels weigh 1.
+
+    Return:
+        np.ndarray: The weight with shape (h, w).
+    """
+    if gaussian_sigma is None:
+        return np.ones([h, w], dtype='float32')
+    ys = (np.arange(h, dtype='float32') - (h - 1) / 2.) / (gaussian_sigma * h)
+    xs = (np.arange(w, dtype='float32') - (w - 1) / 2.) / (gaussian_sigma * w)
+    return np.exp(-0.5 * (ys[:, None] ** 2 + xs[None, :] ** 2)).astype('float32')
+
+
+@functools.lru_cache(maxsize=8)
+def _slide_weights(h_im, w_im, crop_size, stride, gaussian_sigma):
+    """window weight and the inverse of the summed weight of all windows, as tensors
+    """
+    windows = slide_windows(h_im, w_im, crop_size, stride)
+    h1, h2, w1, w2 = windows[0]
+    weight = window_weight(h2 - h1, w2 - w1, gaussian_sigma)
+    count = np.zeros([h_im, w_im], dtype='float32')
+    for h1, h2, w1, w2 in windows:
+        count[h1:h2, w1:w2] += weight
     if np.sum(count == 0) != 0:
         raise RuntimeError(
             'There are pixel not predicted. It is possible that stride is greater than crop_size'
         )
-    final_logit = final_logit / count
-    final_logit = paddle.to_tensor(final_logit)
-    return final_logit
+    return paddle.to_tensor(weight[None, None]), paddle.to_tensor((1. / count)[None, None])
+
+
+def slide_inference(model, im, crop_size, stride, batch_size=None, gaussian_sigma=None):
+    """
+    Infer by sliding window. The windows are stacked into batches of `batch_size` windows
+    so every batch takes a single forward pass, and the logits are accumulated on the
+    device of the model.
+
+    Args:
+        model (paddle.nn.Layer): model to get logits of image.
+        im (Tensor): the input image.
+        crop_size (tuple|list). The size of sliding window, (w, h).
+        stride (tuple|list). The size of stride, (w, h).
+        batch_size (int, optional): The number of windows per forward pass. All windows
+            at once if None. Default: None.
+        gaussian_sigma (float, optional): Merge overlapping windows with gaussian weights,
+            see `window_weight`. Default: None.
+
+    Return:
+        Tensor: The logit of input image.
+    """
+    n = im.shape[0]
+    h_im, w_im = im.shape[-2:]
+    windows = slide_windows(h_im, w_im, crop_size, stride)
+    weight, inv_count = _slide_weights(h_im, w_im, tuple(crop_size), tuple(stride), gaussian_sigma)
+    batch_size = batch_size or len(windows)
+
+    final_logit = None
+    for start in range(0, len(windows), batch_size):
+        chunk = windows[start:start + batch_size]
+        crops = paddle.concat([im[:, :, h1:h2, w1:w2] for h1, h2, w1, w2 in chunk], axis=0)
+        logits = segmentation_logit(model, crops)
+        if final_logit is None:
+            final_logit = paddle.zeros([n, logits.shape[1], h_im, w_im], dtype=logits.dtype)
+        for i, (h1, h2, w1, w2) in enumerate(chunk):
+            final_logit[:, :, h1:h2, w1:w2] += logits[i * n:(i + 1) * n] * weight
+    return final_logit * inv_count
 
 
 def reverse_transform(pred, trans_info, mode='nearest'):
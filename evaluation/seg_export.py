@@ -0,0 +1,201 @@
+"""evaluation.seg_export
+
+Export of segmentation test predictions as per-class polygons. Polygons are computed
+in a process pool and streamed to a JSON-lines file, one image per line, so the main
+rank neither computes them serially nor holds all of them in memory. In distributed
+runs with a shared output directory, every rank can export its own shard instead and the
+shards are merged once at the end.
+"""
+import os
+import sys
+import json
+import contextlib
+import collections
+import multiprocessing
+
+import cv2
+import numpy as np
+
+
+def mask2polygon(mask_image, num_classes=19):
+    """
+    :param mask_image: 输入mask图片, 像素值为类别id
+    :return: dict, 每个类别对应一个list, 每个item为一个labelme的points
+    """
+    cls_2_polygon = {}
+    # 只对图片中出现的类别求轮廓
+    present = set(np.unique(mask_image).tolist())
+    for i in range(num_classes):
+        if i == 0:
+            # 与原提交格式保持一致: 类别0总是整张图的多边形
+            mask = np.ones(mask_image.shape[:2], dtype=np.uint8)
+        elif i not in present:
+            cls_2_polygon[i] = []
+            continue
+        else:
+            mask = (mask_image == i).astype(np.uint8)
+        contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        results = [item.squeeze().tolist() for item in contours]
+        cls_2_polygon[i] = results
+
+    return cls_2_polygon  #results
+
+
+class StreamedJsonList(object):
+    """
+    A list stored in a JSON-lines file, one item per line, read back lazily.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __len__(self):
+        with open(self.path, 'r') as f:
+            return sum(1 for _ in f)
+
+
+def dump_json(obj, f):
+    """
+    `json.dump` for a dict whose values may be `StreamedJsonList`, which are copied
+    line by line into the output instead of being loaded in memory.
+    """
+    if not isinstance(obj, dict):
+        json.dump(obj, f)
+        return
+    f.write('{')
+    for i, (key, value) in enumerate(obj.items()):
+        if i > 0:
+            f.write(', ')
+        f.write(json.dumps(str(key)) + ': ')
+        if isinstance(value, StreamedJsonList):
+            f.write('[')
+            with open(value.path, 'r') as lines:
+                for j, line in enumerate(lines):
+                    if j > 0:
+                        f.write(', ')
+                    f.write(line.rstrip('\n'))
+            f.write(']')
+        else:
+            json.dump(value, f)
+    f.write('}')
+
+
+@contextlib.contextmanager
+def _hide_main():
+    """
+    Hide the launching script from the preparation data of new processes: spawn and
+    forkserver children otherwise re-run its top level (imports, seeds, ...) as `__mp_main__`.
+    """
+    main = sys.modules['__main__']
+    main_file = main.__dict__.pop('__file__', None)
+    main_spec = getattr(main, '__spec__', None)
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        main.__spec__ = main_spec
+        if main_file is not None:
+            main.__file__ = main_file
+
+
+def _polygon_pool(num_workers):
+    """
+    A pool whose workers only import this module (numpy and cv2): they are forked from a
+    forkserver that preloaded it, not from the trainer and its (CUDA) state, and they don't
+    import the launching script.
+    """
+    ctx = multiprocessing.get_context('forkserver')
+    ctx.set_forkserver_preload([__name__])
+    # 进程在Pool构造时全部启动, 之后不再需要隐藏__main__
+    with _hide_main():
+        return ctx.Pool(num_workers)
+
+
+class PolygonExporter(object):
+    """
+    Compute `mask2polygon` in a process pool and append `{imgname: polygons}` lines to
+    `save_file` in submission order.
+
+    Args:
+        save_file (str): the JSON-lines output file.
+        num_workers (int): size of the process pool, 0 computes polygons in the caller.
+        max_pending (int): number of masks in flight before `submit` waits for the oldest.
+    """
+    def __init__(self, save_file, num_workers=4, max_pending=None, num_classes=19):
+        self.save_file = save_file
+        self.num_classes = num_classes
+        self.max_pending = max_pending or 4 * max(num_workers, 1)
+        self.num_images = 0
+        self._f = open(save_file, 'w')
+        self._pending = collections.deque()
+        self._pool = _polygon_pool(num_workers) if num_workers > 0 else None
+
+    def submit(self, imgname, mask):
+        """queue the polygons of one (H, W) uint8 mask
+        """
+        if self._pool is None:
+            self._write(imgname, mask2polygon(mask, self.num_classes))
+            return
+        self._pending.append((imgname, self._pool.apply_async(mask2polygon, (mask, self.num_classes))))
+        self._drain(block=len(self._pending) >= self.max_pending)
+
+    def _drain(self, block=False):
+        while self._pending and (block or self._pending[0][1].ready()):
+            imgname, result = self._pending.popleft()
+            self._write(imgname, result.get())
+            block = False
+
+    def _write(self, imgname, polygons):
+        self._f.write(json.dumps({imgname: polygons}) + '\n')
+        self.num_images += 1
+
+    def close(self):
+        """
+        Wait for the pending masks and close the file.
+
+        Returns:
+            StreamedJsonList: the exported `{imgname: polygons}` items.
+        """
+        while self._pending:
+            self._drain(block=True)
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+        self._f.close()
+        return StreamedJsonList(self.save_file)
+
+
+def shard_file(save_file, rank):
+    """the per-rank shard of `save_file`: seg_polygons.jsonl -> seg_polygons.rank0.jsonl
+    """
+    root, ext = os.path.splitext(save_file)
+    return '{}.rank{}{}'.format(root, rank, ext)
+
+
+def merge_shards(shard_files, save_file, remove=True):
+    """
+    Concatenate JSON-lines shards into `save_file`. Images exported by more than one
+    rank (the distributed sampler pads the last batch with repeated samples) are kept once.
+
+    Returns:
+        StreamedJsonList: the merged `{imgname: polygons}` items.
+    """
+    decoder = json.JSONDecoder()
+    seen = set()
+    with open(save_file, 'w') as out:
+        for path in shard_files:
+            with open(path, 'r') as f:
+                for line in f:
+                    # 只解析imgname, 不解析polygons
+                    imgname, _ = decoder.raw_decode(line, 1)
+                    if imgname in seen:
+                        continue
+                    seen.add(imgname)
+                    out.write(line)
+            if remove:
+                os.remove(path)
+    return StreamedJsonList(save_file)
@@ -63,11 +63,16 @@ class SegEvaluatorInfer(object):
     """
     SegEvaluatorInfer
     """
-    def __init__(self, mode='test', save_path='./'):
+    def __init__(self, mode='test', save_path='./', shard_results=False):
         """init
+
+        Args:
+            shard_results (bool): every rank writes its predictions to a shard under save_path,
+                merged by the main process. save_path must then be shared by all ranks.
         """
         self.mode = mode
         self.save_path = save_path
+        self.shard_results = shard_results
 
     def reset(self):
         """reset
@@ -4,6 +4,7 @@ import paddle.nn.functional as F
 from ppdet.modeling.shape_spec import ShapeSpec
 from ppdet.core.workspace import register, serializable
 import numpy as np
+from collections import OrderedDict
 
 from .transformer_utils import DropPath, Identity
 from .transformer_utils import add_parameter, to_2tuple
@@ -125,6 +126,60 @@ def window_reverse(windows, window_size, H, W):
     return x
 
 
+# 多尺度输入时每种 (Hp, Wp) 一个mask, 超过上限时丢弃最久未用的
+SHIFT_MASK_CACHE_SIZE = 32
+_SHIFT_MASK_CACHE = OrderedDict()
+_RELATIVE_POSITION_INDEX_CACHE = {}
+
+
+def shifted_window_attention_mask(Hp, Wp, window_size, shift_size):
+    """
+    The (0/-100) SW-MSA attention mask of a padded Hp x Wp feature map, of shape
+    (num_windows, Wh*Ww, Wh*Ww). Built once in numpy per shape and device, then reused by
+    every block and step.
+    """
+    key = (Hp, Wp, window_size, shift_size, paddle.get_device())
+    if key in _SHIFT_MASK_CACHE:
+        _SHIFT_MASK_CACHE.move_to_end(key)
+        return _SHIFT_MASK_CACHE[key]
+
+    img_mask = np.zeros([Hp, Wp], dtype='float32')
+    slices = (slice(0, -window_size),
+              slice(-window_size, -shift_size),
+              slice(-shift_size, None))
+    cnt = 0
+    for h in slices:
+        for w in slices:
+            img_mask[h, w] = cnt
+            cnt += 1
+    mask_windows = img_mask.reshape(
+        [Hp // window_size, window_size, Wp // window_size, window_size]).transpose(
+            [0, 2, 1, 3]).reshape([-1, window_size * window_size])
+    attn_mask = mask_windows[:, None, :] != mask_windows[:, :, None]
+    attn_mask = paddle.to_tensor(-100.0 * attn_mask.astype('float32'))
+
+    _SHIFT_MASK_CACHE[key] = attn_mask
+    while len(_SHIFT_MASK_CACHE) > SHIFT_MASK_CACHE_SIZE:
+        _SHIFT_MASK_CACHE.popitem(last=False)
+    return attn_mask
+
+
+def relative_position_index(window_size):
+    """pair-wise relative position index (Wh*Ww, Wh*Ww) of a window, shared by all blocks"""
+    key = (tuple(window_size), paddle.get_device())
+    if key not in _RELATIVE_POSITION_INDEX_CACHE:
+        coords = np.stack(np.meshgrid(
+            np.arange(window_size[0]), np.arange(window_size[1]), indexing='ij'))  # 2, Wh, Ww
+        coords_flatten = coords.reshape([2, -1])  # 2, Wh*Ww
+        relative_coords = (coords_flatten[:, :, None] - coords_flatten[:, None, :]).transpose(
+            [1, 2, 0])  # Wh*Ww, Wh*Ww, 2
+        relative_coords[:, :, 0] += window_size[0] - 1  # shift to start from 0
+        relative_coords[:, :, 1] += window_size[1] - 1
+        relative_coords[:, :, 0] *= 2 * window_size[1] - 1
+        _RELATIVE_POSITION_INDEX_CACHE[key] = paddle.to_tensor(relative_coords.sum(-1))
+    return _RELATIVE_POSITION_INDEX_CACHE[key]
+
+
 class WindowAttention(nn.Layer):
     """ Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -161,21 +216,8 @@ class WindowAttention(nn.Layer):
                           num_heads)))  # 2*Wh-1 * 2*Ww-1, nH
 
         # get pair-wise relative position index for each token inside the window
-        coords_h = paddle.arange(self.window_size[0])
-        coords_w = paddle.arange(self.window_size[1])
-        coords = paddle.stack(paddle.meshgrid(
-            [coords_h, coords_w]))  # 2, Wh, Ww
-        coords_flatten = paddle.flatten(coords, 1)  # 2, Wh*Ww
-        coords_flatten_1 = coords_flatten.unsqueeze(axis=2)
-        coords_flatten_2 = coords_flatten.unsqueeze(axis=1)
-        relative_coords = coords_flatten_1 - coords_flatten_2
-        relative_coords = relative_coords.transpose(
-            [1, 2, 0])  # Wh*Ww, Wh*Ww, 2
-        relative_coords[:, :, 0] += self.window_size[
-            0] - 1  # shift to start from 0
-        relative_coords[:, :, 1] += self.window_size[1] - 1
-        relative_coords[:, :, 0] *= 2 * self.window_size[1] - 1
-        self.relative_position_index = relative_coords.sum(-1)  # Wh*Ww, Wh*Ww
+        self.relative_position_index = relative_position_index(self.window_size)  # Wh*Ww, Wh*Ww
+        self._relative_position_index_flat = self.relative_position_index.flatten()
 
         self.qkv = nn.Linear(dim, dim * 3, bias_attr=qkv_bias)
         self.attn_drop = nn.Dropout(attn_drop)
@@ -200,10 +242,8 @@ class WindowAttention(nn.Layer):
         q = q * self.scale
         attn = paddle.mm(q, k.transpose([0, 1, 3, 2]))
 
-        index = self.relative_position_index.flatten()
-
         relative_position_bias = paddle.index_select(
-            self.relative_position_bias_table, index)
+            self.relative_position_bias_table, self._relative_position_index_flat)
         relative_position_bias = relative_position_bias.reshape([
             self.window_size[0] * self.window_size[1],
             self.window_size[0] * self.window_size[1], -1
@@ -475,27 +515,7 @@ class BasicLayer(nn.Layer):
         # calculate attention mask for SW-MSA
         Hp = int(np.ceil(H / self.window_size)) * self.window_size
         Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = paddle.zeros([1, Hp, Wp, 1], dtype='float32')  # 1 Hp Wp 1
-        h_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        w_slices = (slice(0, -self.window_size),
-                    slice(-self.window_size, -self.shift_size),
-                    slice(-self.shift_size, None))
-        cnt = 0
-        for h in h_slices:
-            for w in w_slices:
-                img_mask[:, h, w, :] = cnt
-
-                cnt += 1
-
-        mask_windows = window_partition(
-            img_mask, self.window_size)  # nW, window_size, window_size, 1
-        mask_windows = mask_windows.reshape(
-            [-1, self.window_size * self.window_size])
-        attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
-        huns = -100.0 * paddle.ones_like(attn_mask)
-        attn_mask = huns * (attn_mask != 0).astype("float32")
+        attn_mask = shifted_window_attention_mask(Hp, Wp, self.window_size, self.shift_size)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
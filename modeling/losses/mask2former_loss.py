@@ -16,6 +16,7 @@
 
 import copy
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from scipy.optimize import linear_sum_assignment
 
 import paddle
@@ -206,6 +207,55 @@ def batch_sigmoid_focal_loss(inputs, targets, alpha=0.25, gamma=2):
     return loss / hw
 
 
+def padded_batch_dice_loss(inputs, targets):
+    """
+    `batch_dice_loss` for a batch of images.
+    Args:
+        inputs: A float tensor of shape [bs, N, P], the mask logits sampled at P points.
+        targets: A float tensor of shape [bs, M, P], the binary target masks at the same points.
+    Returns:
+        Loss tensor of shape [bs, N, M]
+    """
+    inputs = F.sigmoid(inputs)
+    numerator = 2 * paddle.bmm(inputs, targets.transpose([0, 2, 1]))
+    denominator = inputs.sum(-1).unsqueeze(2) + targets.sum(-1).unsqueeze(1)
+    loss = 1 - (numerator + 1) / (denominator + 1)
+    return loss
+
+
+def padded_batch_sigmoid_focal_loss(inputs, targets):
+    """
+    `batch_sigmoid_focal_loss` for a batch of images.
+    Args:
+        inputs: A float tensor of shape [bs, N, P], the mask logits sampled at P points.
+        targets: A float tensor of shape [bs, M, P], the binary target masks at the same points.
+    Returns:
+        Loss tensor of shape [bs, N, M]
+    """
+    hw = inputs.shape[-1]
+
+    pos = F.binary_cross_entropy_with_logits(
+        inputs, paddle.ones_like(inputs), reduction='none')
+    neg = F.binary_cross_entropy_with_logits(
+        inputs, paddle.zeros_like(inputs), reduction='none')
+
+    targets_t = targets.transpose([0, 2, 1])
+    loss = paddle.bmm(pos, targets_t) + paddle.bmm(neg, 1 - targets_t)
+
+    return loss / hw
+
+
+_ASSIGNMENT_POOL = None
+
+
+def _assignment_pool():
+    """threads solving the linear assignments of a batch, shared by all matchers"""
+    global _ASSIGNMENT_POOL
+    if _ASSIGNMENT_POOL is None:
+        _ASSIGNMENT_POOL = ThreadPoolExecutor(max_workers=4)
+    return _ASSIGNMENT_POOL
+
+
 class HungarianMatcher(nn.Layer):
     """This class computes an assignment between the targets and the predictions of the network
     For efficiency reasons, the targets don't include the no_object. Because of this, in general,
@@ -213,22 +263,82 @@ class HungarianMatcher(nn.Layer):
     while the others are un-matched (and thus treated as non-objects).
     """
 
-    def __init__(self, cost_class=1, cost_mask=1, cost_dice=1):
+    def __init__(self, cost_class=1, cost_mask=1, cost_dice=1, batched=True):
         """Creates the matcher
         Params:
             cost_class: This is the relative weight of the classification error in the matching cost
             cost_mask: This is the relative weight of the focal loss of the binary mask in the matching cost
             cost_dice: This is the relative weight of the dice loss of the binary mask in the matching cost
+            batched: If True, the cost matrices of the whole batch are computed in padded tensors, copied
+                to host at once and solved in a thread pool. Otherwise images are matched one by one.
         """
         super().__init__()
         self.cost_class = cost_class
         self.cost_mask = cost_mask
         self.cost_dice = cost_dice
         self.num_points = 12544
+        self.batched = batched
         assert cost_class != 0 or cost_mask != 0 or cost_dice != 0, "all costs cant be 0"
 
     @paddle.no_grad()
     def forward(self, outputs, targets):
+        """Performs the matching, see `forward_per_image` for the arguments and returns.
+        """
+        if not self.batched:
+            return self.forward_per_image(outputs, targets)
+
+        bs, num_queries = outputs["pred_logits"].shape[:2]
+        sizes = [int(t["labels"].shape[0]) for t in targets]
+        max_size = max(sizes)
+        if max_size == 0:
+            return [(paddle.to_tensor(np.array([], dtype='int64')),
+                     paddle.to_tensor(np.array([], dtype='int64'))) for _ in range(bs)]
+
+        out_prob = F.softmax(outputs["pred_logits"], axis=-1)  # [bs, num_queries, num_classes]
+        out_mask = outputs["pred_masks"]  # [bs, num_queries, H_pred, W_pred]
+
+        # one set of random points per image, as in forward_per_image
+        point_coords = paddle.rand((bs, self.num_points, 2))
+        out_mask = point_sample(out_mask, point_coords, align_corners=False)  # [bs, num_queries, num_points]
+
+        # sample the targets of every image and pad them to max_size, the padded columns are dropped
+        # before solving. Sampling before padding avoids copying the full resolution gt masks.
+        tgt_ids, tgt_mask = [], []
+        for b, (t, n) in enumerate(zip(targets, sizes)):
+            ids, masks = [], []
+            if n > 0:
+                ids.append(paddle.cast(t["labels"], 'int64'))
+                masks.append(point_sample(
+                    paddle.cast(t["masks"], out_mask.dtype).unsqueeze(0),
+                    point_coords[b:b + 1], align_corners=False)[0])
+            if n < max_size:
+                ids.append(paddle.zeros([max_size - n], dtype='int64'))
+                masks.append(paddle.zeros([max_size - n, self.num_points], dtype=out_mask.dtype))
+            tgt_ids.append(paddle.concat(ids))
+            tgt_mask.append(paddle.concat(masks))
+        tgt_ids = paddle.stack(tgt_ids)  # [bs, max_size]
+        tgt_mask = paddle.stack(tgt_mask)  # [bs, max_size, num_points]
+
+        cost_class = -paddle.take_along_axis(
+            out_prob, paddle.tile(tgt_ids.unsqueeze(1), [1, num_queries, 1]), axis=2)
+
+        cost_mask = padded_batch_sigmoid_focal_loss(out_mask, tgt_mask)
+        cost_dice = padded_batch_dice_loss(out_mask, tgt_mask)
+
+        C = (self.cost_mask * cost_mask + self.cost_class * cost_class +
+             self.cost_dice * cost_dice)
+        # a single device to host copy for the whole batch
+        C = C.numpy()
+
+        indices = list(_assignment_pool().map(
+            lambda b: linear_sum_assignment(C[b, :, :sizes[b]]), range(bs)))
+
+        return [(paddle.to_tensor(
+            i, dtype='int64'), paddle.to_tensor(
+                j, dtype='int64')) for i, j in indices]
+
+    @paddle.no_grad()
+    def forward_per_image(self, outputs, targets):
         """Performs the matching More memory-friendly.
         Params:
             outputs: This is a dict that contains at least these entries:
@@ -24,15 +24,18 @@ class DETRBBoxPostProcess(object):
     def __init__(self,
                  num_classes=80,
                  num_top_queries=100,
-                 use_focal_loss=False):
+                 use_focal_loss=False,
+                 score_threshold=None):
         super(DETRBBoxPostProcess, self).__init__()
         self.num_classes = num_classes
         self.num_top_queries = num_top_queries
         self.use_focal_loss = use_focal_loss
+        self.score_threshold = score_threshold
 
     def __call__(self, head_out, im_shape, scale_factor):
         """
-        Decode the bbox.
+        Decode the bbox. The whole batch is decoded with batched top-k and `take_along_axis`,
+        and only the kept boxes are converted to xyxy and rescaled.
 
         Args:
             head_out (tuple): bbox_pred, cls_logit and masks of bbox_head output.
@@ -43,38 +46,37 @@ class DETRBBoxPostProcess(object):
                 labels, scores and bboxes. The size of bboxes are corresponding
                 to the input image, the bboxes may be used in other branch.
             bbox_num (Tensor): The number of prediction boxes of each batch with
-                shape [bs], and is N.
+                shape [bs], and is N. If `score_threshold` is set, boxes scoring
+                below it are dropped and the number varies per image.
         """
         bboxes, logits, masks = head_out
-
-        bbox_pred = bbox_cxcywh_to_xyxy(bboxes)
-        origin_shape = paddle.floor(im_shape / scale_factor + 0.5)
-        img_h, img_w = origin_shape.unbind(1)
-        origin_shape = paddle.stack(
-            [img_w, img_h, img_w, img_h], axis=-1).unsqueeze(0)
-        bbox_pred *= origin_shape
-
-        scores = F.sigmoid(logits) if self.use_focal_loss else F.softmax(
-            logits)[:, :, :-1]
+        bs, num_queries, num_classes = logits.shape
 
         if not self.use_focal_loss:
-            scores, labels = scores.max(-1), scores.argmax(-1)
-            if scores.shape[1] > self.num_top_queries:
+            scores = F.softmax(logits)[:, :, :-1]
+            # max and argmax in one op
+            scores, labels = paddle.topk(scores, 1, axis=-1)
+            scores, labels = scores.squeeze(-1), labels.squeeze(-1)
+            index = None
+            if num_queries > self.num_top_queries:
                 scores, index = paddle.topk(
                     scores, self.num_top_queries, axis=-1)
-                labels = paddle.stack(
-                    [paddle.gather(l, i) for l, i in zip(labels, index)])
-                bbox_pred = paddle.stack(
-                    [paddle.gather(b, i) for b, i in zip(bbox_pred, index)])
+                labels = paddle.take_along_axis(labels, index, axis=1)
         else:
+            scores = F.sigmoid(logits)
             scores, index = paddle.topk(
-                scores.reshape([logits.shape[0], -1]),
-                self.num_top_queries,
-                axis=-1)
-            labels = index % logits.shape[2]
-            index = index // logits.shape[2]
-            bbox_pred = paddle.stack(
-                [paddle.gather(b, i) for b, i in zip(bbox_pred, index)])
+                scores.reshape([bs, -1]), self.num_top_queries, axis=-1)
+            labels = index % num_classes
+            index = index // num_classes
+        if index is not None:
+            bboxes = paddle.take_along_axis(
+                bboxes, paddle.tile(index.unsqueeze(-1), [1, 1, 4]), axis=1)
+
+        origin_shape = paddle.floor(im_shape / scale_factor + 0.5)
+        img_h, img_w = origin_shape.unbind(1)
+        origin_shape = paddle.stack(
+            [img_w, img_h, img_w, img_h], axis=-1).unsqueeze(1)
+        bbox_pred = bbox_cxcywh_to_xyxy(bboxes) * origin_shape
 
         bbox_pred = paddle.concat(
             [
@@ -82,63 +84,192 @@ class DETRBBoxPostProcess(object):
                 bbox_pred
             ],
             axis=-1)
+        if self.score_threshold is not None:
+            # masked_select keeps the boxes of every image contiguous and in order
+            keep = scores > self.score_threshold
+            bbox_num = keep.astype('int32').sum(1)
+            bbox_pred = paddle.masked_select(
+                bbox_pred, paddle.tile(keep.unsqueeze(-1), [1, 1, 6]))
+            return bbox_pred.reshape([-1, 6]), bbox_num
         bbox_num = paddle.to_tensor(
             bbox_pred.shape[1], dtype='int32').tile([bbox_pred.shape[0]])
         bbox_pred = bbox_pred.reshape([-1, 6])
         return bbox_pred, bbox_num
 
 
-def nms(dets, thresh):
-    """Apply classic DPM-style greedy NMS."""
-    if dets.shape[0] == 0:
-        return dets[[], :]
-    scores = dets[:, 0]
-    x1 = dets[:, 1]
-    y1 = dets[:, 2]
-    x2 = dets[:, 3]
-    y2 = dets[:, 4]
+def box_iou_one_to_many(box, boxes, offset=0.):
+    """IoU of one box [4] with boxes [M, 4] in x1y1x2y2, `offset=1` for the legacy +1 pixel area"""
+    xx1 = np.maximum(box[0], boxes[:, 0])
+    yy1 = np.maximum(box[1], boxes[:, 1])
+    xx2 = np.minimum(box[2], boxes[:, 2])
+    yy2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.maximum(0.0, xx2 - xx1 + offset) * np.maximum(0.0, yy2 - yy1 + offset)
+    area = (box[2] - box[0] + offset) * (box[3] - box[1] + offset)
+    areas = (boxes[:, 2] - boxes[:, 0] + offset) * (boxes[:, 3] - boxes[:, 1] + offset)
+    return inter / np.maximum(area + areas - inter, 1e-10)
+
+
+def nms_indices(boxes, scores, thresh, offset=0.):
+    """
+    Greedy NMS, vectorized over the remaining boxes: one numpy pass per kept box.
 
-    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    Args:
+        boxes (np.ndarray): [N, 4] in x1y1x2y2.
+        scores (np.ndarray): [N].
+        thresh (float): boxes overlapping a kept box with IoU >= thresh are suppressed.
+        offset (float): 1 for the legacy +1 pixel box area.
+    Returns:
+        np.ndarray: indices of the kept boxes, by decreasing score.
+    """
     order = scores.argsort()[::-1]
+    keep = []
+    while order.size > 0:
+        i = order[0]
+        keep.append(i)
+        ovr = box_iou_one_to_many(boxes[i], boxes[order[1:]], offset)
+        order = order[1:][ovr < thresh]
+    return np.array(keep, dtype='int64')
+
+
+def _offset_by_label(boxes, labels):
+    """shift the boxes of every label to a disjoint range so that one NMS never mixes labels"""
+    if boxes.shape[0] == 0:
+        return boxes
+    span = boxes.max() - boxes.min() + 1
+    return boxes - boxes.min() + labels.reshape([-1, 1]).astype(boxes.dtype) * span
+
+
+def batched_nms(boxes, scores, labels, thresh, offset=0.):
+    """
+    Class-aware NMS in a single pass, with the coordinate offset trick.
 
-    ndets = dets.shape[0]
-    suppressed = np.zeros((ndets), dtype=np.int)
-
-    # nominal indices
-    # _i, _j
-    # sorted indices
-    # i, j
-    # temp variables for box i's (the box currently under consideration)
-    # ix1, iy1, ix2, iy2, iarea
-
-    # variables for computing overlap with box j (lower scoring box)
-    # xx1, yy1, xx2, yy2
-    # w, h
-    # inter, ovr
-
-    for _i in range(ndets):
-        i = order[_i]
-        if suppressed[i] == 1:
-            continue
-        ix1 = x1[i]
-        iy1 = y1[i]
-        ix2 = x2[i]
-        iy2 = y2[i]
-        iarea = areas[i]
-        for _j in range(_i + 1, ndets):
-            j = order[_j]
-            if suppressed[j] == 1:
-                continue
-            xx1 = max(ix1, x1[j])
-            yy1 = max(iy1, y1[j])
-            xx2 = min(ix2, x2[j])
-            yy2 = min(iy2, y2[j])
-            w = max(0.0, xx2 - xx1 + 1)
-            h = max(0.0, yy2 - yy1 + 1)
-            inter = w * h
-            ovr = inter / (iarea + areas[j] - inter)
-            if ovr >= thresh:
-                suppressed[j] = 1
-    keep = np.where(suppressed == 0)[0]
-    dets = dets[keep, :]
-    return dets
\ No newline at end of file
+    Returns:
+        np.ndarray: indices of the kept boxes, by decreasing score.
+    """
+    return nms_indices(_offset_by_label(boxes, labels), scores, thresh, offset)
+
+
+def soft_nms(boxes, scores, labels=None, iou_thresh=0.3, sigma=0.5, score_thresh=0.001,
+             method='gaussian', offset=0.):
+    """
+    Soft-NMS (https://arxiv.org/abs/1704.04503): overlapping boxes are down-weighted
+    instead of removed.
+
+    Args:
+        labels (np.ndarray): if given, only boxes of the same label decay each other.
+        method (str): 'gaussian' (exp(-iou^2 / sigma)) or 'linear' (1 - iou above iou_thresh).
+        score_thresh (float): boxes whose decayed score falls below it are dropped.
+    Returns:
+        tuple(np.ndarray, np.ndarray): indices of the kept boxes by decreasing decayed score,
+            and their decayed scores.
+    """
+    if labels is not None:
+        boxes = _offset_by_label(boxes, labels)
+    scores = scores.astype('float64')
+    remain = np.arange(boxes.shape[0])
+    keep, kept_scores = [], []
+    while remain.size > 0:
+        top = scores[remain].argmax()
+        i = remain[top]
+        keep.append(i)
+        kept_scores.append(scores[i])
+        remain = np.delete(remain, top)
+        ovr = box_iou_one_to_many(boxes[i], boxes[remain], offset)
+        if method == 'linear':
+            decay = np.where(ovr > iou_thresh, 1 - ovr, 1.)
+        elif method == 'gaussian':
+            decay = np.exp(-(ovr * ovr) / sigma)
+        else:
+            raise ValueError("Unknown soft-nms method: {}".format(method))
+        scores[remain] = scores[remain] * decay
+        remain = remain[scores[remain] >= score_thresh]
+    return np.array(keep, dtype='int64'), np.array(kept_scores, dtype='float32')
+
+
+def weighted_boxes_fusion(boxes_list, scores_list, labels_list, weights=None, iou_thresh=0.55,
+                          skip_box_thresh=0.0, conf_type='avg'):
+    """
+    Weighted boxes fusion (https://arxiv.org/abs/1910.13302) of the predictions of several
+    models or test-time augmentations of one image: overlapping boxes of the same label are
+    averaged, weighted by their scores, instead of suppressed.
+
+    Args:
+        boxes_list (list[np.ndarray]): [N_i, 4] x1y1x2y2 boxes of every prediction set.
+        scores_list (list[np.ndarray]): [N_i] scores.
+        labels_list (list[np.ndarray]): [N_i] labels.
+        weights (list[float]): weight of every prediction set, default all 1.
+        iou_thresh (float): a box joins a cluster if its IoU with the fused box exceeds it.
+        skip_box_thresh (float): boxes scoring below it are ignored.
+        conf_type (str): 'avg' or 'max' of the cluster scores.
+    Returns:
+        tuple(np.ndarray, np.ndarray, np.ndarray): fused boxes [K, 4], scores [K] and labels [K],
+            by decreasing score.
+    """
+    weights = np.ones(len(boxes_list)) if weights is None else np.asarray(weights, dtype='float64')
+    boxes = np.concatenate([np.asarray(b, dtype='float64').reshape([-1, 4]) for b in boxes_list])
+    scores = np.concatenate([np.asarray(s, dtype='float64') * w for s, w in zip(scores_list, weights)])
+    labels = np.concatenate([np.asarray(l).reshape([-1]) for l in labels_list])
+    valid = scores >= skip_box_thresh
+    boxes, scores, labels = boxes[valid], scores[valid], labels[valid]
+
+    out_boxes, out_scores, out_labels = [], [], []
+    for label in np.unique(labels):
+        index = np.where(labels == label)[0]
+        index = index[scores[index].argsort()[::-1]]
+        fused = np.zeros((0, 4))
+        members = []
+        for i in index:
+            ovr = box_iou_one_to_many(boxes[i], fused) if len(members) else np.zeros(0)
+            best = ovr.argmax() if ovr.size else -1
+            if best >= 0 and ovr[best] > iou_thresh:
+                members[best].append(i)
+                m = members[best]
+                fused[best] = (scores[m, None] * boxes[m]).sum(0) / scores[m].sum()
+            else:
+                members.append([i])
+                fused = np.concatenate([fused, boxes[i][None]])
+        for box, m in zip(fused, members):
+            if conf_type == 'avg':
+                score = scores[m].mean() * min(len(weights), len(m)) / weights.sum()
+            elif conf_type == 'max':
+                score = scores[m].max() / weights.max()
+            else:
+                raise ValueError("Unknown conf_type: {}".format(conf_type))
+            out_boxes.append(box)
+            out_scores.append(score)
+            out_labels.append(label)
+
+    if not out_boxes:
+        return np.zeros((0, 4), 'float32'), np.zeros((0, ), 'float32'), np.zeros((0, ), labels.dtype)
+    order = np.argsort(out_scores)[::-1]
+    return (np.array(out_boxes, dtype='float32')[order], np.array(out_scores, dtype='float32')[order],
+            np.array(out_labels)[order])
+
+
+def device_batched_nms(boxes, scores, labels, thresh):
+    """
+    Class-aware NMS of Tensors on their device with `paddle.vision.ops.nms`, for candidate sets
+    too large for the numpy path. Boxes use continuous coordinates (no +1 pixel area).
+
+    Returns:
+        Tensor: indices of the kept boxes, by decreasing score.
+    """
+    if boxes.shape[0] == 0:
+        return paddle.zeros([0], dtype='int64')
+    span = boxes.max() - boxes.min() + 1
+    boxes = boxes - boxes.min() + labels.astype(boxes.dtype).unsqueeze(-1) * span
+    return paddle.vision.ops.nms(boxes, iou_threshold=thresh, scores=scores)
+
+
+def nms(dets, thresh):
+    """Apply classic DPM-style greedy NMS.
+
+    Args:
+        dets (np.ndarray): [N, 5+] rows of score, x1, y1, x2, y2, ...
+    Returns:
+        np.ndarray: the kept rows, in their original order.
+    """
+    if dets.shape[0] == 0:
+        return dets[[], :]
+    keep = np.sort(nms_indices(dets[:, 1:5], dets[:, 0], thresh, offset=1.))
+    return dets[keep, :]
@@ -26,13 +26,14 @@ import math
 import paddle
 import paddle.nn as nn
 import paddle.nn.functional as F
+from paddle.autograd import PyLayer
 
 from ..bbox_utils import bbox_overlaps
 
 __all__ = [
     '_get_clones', 'bbox_overlaps', 'bbox_cxcywh_to_xyxy',
     'bbox_xyxy_to_cxcywh', 'sigmoid_focal_loss', 'inverse_sigmoid',
-    'deformable_attention_core_func'
+    'deformable_attention_core_func', 'level_batched_deformable_attention'
 ]
 
 
@@ -72,6 +73,151 @@ def deformable_attention_core_func(value, value_spatial_shapes,
                                    value_level_start_index, sampling_locations,
                                    attention_weights):
     """
+    Args:
+        value (Tensor): [bs, value_length, n_head, c]
+        value_spatial_shapes (Tensor): [n_levels, 2]
+        value_level_start_index (Tensor): [n_levels]
+        sampling_locations (Tensor): [bs, query_length, n_head, n_levels, n_points, 2]
+        attention_weights (Tensor): [bs, query_length, n_head, n_levels, n_points]
+
+    Returns:
+        output (Tensor): [bs, Length_{query}, C]
+    """
+    return level_batched_deformable_attention(
+        value, value_spatial_shapes, sampling_locations, attention_weights)
+
+
+# 每块query的gather缓冲区上限(MB)
+DEFORMABLE_GATHER_CHUNK_MB = 16
+
+
+class _GatherWeightedSum(PyLayer):
+    """
+    out[n, q] = sum_s weights[n, q, s] * value[indices[n, q, s]], computed query chunk by
+    query chunk. With several chunks the gathered values are not kept for backward, which
+    gathers them again chunk by chunk, so only one chunk of them is in memory at a time.
+    """
+
+    @staticmethod
+    def forward(ctx, value, indices, weights, chunk):
+        ctx.chunk = chunk
+        ctx.save_for_backward(value, indices, weights)
+        n, len_q, num_samples = indices.shape
+        outputs = []
+        for start in range(0, len_q, chunk):
+            index = indices[:, start:start + chunk]
+            sampled = paddle.gather(value, index.flatten()).reshape(
+                [n, index.shape[1], num_samples, value.shape[1]])
+            outputs.append(paddle.matmul(weights[:, start:start + chunk].unsqueeze(2), sampled).squeeze(2))
+        # 只有一块时保留gather结果, backward不用重新gather
+        ctx.sampled = sampled if chunk >= len_q else None
+        return paddle.concat(outputs, axis=1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        value, indices, weights = ctx.saved_tensor()
+        n, len_q, num_samples = indices.shape
+        c = value.shape[1]
+        grad_value = paddle.zeros_like(value)
+        grad_weights = []
+        for start in range(0, len_q, ctx.chunk):
+            index = indices[:, start:start + ctx.chunk]
+            grad = grad_output[:, start:start + ctx.chunk]
+            sampled = ctx.sampled
+            if sampled is None:
+                sampled = paddle.gather(value, index.flatten()).reshape(
+                    [n, index.shape[1], num_samples, c])
+            grad_weights.append(paddle.matmul(sampled, grad.unsqueeze(-1)).squeeze(-1))
+            # 外积用matmul, 比广播乘法快
+            updates = paddle.matmul(weights[:, start:start + ctx.chunk].unsqueeze(-1), grad.unsqueeze(2))
+            grad_value = paddle.scatter_nd_add(
+                grad_value, index.reshape([-1, 1]), updates.reshape([-1, c]))
+        return grad_value, None, paddle.concat(grad_weights, axis=1)
+
+
+def level_batched_deformable_attention(value, value_spatial_shapes,
+                                       sampling_locations, attention_weights,
+                                       chunk_mb=DEFORMABLE_GATHER_CHUNK_MB):
+    """
+    Multi-scale deformable attention with one gather for all levels instead of one
+    `F.grid_sample` per level. The 4 bilinear corners of every sampling point are turned into
+    flat indices into the value of all levels (level start offset + y * w + x), corners outside
+    their level point to an extra zero row, and the corners are weighted by the bilinear and the
+    attention weights in a single matmul. Same result as `per_level_deformable_attention_core_func`
+    (zeros padding, align_corners=False).
+
+    The gathered corners are 4 times the sampled values of the per-level version, so they are
+    gathered for chunks of queries of at most `chunk_mb` and not kept for backward.
+
+    Args:
+        value (Tensor): [bs, value_length, n_head, c]
+        value_spatial_shapes (Tensor|list): [n_levels, 2], (h, w) of every level
+        sampling_locations (Tensor): [bs, query_length, n_head, n_levels, n_points, 2]
+        attention_weights (Tensor): [bs, query_length, n_head, n_levels, n_points]
+        chunk_mb (float): size of the gathered corners of one query chunk.
+
+    Returns:
+        output (Tensor): [bs, Length_{query}, C]
+    """
+    bs, len_v, n_head, c = value.shape
+    _, Len_q, _, n_levels, n_points, _ = sampling_locations.shape
+    shapes = [(int(h), int(w)) for h, w in value_spatial_shapes]
+
+    # N_, S_, M_, D_ -> N_*M_*(S_+1), D_, the last row of every head is the zero padding
+    value = value.transpose([0, 2, 1, 3]).reshape([bs * n_head, len_v, c])
+    value = paddle.concat(
+        [value, paddle.zeros([bs * n_head, 1, c], dtype=value.dtype)], axis=1)
+    value = value.reshape([-1, c])
+
+    level_start = paddle.to_tensor(
+        [sum(h * w for h, w in shapes[:level]) for level in range(n_levels)],
+        dtype='int64')[:, None]
+    level_h = paddle.to_tensor([h for h, _ in shapes], dtype='int64')[:, None]
+    level_w = paddle.to_tensor([w for _, w in shapes], dtype='int64')[:, None]
+    level_wh = paddle.to_tensor(
+        [[w, h] for h, w in shapes], dtype=sampling_locations.dtype)[:, None]
+    head_start = (paddle.arange(bs * n_head, dtype='int64') * (len_v + 1)).reshape(
+        [bs, n_head, 1, 1, 1])
+
+    # N_, Lq_, M_, L_, P_, 2 -> N_, M_, Lq_, L_, P_, 2, in pixels of every level
+    pixels = sampling_locations.transpose([0, 2, 1, 3, 4, 5]) * level_wh - 0.5
+    corner = paddle.floor(pixels).detach()
+    frac = pixels - corner
+    corner = paddle.cast(corner, 'int64')
+    x0, y0 = corner[..., 0], corner[..., 1]
+    fx, fy = frac[..., 0], frac[..., 1]
+    indices, weights = [], []
+    for dy in (0, 1):
+        for dx in (0, 1):
+            x, y = x0 + dx, y0 + dy
+            valid = (x >= 0) & (x < level_w) & (y >= 0) & (y < level_h)
+            index = paddle.where(valid, level_start + y * level_w + x,
+                                 paddle.full_like(x, len_v))
+            indices.append(index + head_start)
+            weights.append((fx if dx else 1 - fx) * (fy if dy else 1 - fy))
+    # N_, M_, Lq_, L_, P_, 4
+    indices = paddle.stack(indices, axis=-1)
+    weights = paddle.stack(weights, axis=-1) * attention_weights.transpose(
+        [0, 2, 1, 3, 4]).unsqueeze(-1)
+
+    num_samples = n_levels * n_points * 4
+    # 一块query的gather结果 [N_*M_, chunk, L_*P_*4, D_] 不超过chunk_mb
+    chunk_bytes = bs * n_head * num_samples * c * (2 if value.dtype == paddle.float16 else 4)
+    chunk = max(1, min(Len_q, int(chunk_mb * 1024 * 1024 // chunk_bytes)))
+    # N_*M_, Lq_, L_*P_*4 weighted sum of the gathered rows -> N_, M_, Lq_, D_
+    output = _GatherWeightedSum.apply(
+        value, indices.reshape([bs * n_head, Len_q, num_samples]),
+        weights.reshape([bs * n_head, Len_q, num_samples]), chunk).reshape([bs, n_head, Len_q, c])
+
+    return output.transpose([0, 2, 1, 3]).reshape([bs, Len_q, n_head * c])
+
+
+def per_level_deformable_attention_core_func(value, value_spatial_shapes,
+                                   value_level_start_index, sampling_locations,
+                                   attention_weights):
+    """
+    Reference implementation of `deformable_attention_core_func`, one `F.grid_sample` per level.
+
     Args:
         value (Tensor): [bs, value_length, n_head, c]
         value_spatial_shapes (Tensor): [n_levels, 2]
@@ -0,0 +1,152 @@
+"""
+Parity and speed of the level-batched deformable attention fallback against the per-level one.
+
+    python tools/benchmark_deformable_attention.py --device cpu --num-queries 900
+
+Both the forward output and the gradients w.r.t. value, sampling locations and attention
+weights are compared; sampling locations are drawn slightly outside [0, 1] to cover the
+zero padding at the level borders. The peak memory of one call is measured on the GPU
+allocator, or on CPU as the peak resident memory of a fresh process per implementation.
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+import paddle
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modeling.transformers.utils import (level_batched_deformable_attention,
+                                         per_level_deformable_attention_core_func)
+
+
+def build_inputs(batch_size, num_queries, num_heads, head_dim, num_points, spatial_shapes, seed=0):
+    """random value, sampling locations and attention weights"""
+    rng = np.random.RandomState(seed)
+    num_levels = len(spatial_shapes)
+    value_length = sum(h * w for h, w in spatial_shapes)
+    value = rng.randn(batch_size, value_length, num_heads, head_dim)
+    locations = rng.uniform(-0.05, 1.05, (batch_size, num_queries, num_heads, num_levels, num_points, 2))
+    weights = rng.rand(batch_size, num_queries, num_heads, num_levels, num_points)
+    weights /= weights.sum((-1, -2), keepdims=True)
+    tensors = [paddle.to_tensor(x.astype('float32'), stop_gradient=False) for x in (value, locations, weights)]
+    shapes = paddle.to_tensor(spatial_shapes, dtype='int64')
+    start_index = paddle.to_tensor(np.cumsum([0] + [h * w for h, w in spatial_shapes[:-1]]), dtype='int64')
+    return tensors, shapes, start_index
+
+
+def run(func, tensors, shapes, start_index, backward):
+    value, locations, weights = tensors
+    if func is per_level_deformable_attention_core_func:
+        output = func(value, shapes, start_index, locations, weights)
+    else:
+        output = func(value, shapes, locations, weights)
+    if not backward:
+        return output, []
+    grads = paddle.grad(output.sum(), [value, locations, weights])
+    return output, grads
+
+
+def sync():
+    if paddle.is_compiled_with_cuda():
+        paddle.device.cuda.synchronize()
+
+
+def _proc_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+def _cpu_peak_memory_mb(name, input_args, backward):
+    """peak resident memory of one call, run in a fresh process (the allocator caches)"""
+    func = FUNCS[name]
+    tensors, shapes, start_index = build_inputs(*input_args)
+    rss = _proc_status_kb('VmRSS')
+    # 重置VmHWM
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    run(func, tensors, shapes, start_index, backward)
+    return (_proc_status_kb('VmHWM') - rss) / 1024
+
+
+def peak_memory_mb(name, input_args, tensors, shapes, start_index, backward):
+    """memory allocated by one call on top of its inputs, None if it can not be measured"""
+    if paddle.is_compiled_with_cuda() and 'gpu' in paddle.get_device():
+        if not hasattr(paddle.device.cuda, 'reset_max_memory_allocated'):
+            return None
+        sync()
+        paddle.device.cuda.reset_max_memory_allocated()
+        base = paddle.device.cuda.memory_allocated()
+        run(FUNCS[name], tensors, shapes, start_index, backward)
+        sync()
+        return (paddle.device.cuda.max_memory_allocated() - base) / 1024 ** 2
+    if not os.path.exists('/proc/self/clear_refs'):
+        return None
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    try:
+        return pool.apply(_cpu_peak_memory_mb, (name, input_args, backward))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def benchmark(func, tensors, shapes, start_index, backward, iters, warmup=2):
+    """average seconds of one call"""
+    for _ in range(warmup):
+        run(func, tensors, shapes, start_index, backward)
+    sync()
+    start = time.perf_counter()
+    for _ in range(iters):
+        run(func, tensors, shapes, start_index, backward)
+    sync()
+    return (time.perf_counter() - start) / iters
+
+
+FUNCS = {
+    'per-level': per_level_deformable_attention_core_func,
+    'batched': level_batched_deformable_attention,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--num-queries', type=int, default=900)
+    parser.add_argument('--num-heads', type=int, default=8)
+    parser.add_argument('--head-dim', type=int, default=32)
+    parser.add_argument('--num-points', type=int, default=4)
+    parser.add_argument('--input-size', type=int, nargs=2, default=[640, 640], help='image h w')
+    parser.add_argument('--strides', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    paddle.set_device(args.device)
+    spatial_shapes = [[-(-args.input_size[0] // s), -(-args.input_size[1] // s)] for s in args.strides]
+    input_args = (args.batch_size, args.num_queries, args.num_heads, args.head_dim, args.num_points,
+                  spatial_shapes)
+    tensors, shapes, start_index = build_inputs(*input_args)
+    print('device: {}, spatial shapes: {}, queries: {}'.format(
+        paddle.get_device(), spatial_shapes, args.num_queries))
+
+    ref, ref_grads = run(per_level_deformable_attention_core_func, tensors, shapes, start_index, True)
+    out, grads = run(level_batched_deformable_attention, tensors, shapes, start_index, True)
+    print('max abs diff: output {:.2e}, grad value {:.2e}, grad locations {:.2e}, grad weights {:.2e}'.format(
+        *[float((a - b).abs().max()) for a, b in zip([out] + list(grads), [ref] + list(ref_grads))]))
+
+    for backward in (False, True):
+        for name, func in FUNCS.items():
+            seconds = benchmark(func, tensors, shapes, start_index, backward, args.iters)
+            peak = peak_memory_mb(name, input_args, tensors, shapes, start_index, backward)
+            print('{:>16}: {:8.2f} ms, peak {}'.format(
+                name + (' fwd+bwd' if backward else ' fwd'), seconds * 1e3,
+                'n/a' if peak is None else '{:.1f} MB'.format(peak)))
+
+
+if __name__ == '__main__':
+    main()
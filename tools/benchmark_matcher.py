@@ -0,0 +1,90 @@
+"""
+Micro-benchmark of the Mask2Former HungarianMatcher: batched vs per-image matching.
+
+    python tools/benchmark_matcher.py --batch-size 2 --num-queries 100 --max-targets 19
+
+The loss calls the matcher once for the main output and once per auxiliary decoder layer,
+so `ms / step` is the matching time of one training step of the segmentation task.
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import paddle
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from modeling.losses.mask2former_loss import HungarianMatcher
+
+
+def build_inputs(batch_size, num_queries, num_classes, max_targets, pred_size, gt_size, seed=0):
+    """random logits, masks and targets of realistic sizes"""
+    rng = np.random.RandomState(seed)
+    outputs = {
+        'pred_logits': paddle.to_tensor(rng.randn(batch_size, num_queries, num_classes + 1).astype('float32')),
+        'pred_masks': paddle.to_tensor(rng.randn(batch_size, num_queries, *pred_size).astype('float32')),
+    }
+    targets = []
+    for _ in range(batch_size):
+        n = rng.randint(1, max_targets + 1)
+        labels = rng.choice(num_classes, n, replace=False).astype('int64')
+        masks = rng.rand(n, *gt_size) > 0.5
+        targets.append({'labels': paddle.to_tensor(labels), 'masks': paddle.to_tensor(masks)})
+    return outputs, targets
+
+
+def sync():
+    if paddle.is_compiled_with_cuda():
+        paddle.device.cuda.synchronize()
+
+
+def benchmark(matcher, outputs, targets, iters, warmup=3):
+    """average seconds of one matcher call"""
+    for _ in range(warmup):
+        matcher(outputs, targets)
+    sync()
+    start = time.perf_counter()
+    for _ in range(iters):
+        matcher(outputs, targets)
+    sync()
+    return (time.perf_counter() - start) / iters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--num-queries', type=int, default=100)
+    parser.add_argument('--num-classes', type=int, default=19)
+    parser.add_argument('--max-targets', type=int, default=19)
+    parser.add_argument('--pred-size', type=int, nargs=2, default=[160, 90])
+    parser.add_argument('--gt-size', type=int, nargs=2, default=[640, 360])
+    parser.add_argument('--dec-layers', type=int, default=10, help='matcher calls per training step')
+    parser.add_argument('--iters', type=int, default=20)
+    parser.add_argument('--device', default=None, help='e.g. cpu or gpu:0')
+    args = parser.parse_args()
+
+    if args.device is not None:
+        paddle.set_device(args.device)
+    outputs, targets = build_inputs(args.batch_size, args.num_queries, args.num_classes,
+                                    args.max_targets, args.pred_size, args.gt_size)
+    print('device: {}, targets per image: {}'.format(
+        paddle.get_device(), [int(t['labels'].shape[0]) for t in targets]))
+
+    # the same random points give the same assignment in both modes
+    results = {}
+    for batched in (False, True):
+        paddle.seed(0)
+        results[batched] = HungarianMatcher(batched=batched)(outputs, targets)
+    same = all((i0.numpy() == i1.numpy()).all() and (j0.numpy() == j1.numpy()).all()
+               for (i0, j0), (i1, j1) in zip(results[False], results[True]))
+    print('assignments identical: {}'.format(same))
+
+    for name, batched in (('per-image', False), ('batched', True)):
+        seconds = benchmark(HungarianMatcher(batched=batched), outputs, targets, args.iters)
+        print('{:>10}: {:8.2f} ms / call, {:8.2f} ms / step'.format(
+            name, seconds * 1e3, seconds * 1e3 * args.dec_layers))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Checks of the bucketed gradient all_reduce on CPU, in one process.
+
+    python tools/check_grad_reduce.py
+
+Communication goes through `utils.comm.SimulatedGroup`, whose ranks all hold the same
+tensors: a sum all_reduce multiplies by the number of ranks, and calls and bytes are
+counted. Every check raises AssertionError on failure.
+"""
+import os
+import sys
+
+import numpy as np
+import paddle
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.comm import SimulatedGroup, tensor_nbytes
+from detectron2.engine.train_loop import GradBuckets, OverlappedGradReducer
+
+
+class MLP(paddle.nn.Layer):
+    """a few linear layers and a frozen one"""
+    def __init__(self, dim=64, depth=4):
+        super().__init__()
+        self.layers = paddle.nn.LayerList([paddle.nn.Linear(dim, dim) for _ in range(depth)])
+        self.unused = paddle.nn.Linear(dim, dim)
+        self.frozen = paddle.nn.Linear(dim, dim)
+        for p in self.frozen.parameters():
+            p.stop_gradient = True
+
+    def forward(self, x):
+        for layer in self.layers:
+            x = layer(x)
+        return (x ** 2).mean()
+
+
+class MultiTask(paddle.nn.Layer):
+    """a shared backbone and one head per task; `borrow` makes a task also use another head"""
+    def __init__(self, tasks=('a', 'b', 'c'), dim=64):
+        super().__init__()
+        self.backbone = MLP(dim).layers
+        self.heads = paddle.nn.LayerDict({t: paddle.nn.Linear(dim, 1) for t in tasks})
+        self.borrow = {}
+
+    def forward(self, task, x):
+        for layer in self.backbone:
+            x = layer(x)
+        loss = (self.heads[task](x) ** 2).mean()
+        if task in self.borrow:
+            loss = loss + self.heads[self.borrow[task]](x).mean()
+        return loss
+
+
+class DivergentGroup(SimulatedGroup):
+    """a SimulatedGroup whose last rank recorded that task `task` also uses parameters `extra`"""
+    def __init__(self, nranks, task, extra):
+        super().__init__(nranks)
+        self.task = task
+        self.extra = extra
+
+    def all_gather_object(self, data):
+        gathered = super().all_gather_object(data)
+        tasks, used = gathered[-1]
+        used[self.task] = sorted(set(used.get(self.task, [])) | set(self.extra))
+        return gathered
+
+
+def grads_of(model):
+    return {p.name: p.grad.numpy().copy() for p in model.parameters() if p.grad is not None}
+
+
+def max_diff(grads, ref, scale=1.0):
+    assert sorted(grads) == sorted(ref), (sorted(grads), sorted(ref))
+    return max(np.abs(grads[k] - ref[k] * scale).max() for k in ref)
+
+
+def check_grad_buckets(nranks=4, div_factor=2, bucket_size_mb=0.02):
+    """reduced grads, number of collectives and bytes of GradBuckets"""
+    paddle.seed(0)
+    model = MLP()
+    x = paddle.rand([8, 64])
+    model(x).backward()
+    ref = grads_of(model)
+
+    group = SimulatedGroup(nranks)
+    buckets = GradBuckets(model.parameters(), group, bucket_size_mb, div_factor)
+    trainable = [p for p in model.parameters() if not p.stop_gradient]
+    assert sum(len(b) for b in buckets.buckets) == len(trainable)
+    assert len(buckets.buckets) > 1
+    buckets.reduce()
+    # 每个simulated rank的梯度相同: 求和后乘nranks, 再除以div_factor
+    err = max_diff(grads_of(model), ref, nranks / div_factor)
+    assert err < 1e-6, err
+    assert buckets.num_collectives == len(buckets.buckets) == group.num_calls
+    # 没有梯度的参数以0参与通信, 但不写回
+    assert buckets.num_bytes == sum(tensor_nbytes(p) for p in trainable) == group.num_bytes
+    assert all(p.grad is None for p in model.unused.parameters())
+
+    # comm_flag=False只做除法
+    buckets.reduce(comm_flag=False)
+    err = max_diff(grads_of(model), ref, nranks / div_factor ** 2)
+    assert err < 1e-6, err
+    assert buckets.num_collectives == 0 and group.num_calls == len(buckets.buckets)
+
+    # 单rank不通信
+    single = GradBuckets(model.parameters(), SimulatedGroup(1), bucket_size_mb)
+    single.reduce()
+    assert single.num_collectives == 0
+    print('GradBuckets: {} buckets, {:.3f} MB, max err {:.1e}'.format(
+        len(buckets.buckets), group.num_bytes / 1024 ** 2, err))
+
+
+def _overlapped_step(model, reducer, batch):
+    model.clear_gradients()
+    reducer.begin_step(batch.keys())
+    for task, x in batch.items():
+        reducer.begin_task(task)
+        model(task, x).backward()
+    reducer.finish_step()
+    return grads_of(model)
+
+
+def _plain_step(model, batch):
+    model.clear_gradients()
+    for task, x in batch.items():
+        model(task, x).backward()
+    return grads_of(model)
+
+
+def check_overlapped_reducer(nranks=4, bucket_size_mb=0.0001, steps=3):
+    """
+    OverlappedGradReducer: reduced grads equal plain backward, buckets overlap the backward
+    after the recording step, late grads are reduced again, and the usage of all ranks is
+    merged before the layout is built.
+    """
+    paddle.seed(0)
+    model = MultiTask()
+    rng = np.random.RandomState(0)
+    batches = [{t: paddle.to_tensor(rng.randn(8, 64).astype('float32')) for t in 'abc'}
+               for _ in range(steps + 1)]
+    group = SimulatedGroup(nranks)
+    reducer = OverlappedGradReducer(model, group, bucket_size_mb)
+
+    for step, batch in enumerate(batches[:steps]):
+        ref = _plain_step(model, batch)
+        err = max_diff(_overlapped_step(model, reducer, batch), ref)
+        assert err < 1e-6, (step, err)
+        num_buckets = len(reducer.buckets.buckets)
+        assert reducer.buckets.num_collectives == num_buckets
+        # 第一步只记录参数的使用情况
+        assert reducer.num_overlapped == (0 if step == 0 else num_buckets), (step, reducer.num_overlapped)
+    # 每个task用到backbone和自己的head
+    assert len(reducer.task_params['a']) == len(reducer.task_params['c'])
+
+    # task c开始使用a的head: a的bucket已经发出, 要重新归约
+    model.borrow['c'] = 'a'
+    ref = _plain_step(model, batches[steps])
+    err = max_diff(_overlapped_step(model, reducer, batches[steps]), ref)
+    assert err < 1e-6, err
+    head_a = set(i for i, p in enumerate(reducer.params) if any(p is q for q in model.heads['a'].parameters()))
+    assert head_a <= reducer.task_params['c']
+    assert reducer.buckets.num_collectives > len(reducer.buckets.buckets)
+    # 重建后不再重新归约
+    err = max_diff(_overlapped_step(model, reducer, batches[0]), _plain_step(model, batches[0]))
+    assert err < 1e-6, err
+    assert reducer.buckets.num_collectives == len(reducer.buckets.buckets)
+    print('OverlappedGradReducer: {} buckets, {} overlapped, max err {:.1e}'.format(
+        len(reducer.buckets.buckets), reducer.num_overlapped, err))
+
+    # 另一个rank记录到task a还用到了b的head: 所有rank的layout一致
+    model.borrow.clear()
+    b_head = [i for i, p in enumerate(reducer.params) if any(p is q for q in model.heads['b'].parameters())]
+    reducer = OverlappedGradReducer(model, DivergentGroup(nranks, 'a', b_head), bucket_size_mb)
+    _overlapped_step(model, reducer, batches[0])
+    assert set(b_head) <= reducer.task_params['a']
+
+
+def main():
+    check_grad_buckets()
+    check_overlapped_reducer()
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
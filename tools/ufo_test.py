@@ -37,6 +37,7 @@ from detectron2.engine import (
 from evaluation import print_csv_format
 from evaluation.evaluator import inference_on_dataset
 from evaluation.seg_evaluator import seg_inference_on_dataset, seg_inference_on_test_dataset
+from evaluation.seg_export import dump_json
 from utils import comm
 
 logger = logging.getLogger("ufo")
@@ -50,6 +51,7 @@ def do_test(cfg, model, _run=None, subnet_mode="largest"):
             task_name = '.'.join(list(dataloader.task_loaders.keys()))
             dataset_name = dataloader.task_loaders[task_name].dataset.dataset_name
             if (hasattr(cfg.train, 'selected_task_names')) and (task_name not in cfg.train.selected_task_names):
+                dataloader.shutdown()
                 continue
             print('=' * 10, dataset_name, '=' * 10)
             # recognition
@@ -69,7 +71,9 @@ def do_test(cfg, model, _run=None, subnet_mode="largest"):
                 evaluator_cfg.anno_file = list(dataloader.task_loaders.values())[0].dataset.get_anno()
                 evaluator_cfg.clsid2catid = {v: k for k, v in list(dataloader.task_loaders.values())[0].dataset.catid2clsid.items()}
                 evaluator = instantiate(evaluator_cfg)
-                ret = inference_on_dataset(model, dataloader, evaluator)
+                ret = inference_on_dataset(model, dataloader, evaluator, det_scales=args.tta_scales_det,
+                                           det_flip=args.flip_horizontal_det, det_fusion=args.tta_fusion_det)
+            dataloader.shutdown()
             if comm.is_main_process():
                 pred_rets.update(**ret)
 
@@ -79,7 +83,7 @@ def do_test(cfg, model, _run=None, subnet_mode="largest"):
                 os.makedirs(save_path)
             save_path = os.path.join(save_path, 'pred_results.json')
             with open(save_path, 'w') as f:
-                json.dump(pred_rets, f)
+                dump_json(pred_rets, f)
                 logger.info(f'Pred results are saved to {save_path}')
 
 def main(args):
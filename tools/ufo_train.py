@@ -19,7 +19,7 @@ sys.path.append('.')
 SEED = os.getenv("SEED", "0")
 paddle.seed(42)
 from utils.events import CommonMetricSacredWriter
-from engine.hooks import LRScheduler
+from engine.hooks import LRScheduler, DatasetIterSync
 from utils.config import auto_adjust_cfg
 from fastreid.utils.checkpoint import Checkpointer
 from detectron2.config import LazyConfig, instantiate
@@ -47,6 +47,7 @@ def do_test(cfg, model, _run=None, subnet_mode="largest"):
             task_name = '.'.join(list(dataloader.task_loaders.keys()))
             dataset_name = dataloader.task_loaders[task_name].dataset.dataset_name
             if (hasattr(cfg.train, 'selected_task_names')) and (task_name not in cfg.train.selected_task_names):
+                dataloader.shutdown()
                 continue
             print('=' * 10, dataset_name, '=' * 10)
             # recognition
@@ -70,6 +71,8 @@ def do_test(cfg, model, _run=None, subnet_mode="largest"):
                 evaluator_cfg.clsid2catid = {v: k for k, v in list(dataloader.task_loaders.values())[0].dataset.catid2clsid.items()}
                 evaluator = instantiate(evaluator_cfg)
                 ret = inference_on_dataset(model, dataloader, evaluator)
+            # release the worker processes of this eval loader before the next one starts
+            dataloader.shutdown()
             print_csv_format(ret)
 
             for metric, res in ret.items():
@@ -114,7 +117,10 @@ def do_train(args, cfg, cfg_for_sacred=None, _run=None):
 
     if paddle.distributed.get_world_size() > 1:
         model = paddle.DataParallel(model)
-    trainer = (AMPTrainer if cfg.train.amp.enabled else SimpleTrainer)(model, train_loader, optim)
+    trainer = (AMPTrainer if cfg.train.amp.enabled else SimpleTrainer)(
+        model, train_loader, optim, metrics_period=cfg.train.log_period,
+        overlap_grad_reduce=cfg.train.get('overlap_grad_reduce', False),
+        micro_batch=cfg.train.get('micro_batch', None))
 
     checkpointer = Checkpointer(
         model,
@@ -130,6 +136,7 @@ def do_train(args, cfg, cfg_for_sacred=None, _run=None):
         [
             hooks.IterationTimer(),
             LRScheduler(optimizer=optim, scheduler=optim._learning_rate),
+            DatasetIterSync(train_loader),
             hooks.PeriodicCheckpointer(checkpointer, **cfg.train.checkpointer)
             if comm.is_main_process()
             else None,
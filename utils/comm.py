@@ -83,6 +83,23 @@ def gather_v(data, dst=0, group=None):
     return data_list
 
 
+def all_gather_object(data, group=None):
+    """
+    Run all_gather on arbitrary picklable data (not necessarily tensors).
+
+    Returns:
+        list[data]: list of data gathered from each rank
+    """
+    if hasattr(group, 'all_gather_object'):
+        data_list = group.all_gather_object(data)
+    elif get_world_size(group) > 1:
+        data_list = []
+        dist.all_gather_object(data_list, data, group)
+    else:
+        data_list = [data]
+    return data_list
+
+
 def gather(datas, dst=0, group=None):
     """
     Run gather on arbitrary picklable data (not necessarily tensors).
@@ -132,6 +149,70 @@ def gather(datas, dst=0, group=None):
         data_list = [datas]
     return data_list
 
+_DTYPE_BYTES = {
+    'bool': 1, 'uint8': 1, 'int8': 1, 'float16': 2, 'bfloat16': 2,
+    'int32': 4, 'float32': 4, 'int64': 8, 'float64': 8,
+}
+
+
+def tensor_nbytes(tensor):
+    """size of a tensor in bytes, without touching its data"""
+    return int(np.prod(tensor.shape)) * _DTYPE_BYTES[str(tensor.dtype).split('.')[-1]]
+
+
+class SimulatedGroup(object):
+    """
+    A process group of `nranks` ranks simulated in one process, to test communication code
+    without launching workers. Every simulated rank holds the same tensors, so a sum
+    all_reduce multiplies by nranks. Calls and bytes are counted.
+    """
+
+    def __init__(self, nranks=2):
+        self.nranks = nranks
+        self.ranks = list(range(nranks))
+        self.rank = 0
+        self.num_calls = 0
+        self.num_bytes = 0
+
+    def all_reduce(self, tensor):
+        """in place sum all_reduce of tensor over the simulated ranks"""
+        with paddle.no_grad():
+            tensor.scale_(float(self.nranks))
+        self.num_calls += 1
+        self.num_bytes += tensor_nbytes(tensor)
+
+    def all_gather_object(self, data):
+        """the same object from every simulated rank"""
+        self.num_calls += 1
+        return [pickle.loads(pickle.dumps(data)) for _ in self.ranks]
+
+
+class _AllReduceWork(object):
+    """handle of an all_reduce started on the communication stream"""
+
+    def __init__(self, tensor=None, group=None):
+        self.tensor = tensor
+        self.group = group
+
+    def wait(self):
+        """make the calculation stream wait for the all_reduce"""
+        if self.tensor is not None:
+            dist.wait(self.tensor, group=self.group, use_calc_stream=True)
+
+
+def all_reduce_async(tensor, group=None):
+    """
+    Start an in place sum all_reduce of a tensor on the communication stream, so that the
+    following kernels overlap with it. The tensor must not be read before `wait()` of the
+    returned handle. A :class:`SimulatedGroup` reduces at once.
+    """
+    if hasattr(group, 'all_reduce'):
+        group.all_reduce(tensor)
+        return _AllReduceWork()
+    dist.all_reduce(tensor, group=group, use_calc_stream=False)
+    return _AllReduceWork(tensor, group)
+
+
 def shared_random_seed():
     """
     Returns:
@@ -7,18 +7,77 @@
 # Modified from: https://github.com/open-mmlab/OpenUnReID/blob/66bb2ae0b00575b80fbe8915f4d4f4739cc21206/openunreid/core/utils/compute_dist.py
 
 
-import faiss
 import numpy as np
 import paddle
 import paddle.nn.functional as F
+from scipy import sparse
 
 __all__ = [
     "build_dist",
+    "iter_dist_blocks",
     "compute_jaccard_distance",
     "compute_euclidean_distance",
     "compute_cosine_distance",
+    "k_reciprocal_encoding",
+    "jaccard_distance_block",
+    "iter_jaccard_blocks",
 ]
 
+# 分块计算时每块的行数, 一块 [block_size, n] 的距离矩阵在显存中
+DEFAULT_BLOCK_SIZE = 4096
+# jaccard距离一次配对的非零元对数上限, 限制临时数组的大小
+MAX_JACCARD_PAIRS = 1 << 22
+
+
+def _to_tensor(features):
+    if isinstance(features, paddle.Tensor):
+        return features.astype('float32')
+    return paddle.to_tensor(np.asarray(features, dtype='float32'))
+
+
+def _use_fp16(fp16):
+    # CPU上没有float16的matmul
+    return fp16 and 'gpu' in paddle.get_device()
+
+
+@paddle.no_grad()
+def iter_dist_blocks(feat_1, feat_2, metric="euclidean", block_size=DEFAULT_BLOCK_SIZE, fp16=False):
+    r"""Yield the distance matrix between two feature embeddings block by block.
+
+    Only `block_size` rows of feat_1 against all of feat_2 are on the device at a time, so the
+    full matrix never has to fit in memory.
+
+    Args:
+        feat_1 (paddle.Tensor|numpy.ndarray): 2-D feature with batch dimension.
+        feat_2 (paddle.Tensor|numpy.ndarray): 2-D feature with batch dimension.
+        metric: "euclidean" (squared) or "cosine".
+        block_size (int): rows of feat_1 per block.
+        fp16 (bool): half precision matmul, only on GPU.
+
+    Yields:
+        (int, numpy.ndarray): first row of the block and the float32 [rows, len(feat_2)] distances.
+    """
+    assert metric in ["cosine", "euclidean"], "Expected metrics are cosine and euclidean, " \
+                                              "but got {}".format(metric)
+    feat_1, feat_2 = _to_tensor(feat_1), _to_tensor(feat_2)
+    if metric == "cosine":
+        feat_1 = F.normalize(feat_1, p=2, axis=1)
+        feat_2 = F.normalize(feat_2, p=2, axis=1)
+    else:
+        sq_2 = paddle.pow(feat_2, 2).sum(axis=1).unsqueeze(0)
+    fp16 = _use_fp16(fp16)
+    others = feat_2.astype('float16') if fp16 else feat_2
+    for start in range(0, feat_1.shape[0], block_size):
+        block = feat_1[start:start + block_size]
+        prod = paddle.matmul(block.astype('float16') if fp16 else block, others, transpose_y=True)
+        prod = prod.astype('float32')
+        if metric == "cosine":
+            dist = 1 - prod
+        else:
+            sq_1 = paddle.pow(block, 2).sum(axis=1, keepdim=True)
+            dist = paddle.clip(sq_1 + sq_2 - 2 * prod, min=0)
+        yield start, dist.numpy()
+
 
 @paddle.no_grad()
 def build_dist(feat_1, feat_2, metric="euclidean", **kwargs):
@@ -27,24 +86,39 @@ def build_dist(feat_1, feat_2, metric="euclidean", **kwargs):
     Args:
         feat_1 (paddle.Tensor): 2-D feature with batch dimension.
         feat_2 (paddle.Tensor): 2-D feature with batch dimension.
-        metric:
+        metric: "cosine", "euclidean" or "jaccard" (k-reciprocal re-ranking distance, with
+            kwargs k1 and k2).
+        kwargs: block_size and fp16 of the distance engine; blocks=True returns an iterator
+            of (start, block) over the rows of feat_1 instead, for galleries whose full
+            distance matrix does not fit in memory (see `evaluation.rank.evaluate_rank_streaming`).
 
     Returns:
-        numpy.ndarray: distance matrix.
+        numpy.ndarray: distance matrix, or an iterator of its row blocks.
     """
     assert metric in ["cosine", "euclidean", "jaccard"], "Expected metrics are cosine, euclidean and jaccard, " \
                                                          "but got {}".format(metric)
+    block_size = kwargs.get("block_size", DEFAULT_BLOCK_SIZE)
+    fp16 = kwargs.get("fp16", False)
 
-    if metric == "euclidean":
-        return compute_euclidean_distance(feat_1, feat_2)
+    if metric == "jaccard":
+        feat = paddle.concat((_to_tensor(feat_1), _to_tensor(feat_2)), axis=0)
+        num_1 = feat_1.shape[0]
+        encoding = k_reciprocal_encoding(
+            feat, k1=kwargs.get("k1", 20), k2=kwargs.get("k2", 6), fp16=fp16, block_size=block_size)
+        # 只计算 query x gallery 这一块
+        blocks = iter_jaccard_blocks(encoding, num_1, cols=np.arange(num_1, feat.shape[0]), block_size=block_size)
+    else:
+        blocks = iter_dist_blocks(feat_1, feat_2, metric, block_size, fp16)
+    if kwargs.get("blocks", False):
+        return blocks
+    return _gather_blocks(blocks, feat_1.shape[0], feat_2.shape[0])
 
-    elif metric == "cosine":
-        return compute_cosine_distance(feat_1, feat_2)
 
-    # elif metric == "jaccard":
-    #     feat = paddle.concat((feat_1, feat_2), axis=0)
-    #     dist = compute_jaccard_distance(feat, k1=kwargs["k1"], k2=kwargs["k2"], search_option=0)
-    #     return dist[:feat_1.size(0), feat_1.size(0):]
+def _gather_blocks(blocks, num_1, num_2):
+    dist_m = np.empty((num_1, num_2), dtype=np.float32)
+    for start, block in blocks:
+        dist_m[start:start + len(block)] = block
+    return dist_m
 
 
 def k_reciprocal_neigh(initial_rank, i, k1):
@@ -56,37 +130,166 @@ def k_reciprocal_neigh(initial_rank, i, k1):
     return forward_k_neigh_index[fi]
 
 
+def _k_reciprocal_matrix(initial_rank, k):
+    """k_reciprocal_neigh of all samples at once, as a sparse 0/1 [N, N] matrix"""
+    num = initial_rank.shape[0]
+    forward = initial_rank[:, :k + 1]
+    backward = initial_rank[forward, :k + 1]
+    mask = (backward == np.arange(num)[:, None, None]).any(axis=2)
+    rows = np.broadcast_to(np.arange(num)[:, None], forward.shape)[mask]
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, forward[mask])), shape=(num, num))
+
+
 @paddle.no_grad()
-def compute_jaccard_distance(features, k1=20, k2=6, search_option=0, fp16=False):
-    """compute_jaccard_distance
+def k_reciprocal_encoding(features, k1=20, k2=6, fp16=False, block_size=DEFAULT_BLOCK_SIZE):
     """
-    pass
+    Sparse k-reciprocal encoding V of the re-ranking (Zhong et al., CVPR 2017): row i holds the
+    softmax weights of the expanded k-reciprocal neighbours of sample i, averaged over its k2
+    nearest neighbours (query expansion). Features are L2 normalized.
+
+    Returns:
+        scipy.sparse.csr_matrix: [N, N], every row sums to 1.
+    """
+    features = F.normalize(_to_tensor(features), p=2, axis=1)
+    num = features.shape[0]
+    k1 = min(k1, num - 1)
+    k2 = min(k2, k1 + 1)
+
+    # 分块取前k1+1近邻, 不需要完整的 N x N 距离矩阵
+    initial_rank = np.empty((num, k1 + 1), dtype='int64')
+    for start, dist in iter_dist_blocks(features, features, "euclidean", block_size, fp16):
+        part = np.argpartition(dist, k1, axis=1)[:, :k1 + 1]
+        order = np.argsort(np.take_along_axis(dist, part, axis=1), axis=1, kind='stable')
+        initial_rank[start:start + len(dist)] = np.take_along_axis(part, order, axis=1)
+
+    nn_k1 = _k_reciprocal_matrix(initial_rank, k1)
+    nn_k1_half = _k_reciprocal_matrix(initial_rank, int(np.around(k1 / 2)))
+
+    # 候选c的半近邻与i的近邻交集超过2/3时, 把c的半近邻并入i的扩展集合
+    inter = (nn_k1 @ nn_k1_half.T).multiply(nn_k1).tocsr()
+    half_size = np.asarray(nn_k1_half.sum(axis=1)).ravel()
+    inter.data = (inter.data > 2. / 3 * half_size[inter.indices]).astype(np.float32)
+    inter.eliminate_zeros()
+    # 自身总在集合内, 重复特征很多时也不会出现空行
+    expansion = (nn_k1 + inter @ nn_k1_half + sparse.identity(num, dtype=np.float32, format='csr')).tocsr()
+    expansion.sort_indices()
+    rows = np.repeat(np.arange(num), np.diff(expansion.indptr))
+    cols = expansion.indices
+
+    # 扩展集合内的 softmax(-dist), dist = 2 - 2 * cos
+    feat = features.numpy()
+    sim = np.empty(len(rows), dtype=np.float32)
+    step = max(1, block_size * 64)
+    for start in range(0, len(rows), step):
+        sl = slice(start, start + step)
+        sim[sl] = (feat[rows[sl]] * feat[cols[sl]]).sum(axis=1)
+    logits = 2 * sim
+    row_max = np.maximum.reduceat(logits, expansion.indptr[:-1])
+    weights = np.exp(logits - row_max[rows])
+    weights /= np.add.reduceat(weights, expansion.indptr[:-1])[rows]
+    # scipy.sparse不支持float16, fp16只用于距离的matmul
+    encoding = sparse.csr_matrix((weights.astype(np.float32), cols, expansion.indptr), shape=(num, num))
+
+    if k2 != 1:
+        qe_rows = np.repeat(np.arange(num), k2)
+        qe = sparse.csr_matrix((np.full(len(qe_rows), 1. / k2, dtype=np.float32),
+                                (qe_rows, initial_rank[:, :k2].ravel())), shape=(num, num))
+        encoding = (qe @ encoding).tocsr()
+    return encoding
+
+
+def _jaccard_rows(rows, by_col, cols):
+    block = rows.tocoo()
+    # 每个非零元(i, c)与第c列的所有非零元(j, c)配对
+    counts = np.diff(by_col.indptr)[block.col]
+    a = np.repeat(np.arange(block.nnz), counts)
+    offsets = np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+    b = np.repeat(by_col.indptr[block.col], counts) + offsets
+    mins = np.minimum(block.data[a], by_col.data[b])
+    overlap = sparse.csr_matrix((mins, (block.row[a], by_col.indices[b])), shape=(block.shape[0], by_col.shape[0]))
+    if cols is not None:
+        overlap = overlap[:, cols]
+    overlap = overlap.toarray()
+    return (1 - overlap / (2 - overlap)).astype(np.float32)
+
+
+def jaccard_distance_block(encoding, row_start, row_end, cols=None, by_col=None, max_pairs=MAX_JACCARD_PAIRS):
+    """
+    Jaccard distance 1 - m / (2 - m) of rows [row_start, row_end) of a k-reciprocal encoding,
+    where m[i, j] = sum_c min(V[i, c], V[j, c]). Only pairs sharing a neighbour are touched,
+    at most `max_pairs` of them at a time.
+
+    Args:
+        by_col: `encoding.tocsc()`, pass it when computing many blocks.
+
+    Returns:
+        numpy.ndarray: float32 [row_end - row_start, len(cols)], all columns if cols is None.
+    """
+    if by_col is None:
+        by_col = encoding.tocsc()
+    by_col.sort_indices()
+    block = encoding[row_start:row_end]
+    # 按配对数把行分组, 临时数组的大小和块的行数无关
+    entry_pairs = np.diff(by_col.indptr)[block.indices]
+    row_pairs = np.add.reduceat(np.append(entry_pairs, 0), block.indptr[:-1]) * (np.diff(block.indptr) > 0)
+    cum_pairs = np.cumsum(row_pairs)
+    out = np.empty((block.shape[0], by_col.shape[0] if cols is None else len(cols)), dtype=np.float32)
+    start = 0
+    while start < block.shape[0]:
+        limit = (cum_pairs[start - 1] if start > 0 else 0) + max_pairs
+        end = max(start + 1, int(np.searchsorted(cum_pairs, limit, side='right')))
+        out[start:end] = _jaccard_rows(block[start:end], by_col, cols)
+        start = end
+    return out
+
+
+def iter_jaccard_blocks(encoding, num_rows=None, cols=None, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Yield the jaccard distances of the first `num_rows` rows of a k-reciprocal encoding
+    (all rows if None) block by block, like :func:`iter_dist_blocks`.
+    """
+    num_rows = encoding.shape[0] if num_rows is None else num_rows
+    by_col = encoding.tocsc()
+    for start in range(0, num_rows, block_size):
+        yield start, jaccard_distance_block(encoding, start, min(start + block_size, num_rows), cols, by_col)
 
 
 @paddle.no_grad()
-def compute_euclidean_distance(features, others):
-    """compute_euclidean_distance
+def compute_jaccard_distance(features, k1=20, k2=6, search_option=0, fp16=False, block_size=DEFAULT_BLOCK_SIZE):
+    """Computes the k-reciprocal jaccard distance between all samples of features.
+
+    search_option is kept for compatibility: the nearest neighbours always come from the
+    blocked distance engine on the current device.
+
+    Returns:
+        numpy.ndarray: [N, N] distance matrix.
     """
-    m, n = features.size(0), others.size(0)
-    dist_m = (
-            paddle.pow(features, 2).sum(dim=1, keepdim=True).expand(m, n)
-            + paddle.pow(others, 2).sum(dim=1, keepdim=True).expand(n, m).t()
-    )
-    dist_m.addmm_(1, -2, features, others.t()).numpy()
+    encoding = k_reciprocal_encoding(features, k1=k1, k2=k2, fp16=fp16, block_size=block_size)
+    num = encoding.shape[0]
+    return _gather_blocks(iter_jaccard_blocks(encoding, block_size=block_size), num, num)
 
-    return dist_m
+
+@paddle.no_grad()
+def compute_euclidean_distance(features, others, block_size=DEFAULT_BLOCK_SIZE, fp16=False):
+    """Computes squared euclidean distance.
+    Args:
+        features (paddle.Tensor): 2-D feature matrix.
+        others (paddle.Tensor): 2-D feature matrix.
+    Returns:
+        numpy.ndarray: distance matrix.
+    """
+    return _gather_blocks(iter_dist_blocks(features, others, "euclidean", block_size, fp16),
+                          features.shape[0], others.shape[0])
 
 
 @paddle.no_grad()
-def compute_cosine_distance(features, others):
+def compute_cosine_distance(features, others, block_size=DEFAULT_BLOCK_SIZE, fp16=False):
     """Computes cosine distance.
     Args:
         features (paddle.Tensor): 2-D feature matrix.
         others (paddle.Tensor): 2-D feature matrix.
     Returns:
-        paddle.Tensor: distance matrix.
+        numpy.ndarray: distance matrix.
     """
-    features = F.normalize(features, p=2, axis=1)
-    others = F.normalize(others, p=2, axis=1)
-    dist_m = 1 - paddle.mm(features, others.t()).numpy()
-    return dist_m
+    return _gather_blocks(iter_dist_blocks(features, others, "cosine", block_size, fp16),
+                          features.shape[0], others.shape[0])